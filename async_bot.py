@@ -0,0 +1,533 @@
+import asyncio
+import io
+import logging
+import os
+import secrets
+import tempfile
+from datetime import datetime
+
+import schedule
+from telebot import asyncio_filters, asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import State, StatesGroup
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.asyncio_storage import StateMemoryStorage
+
+import async_database
+import cache
+import callbacks
+import config
+import logs
+import metrics
+import outbox
+import reports
+import storage
+
+# Асинхронный режим бота на AsyncTeleBot. Обработчики повторяют bot.py, но
+# обращения к базе данных и диску выполняются в пуле потоков, поэтому медленная
+# загрузка файла или экспорт не задерживают сообщения других пользователей.
+# Запуск: python async_bot.py
+
+# Запись журнала выполняется отдельным потоком и не блокирует цикл событий
+logs.setup_logging("bot.log", structured=getattr(config, 'LOG_JSON', False),
+                   asynchronous=getattr(config, 'LOG_ASYNC', True))
+metrics.SLOW_QUERY_SECONDS = getattr(config, 'SLOW_QUERY_MS', 100) / 1000
+
+bot = AsyncTeleBot(config.TOKEN, state_storage=StateMemoryStorage())
+bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+
+# Все исходящие вызовы Telegram API проходят через общую очередь с лимитами,
+# как в bot.py; результат вызова - Future очереди, ожидать его не нужно
+outgoing = outbox.AsyncOutbox()
+
+def send_message(chat_id, text, priority=outbox.PRIORITY_USER, **kwargs):
+    return outgoing.submit(chat_id, bot.send_message, chat_id, text, priority=priority, **kwargs)
+
+def edit_message_text(text, chat_id, message_id, priority=outbox.PRIORITY_ADMIN, **kwargs):
+    return outgoing.submit(chat_id, bot.edit_message_text, text, chat_id, message_id, priority=priority, **kwargs)
+
+# Документ из памяти; InputFile создается заново при каждой попытке отправки
+async def _send_document(chat_id, data, file_name):
+    return await bot.send_document(chat_id, types.InputFile(io.BytesIO(data), file_name=file_name))
+
+def send_document(chat_id, data, file_name, priority=outbox.PRIORITY_USER):
+    return outgoing.submit(chat_id, _send_document, chat_id, data, file_name, priority=priority)
+
+# Нажатия всех кнопок проходят через один обработчик с таблицей действий
+router = callbacks.CallbackRouter()
+
+UPLOAD_FOLDER = config.UPLOAD_FOLDER
+if not os.path.exists(UPLOAD_FOLDER):
+    os.makedirs(UPLOAD_FOLDER)
+
+SUPPORTED_FORMATS = ['.pdf', '.jpg', '.jpeg', '.png', '.txt', '.doc', '.docx', '.xls', '.xlsx']
+
+class RegistrationStates(StatesGroup):
+    name = State()
+    phone = State()
+    city = State()
+
+class RequestStates(StatesGroup):
+    amount = State()
+    comment = State()
+    file = State()
+
+class AdminStates(StatesGroup):
+    approve_comment = State()
+
+@bot.message_handler(commands=['start'])
+async def start_registration(message):
+    user_id = message.from_user.id
+    if await async_database.is_user_registered(user_id):
+        await send_main_menu(message.chat.id)
+        logging.info(f"Користувач {user_id} вже зареєстрований, надіслано головне меню")
+    else:
+        markup = types.InlineKeyboardMarkup()
+        button = types.InlineKeyboardButton('🆕 Зареєструватися', callback_data=callbacks.encode(callbacks.REGISTER))
+        markup.add(button)
+        send_message(message.chat.id, "👤 **Натисніть кнопку для реєстрації**", reply_markup=markup, parse_mode='Markdown')
+        logging.info(f"Користувач {user_id} отримав пропозицію для реєстрації")
+
+# Необязательные настройки напоминаний (могут отсутствовать в config.py)
+REMINDER_INCREMENTAL = getattr(config, 'REMINDER_INCREMENTAL', False)
+REMINDER_AGING_HOURS = getattr(config, 'REMINDER_AGING_HOURS', 24)
+
+# Напоминание об активных заявках, как в bot.py. Сообщения собираются в пуле
+# потоков: заявки читаются из базы страницами. Списка /active с кнопками в
+# асинхронном режиме нет, поэтому строка с числом заявок без кнопки.
+async def send_active_requests_reminder():
+    now = datetime.utcnow()
+    last_run = await async_database.get_bot_state('last_reminder_at')
+    texts = await async_database.run_blocking(
+        list, reports.format_active_reminder(now, last_run, REMINDER_INCREMENTAL, REMINDER_AGING_HOURS))
+    for text in texts:
+        send_message(config.ADMIN_CHAT_ID, text, parse_mode='Markdown', priority=outbox.PRIORITY_BACKGROUND)
+    active_count = await async_database.get_active_requests_count()
+    if texts or active_count:
+        send_message(config.ADMIN_CHAT_ID, f"🔔 Усього активних заявок: {active_count}", priority=outbox.PRIORITY_BACKGROUND)
+        logging.info("Надіслано нагадування про активні заявки адміністратору")
+    await async_database.set_bot_state('last_reminder_at', now.strftime('%Y-%m-%d %H:%M:%S'))
+
+async def schedule_reminders():
+    loop = asyncio.get_running_loop()
+    weekdays = ["monday", "tuesday", "wednesday", "thursday", "friday"]
+    for day in weekdays:
+        for hour in range(10, 17):
+            getattr(schedule.every(), day).at(f"{hour}:00").do(lambda: loop.create_task(send_active_requests_reminder()))
+    while True:
+        schedule.run_pending()
+        # Сон до ближайшего задания расписания вместо проверки каждую секунду
+        idle_seconds = schedule.idle_seconds()
+        await asyncio.sleep(max(idle_seconds, 0) if idle_seconds is not None else 60)
+
+@router.action(callbacks.MAKE_REQUEST)
+async def handle_make_request(call):
+    user_id = call.from_user.id
+    await bot.set_state(user_id, RequestStates.amount, call.message.chat.id)
+    send_message(call.message.chat.id, "💰 **Введіть суму вашого запиту:**", parse_mode='Markdown')
+    logging.info(f"Користувач {user_id} натиснув кнопку 'Зробити запит'")
+
+@router.action(callbacks.REGISTER)
+async def process_registration(call):
+    user_id = call.from_user.id
+    if await async_database.is_user_registered(user_id):
+        send_message(call.message.chat.id, "✅ **Ви вже авторизовані!**", parse_mode='Markdown')
+        logging.info(f"Користувач {user_id} вже авторизований")
+    else:
+        await bot.set_state(user_id, RegistrationStates.name, call.message.chat.id)
+        send_message(call.from_user.id, "✏️ **Введіть ваше ім'я та прізвище:**", parse_mode='Markdown')
+        logging.info(f"Користувач {user_id} почав реєстрацію")
+
+@bot.message_handler(state=RegistrationStates.name)
+async def get_name(message):
+    user_id = message.from_user.id
+    name = message.text
+    await bot.add_data(user_id, message.chat.id, name=name)
+    await bot.set_state(user_id, RegistrationStates.phone, message.chat.id)
+    send_message(message.chat.id, "📱 **Введіть ваш номер телефону:**", parse_mode='Markdown')
+    logging.info(f"Користувач {user_id} ввів ім'я: {name}")
+
+@bot.message_handler(state=RegistrationStates.phone)
+async def get_phone(message):
+    phone = message.text
+    await bot.add_data(message.from_user.id, message.chat.id, phone=phone)
+    await bot.set_state(message.from_user.id, RegistrationStates.city, message.chat.id)
+    send_message(message.chat.id, "🏙 **Введіть ваше місто:**", parse_mode='Markdown')
+    logging.info(f"Користувач {message.from_user.id} ввів телефон")
+
+@bot.message_handler(state=RegistrationStates.city)
+async def get_city(message):
+    city = message.text
+    user_id = message.from_user.id
+    async with bot.retrieve_data(user_id, message.chat.id) as data:
+        name, phone = data['name'], data['phone']
+    await bot.delete_state(user_id, message.chat.id)
+    await async_database.add_user(user_id, name, phone, city)
+    send_message(message.chat.id, "🎉 **Ви успішно зареєстровані!**", parse_mode='Markdown')
+    logging.info(f"Користувач {user_id} зареєстрований. Місто: {city}")
+    await send_main_menu(message.chat.id)
+
+async def send_main_menu(chat_id):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton('📝 Зробити запит', callback_data=callbacks.encode(callbacks.MAKE_REQUEST)))
+    send_message(chat_id, "🔔 **Оберіть одну з опцій:**", reply_markup=markup, parse_mode='Markdown')
+    logging.info(f"Користувачу {chat_id} надіслано головне меню")
+
+# Функция для разбора необязательного периода из аргументов команды
+def parse_period(args):
+    date_from = datetime.strptime(args[0], '%Y-%m-%d').date() if len(args) > 0 else None
+    date_to = datetime.strptime(args[1], '%Y-%m-%d').date() if len(args) > 1 else None
+    return date_from, date_to
+
+@bot.message_handler(commands=['export_requests'])
+async def export_requests_command(message):
+    user_id = message.from_user.id
+    if user_id in config.ADMIN_NAMES:
+        # Необов'язкові аргументи: /export_requests [з YYYY-MM-DD] [по YYYY-MM-DD] [статус]
+        args = message.text.split(maxsplit=3)[1:]
+        try:
+            date_from, date_to = parse_period(args[:2])
+        except ValueError:
+            send_message(message.chat.id, "❗️ Формат: /export_requests [YYYY-MM-DD] [YYYY-MM-DD] [статус]")
+            return
+        status = args[2] if len(args) > 2 else None
+        # Отдельный каталог на каждый экспорт: одновременные экспорты не
+        # пишут в один файл, файл удаляется после отправки
+        with tempfile.TemporaryDirectory(prefix='export_') as export_folder:
+            file_path = os.path.join(export_folder, f"requests_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
+            await async_database.export_requests_to_excel(file_path, date_from=date_from, date_to=date_to, status=status)
+            data = await async_database.read_file(file_path)
+        send_document(user_id, data, os.path.basename(file_path))
+        logging.info(f"Адміністратор {user_id} експортував запити в Excel")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для експорту запитів.")
+        logging.warning(f"Користувач {user_id} намагався експортувати запити без прав")
+
+@bot.message_handler(commands=['import_requests'])
+async def import_requests_command(message):
+    user_id = message.from_user.id
+    if user_id in config.ADMIN_NAMES:
+        # Импорт выполняется фоновыми задачами jobs.py, которых в асинхронном
+        # режиме нет
+        send_message(message.chat.id, "⚠️ Імпорт запитів в асинхронному режимі не підтримується. "
+                                                "Запустіть бота командою python bot.py і повторіть /import_requests.")
+        logging.warning(f"Адміністратор {user_id} намагався виконати імпорт в асинхронному режимі")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для імпорту запитів.")
+        logging.warning(f"Користувач {user_id} намагався виконати імпорт запитів без прав")
+
+@bot.message_handler(state=RequestStates.amount)
+async def process_amount(message):
+    amount = message.text
+    if not amount or not amount.isdigit():
+        send_message(message.chat.id, "❗️ **Будь ласка, введіть коректне число для суми.**", parse_mode='Markdown')
+        logging.warning(f"Користувач {message.from_user.id} ввів некоректну суму: {amount}")
+        return
+    await bot.add_data(message.from_user.id, message.chat.id, amount=amount)
+    await bot.set_state(message.from_user.id, RequestStates.comment, message.chat.id)
+    send_message(message.chat.id, "🖋 **Введіть коментар:**", parse_mode='Markdown')
+    logging.info(f"Користувач {message.from_user.id} ввів суму: {amount}")
+
+@bot.message_handler(state=RequestStates.comment)
+async def process_comment(message):
+    comment = message.text
+    # Черновик хранится в состоянии разговора под коротким ключом; кнопка несет
+    # только ключ, поэтому устаревшая кнопка от прошлого черновика не срабатывает
+    draft = secrets.randbits(48)
+    await bot.add_data(message.from_user.id, message.chat.id, comment=comment, draft=draft)
+    await bot.set_state(message.from_user.id, RequestStates.file, message.chat.id)
+    markup = types.InlineKeyboardMarkup()
+    skip_button = types.InlineKeyboardButton('⏭ Пропустити', callback_data=callbacks.encode(callbacks.SKIP_FILE, draft))
+    markup.add(skip_button)
+    send_message(message.chat.id, "📎 **Тепер можна прикріпити фото або PDF-файл. Якщо файл не потрібен, пропустіть цей крок.**", reply_markup=markup, parse_mode='Markdown')
+    logging.info(f"Користувач {message.from_user.id} додав коментар ({len(comment)} символів)")
+
+async def _get_request_draft(user_id, chat_id):
+    async with bot.retrieve_data(user_id, chat_id) as data:
+        draft = dict(data) if data else {}
+    return draft.get('amount'), draft.get('comment')
+
+async def _pop_request_draft(user_id, chat_id):
+    draft = await _get_request_draft(user_id, chat_id)
+    await bot.delete_state(user_id, chat_id)
+    return draft
+
+@router.action(callbacks.SKIP_FILE)
+async def skip_file(call, draft=None):
+    user_id = call.from_user.id
+    if await bot.get_state(user_id, call.message.chat.id) != RequestStates.file.name:
+        return
+    if draft is not None:
+        async with bot.retrieve_data(user_id, call.message.chat.id) as data:
+            if not data or data.get('draft') != draft:
+                return
+    amount, comment = await _pop_request_draft(user_id, call.message.chat.id)
+    request_id, request_number = await async_database.add_request(user_id, amount, comment, None)
+    await notify_admin_about_request(request_id, request_number, amount, comment, user_id)
+    send_message(call.message.chat.id, f"📩 **Ваш запит №{request_number}: {amount} прийнятий на розгляд.**", parse_mode='Markdown')
+    logging.info(f"Запит №{request_number} від користувача {user_id} додано без файлу")
+
+# Функция для потоковой загрузки вложения пользователя в хранилище. file_id
+# сообщения пользователя запоминается, чтобы переслать файл администратору
+# без повторной загрузки.
+async def save_upload(file_id, extension, file_name, kind):
+    file_info = await bot.get_file(file_id)
+    url = storage.telegram_file_url(bot.token, file_info.file_path, asyncio_helper.FILE_URL)
+    proxies = {'http': asyncio_helper.proxy, 'https': asyncio_helper.proxy} if asyncio_helper.proxy else None
+    return await async_database.run_blocking(storage.download, url, UPLOAD_FOLDER, extension, file_name, file_id, kind, proxies=proxies)
+
+# Функция для отправки файла: по file_id, если Telegram уже знает файл, иначе
+# загрузкой с диска с сохранением полученного file_id
+async def _send_file(chat_id, file_path, as_photo):
+    stored = await async_database.get_file(file_path)
+    if stored and stored['telegram_file_id']:
+        try:
+            if stored['telegram_kind'] == 'photo':
+                return await bot.send_photo(chat_id, stored['telegram_file_id'])
+            return await bot.send_document(chat_id, stored['telegram_file_id'])
+        except ApiTelegramException as e:
+            if e.error_code != 400:
+                raise
+            logging.warning(f"file_id файлу {file_path} недійсний, файл буде завантажено повторно: {e}")
+    data = await async_database.read_file(file_path)
+    file_name = stored['file_name'] if stored and stored['file_name'] else os.path.basename(file_path)
+    file = types.InputFile(io.BytesIO(data), file_name=file_name)
+    sent = await bot.send_photo(chat_id, file) if as_photo else await bot.send_document(chat_id, file)
+    await async_database.run_blocking(storage.remember_sent_file, file_path, sent)
+    return sent
+
+def send_file(chat_id, file_path, as_photo=False, priority=outbox.PRIORITY_USER):
+    return outgoing.submit(chat_id, _send_file, chat_id, file_path, as_photo, priority=priority)
+
+@bot.message_handler(state=RequestStates.file, content_types=['text', 'photo', 'document'])
+async def process_file(message):
+    try:
+        file_path = None
+        user_id = message.from_user.id
+        if message.content_type == 'photo':
+            file_path = await save_upload(message.photo[-1].file_id, '.jpg', None, 'photo')
+        elif message.content_type == 'document':
+            file_extension = os.path.splitext(message.document.file_name)[-1].lower()
+            if file_extension not in SUPPORTED_FORMATS:
+                # Черновик остается, пользователь может отправить другой файл
+                send_message(message.chat.id, "❗️ **Формат файла не поддерживается. Разрешенные форматы: PDF, JPG, JPEG, PNG, TXT, DOC, DOCX, XLS, XLSX.**")
+                logging.warning(f"Формат файла {file_extension} не поддерживается для пользователя {user_id}")
+                return
+            file_path = await save_upload(message.document.file_id, file_extension, message.document.file_name, 'document')
+
+        # Черновик удаляется только после создания заявки, чтобы при ошибке
+        # пользователь мог отправить файл еще раз
+        amount, comment = await _get_request_draft(user_id, message.chat.id)
+        request_id, request_number = await async_database.add_request(user_id, amount, comment, file_path)
+        await bot.delete_state(user_id, message.chat.id)
+        await notify_admin_about_request(request_id, request_number, amount, comment, user_id, file_path)
+        send_message(message.chat.id, f"📩 **Ваш запит №{request_number}: {amount} прийнятий на розгляд.**", parse_mode='Markdown')
+        logging.info(f"Запит №{request_number} від користувача {user_id} додано з файлом {file_path if file_path else 'без файлу'}")
+
+    except Exception as e:
+        error_message = f"❗️ **Произошла ошибка при обработке файла. Причина: {str(e)}.** Пожалуйста, попробуйте снова или загрузите другой файл."
+        send_message(message.chat.id, error_message)
+        logging.error(f"Ошибка при обработке файла для пользователя {message.from_user.id}: {str(e)}")
+
+async def notify_admin_about_request(request_id, request_number, amount, comment, user_id, file_path=None):
+    user_info = await async_database.get_user_profile(user_id)
+    # Текст пользователя экранируется: сообщение отправляется с разметкой Markdown
+    request_text = (f"🆕 **Запит №{request_number}** від {reports.escape_markdown(user_info['name'])}, "
+                    f"{reports.escape_markdown(user_info['city'])} (📞 Телефон: {reports.escape_markdown(user_info['phone'])}):\n"
+                    f"💰 **Сума:** {amount}\n"
+                    f"🖋 **Коментар:** {reports.escape_markdown(comment)}\n"
+                    f"📎 **Файл:** {'Прикріплено' if file_path else 'Файл не додано.'}")
+    # Кнопки отправляются вместе с текстом одним вызовом
+    markup = types.InlineKeyboardMarkup()
+    approve_button = types.InlineKeyboardButton('✅ Погодити без коментаря', callback_data=callbacks.encode(callbacks.APPROVE, request_id))
+    approve_with_comment_button = types.InlineKeyboardButton('✏️ Погодити з коментарем', callback_data=callbacks.encode(callbacks.APPROVE_WITH_COMMENT, request_id))
+    reject_button = types.InlineKeyboardButton('❌ Відхилити', callback_data=callbacks.encode(callbacks.REJECT, request_id))
+    markup.add(approve_button, approve_with_comment_button, reject_button)
+    send_message(config.ADMIN_CHAT_ID, request_text, reply_markup=markup, parse_mode='Markdown', priority=outbox.PRIORITY_ADMIN)
+
+    if file_path:
+        send_file(config.ADMIN_CHAT_ID, file_path, as_photo=not file_path.endswith(('.pdf', '.txt', '.doc', '.docx', '.xls', '.xlsx')), priority=outbox.PRIORITY_ADMIN)
+    logging.info(f"Надіслано запит №{request_number} адміністратору")
+
+# Уведомление автора заявки о решении. Пользователи из импорта не связаны
+# с чатом Telegram и уведомлений не получают.
+def notify_user(user_id, text, priority=outbox.PRIORITY_USER):
+    if not async_database.is_imported_user(user_id):
+        send_message(user_id, text, priority=priority)
+
+# Заявка могла быть уже решена массовым действием или другим администратором
+def report_already_decided(request_id, request_info, chat_id, message_id):
+    status = request_info['status'] if request_info else "не знайдено"
+    edit_message_text(f"Запит №{request_id} вже розглянуто: {status}.", chat_id, message_id)
+
+async def is_pending(call, request_info, request_id):
+    if request_info is not None and request_info['status'] == async_database.STATUS_PENDING:
+        return True
+    report_already_decided(request_id, request_info, call.message.chat.id, call.message.message_id)
+    return False
+
+# Запись решения, только если заявка еще в обработке (проверка и запись -
+# один запрос). Иначе сообщение с кнопками заменяется текущим статусом.
+async def decide(request_id, status, admin_id, chat_id, message_id, comment=None):
+    if await async_database.decide_request(request_id, status, comment, admin_id):
+        return True
+    report_already_decided(request_id, await async_database.get_cached_request(request_id), chat_id, message_id)
+    return False
+
+@router.action(callbacks.APPROVE)
+async def approve_without_comment(call, request_id):
+    admin_name = config.ADMIN_NAMES.get(call.from_user.id, "Адміністратор")
+
+    request_info = await async_database.get_cached_request(request_id)
+    if not await is_pending(call, request_info, request_id):
+        return
+    if not await decide(request_id, "Погоджено", call.from_user.id, call.message.chat.id, call.message.message_id):
+        return
+    notify_user(request_info['user_id'], f"Ваш запит №{request_info['request_number']} було погоджено адміністратором {admin_name} без коментаря.")
+    edit_message_text(f"Запит №{request_id} погоджено адміністратором {admin_name}.", config.ADMIN_CHAT_ID, call.message.message_id)
+    logging.info(f"Запит №{request_id} погоджено без коментаря")
+
+@router.action(callbacks.APPROVE_WITH_COMMENT)
+async def approve_with_comment(call, request_id):
+    if not await is_pending(call, await async_database.get_cached_request(request_id), request_id):
+        return
+    await bot.set_state(call.from_user.id, AdminStates.approve_comment, call.message.chat.id)
+    await bot.add_data(call.from_user.id, call.message.chat.id, request_id=request_id, admin_message_id=call.message.message_id)
+    send_message(call.message.chat.id, "✏️ Введіть ваш коментар до погодження:", parse_mode='Markdown')
+    logging.info(f"Адміністратор обрав погодження з коментарем для запиту №{request_id}")
+
+@bot.message_handler(state=AdminStates.approve_comment)
+async def process_approve_comment(message):
+    admin_comment = message.text
+    async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+        request_id, admin_message_id = data['request_id'], data['admin_message_id']
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    # Комментарий вводится после нажатия кнопки: за это время заявку мог
+    # решить другой администратор
+    if not await decide(request_id, "Погоджено", message.from_user.id, config.ADMIN_CHAT_ID, admin_message_id, admin_comment):
+        send_message(message.chat.id, "❗️ Коментар не збережено: запит уже розглянуто.")
+        return
+    request_info = await async_database.get_cached_request(request_id)
+
+    edit_message_text(
+        f"Запит №{request_info['request_number']} погоджено з коментарем адміністратора: {reports.escape_markdown(admin_comment)}",
+        config.ADMIN_CHAT_ID,
+        admin_message_id,
+        parse_mode='Markdown'
+    )
+
+    notify_user(
+        request_info['user_id'],
+        f"Ваш запит №{request_info['request_number']} погоджено з коментарем адміністратора: {admin_comment}"
+    )
+    logging.info(f"Запит №{request_id} погоджено адміністратором з коментарем")
+
+@router.action(callbacks.REJECT)
+async def reject_request(call, request_id):
+    admin_name = config.ADMIN_NAMES.get(call.from_user.id, "Адміністратор")
+
+    request_info = await async_database.get_cached_request(request_id)
+    if not await is_pending(call, request_info, request_id):
+        return
+    if not await decide(request_id, "Відхилено", call.from_user.id, call.message.chat.id, call.message.message_id):
+        return
+    notify_user(request_info['user_id'], f"Ваш запит №{request_info['request_number']} було відхилено адміністратором {admin_name}.")
+    edit_message_text(f"Запит №{request_id} відхилено адміністратором {admin_name}.", config.ADMIN_CHAT_ID, call.message.message_id)
+    logging.info(f"Запит №{request_id} відхилено адміністратором {admin_name}")
+
+@bot.message_handler(commands=['storage_gc'])
+async def storage_gc_command(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        removed, freed = await async_database.run_blocking(storage.collect_garbage, UPLOAD_FOLDER)
+        send_message(message.chat.id, f"🧹 Видалено файлів: {removed}, звільнено {freed / 1024 / 1024:.1f} МБ.")
+        logging.info(f"Адміністратор {message.from_user.id} запустив очищення сховища")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для очищення сховища.")
+        logging.warning(f"Користувач {message.from_user.id} намагався очистити сховище без прав")
+
+@bot.message_handler(commands=['stats'])
+async def send_stats(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        # /stats - за весь час, /stats YYYY-MM-DD [YYYY-MM-DD] - за період,
+        # /stats cities [YYYY-MM-DD] [YYYY-MM-DD] - за містами
+        args = message.text.split()[1:]
+        by_city = bool(args) and args[0] == 'cities'
+        if by_city:
+            args = args[1:]
+        try:
+            date_from, date_to = parse_period(args)
+        except ValueError:
+            send_message(message.chat.id, "❗️ Формат: /stats [cities] [YYYY-MM-DD] [YYYY-MM-DD]")
+            return
+        period = f" з {date_from or '...'} по {date_to or '...'}" if args else ''
+
+        if by_city:
+            text = reports.format_city_stats(await async_database.get_stats_by_city(date_from, date_to), f"🏙 Статистика за містами{period}:")
+        elif args:
+            text = reports.format_stats(await async_database.get_stats_by_period(date_from, date_to), f"📊 Статистика запитів{period}:")
+        else:
+            text = reports.format_stats(await async_database.get_stats_summary())
+        send_message(message.chat.id, text)
+        logging.info(f"Адміністратор {message.from_user.id} запросив статистику")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для перегляду статистики.")
+        logging.warning(f"Користувач {message.from_user.id} намагався отримати доступ до статистики без прав")
+
+@bot.message_handler(commands=['stats_verify'])
+async def verify_stats_command(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        # /stats_verify fix - перерахувати зведену статистику при розбіжностях
+        fix = message.text.split()[1:2] == ['fix']
+        mismatches = await async_database.verify_stats(fix=fix)
+        send_message(message.chat.id, reports.format_stats_verification(mismatches, fixed=fix))
+        if mismatches:
+            logging.warning(f"Зведена статистика має {len(mismatches)} розбіжностей з перерахунком")
+        logging.info(f"Адміністратор {message.from_user.id} перевірив статистику")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для перевірки статистики.")
+        logging.warning(f"Користувач {message.from_user.id} намагався перевірити статистику без прав")
+
+# Текущее состояние очереди отправки и кеша для /metrics
+def collect_metrics():
+    values = []
+    for name, value in outgoing.metrics().items():
+        if isinstance(value, dict):
+            values.extend((f'outbox_{name}', 'gauge', {'priority': priority}, count) for priority, count in value.items())
+        else:
+            values.append((f'outbox_{name}', 'gauge', {}, value))
+    for name, cache_stats in cache.stats().items():
+        values.extend((f'cache_{key}', 'gauge', {'cache': name}, value) for key, value in cache_stats.items())
+    return values
+
+metrics.add_collector(collect_metrics)
+
+@bot.message_handler(commands=['metrics'])
+async def send_metrics(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        # Ограничение Telegram на длину одного сообщения
+        send_message(message.chat.id, metrics.format_summary()[:4096])
+        logging.info(f"Адміністратор {message.from_user.id} переглянув метрики")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для перегляду метрик.")
+        logging.warning(f"Користувач {message.from_user.id} намагався переглянути метрики без прав")
+
+@bot.callback_query_handler(func=lambda call: True)
+async def handle_callback(call):
+    handler = router.dispatch(call)
+    if handler is not None:
+        await handler
+
+# Замер времени всех обработчиков; вызывается после регистрации обработчиков
+metrics.instrument_bot(bot)
+
+async def main():
+    reminders = asyncio.create_task(schedule_reminders())
+    if getattr(config, 'METRICS_PORT', None):
+        metrics.start_http_server(config.METRICS_PORT, getattr(config, 'METRICS_HOST', '127.0.0.1'))
+    try:
+        await bot.polling(non_stop=True)
+    finally:
+        reminders.cancel()
+
+if __name__ == "__main__":
+    asyncio.run(main())
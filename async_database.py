@@ -0,0 +1,65 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import database
+
+# Количество потоков для обращений к базе данных и диску из asyncio-режима.
+# Каждый поток получает собственное соединение (database.get_connection),
+# а записи все равно проходят через общий поток записи database.py.
+EXECUTOR_WORKERS = 8
+
+_executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix='database-async')
+
+# Функция для выполнения блокирующего вызова в пуле потоков без блокировки цикла событий
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def _wrap(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(func, *args, **kwargs)
+    return wrapper
+
+# Асинхронные версии функций database.py
+add_request = _wrap(database.add_request)
+get_request_info = _wrap(database.get_request_info)
+get_active_requests = _wrap(database.get_active_requests)
+get_user_info = _wrap(database.get_user_info)
+get_next_request_number = _wrap(database.get_next_request_number)
+get_all_active_requests = _wrap(database.get_all_active_requests)
+get_active_requests_count = _wrap(database.get_active_requests_count)
+get_bot_state = _wrap(database.get_bot_state)
+set_bot_state = _wrap(database.set_bot_state)
+get_total_requests = _wrap(database.get_total_requests)
+get_approved_requests = _wrap(database.get_approved_requests)
+get_rejected_requests = _wrap(database.get_rejected_requests)
+get_total_amount = _wrap(database.get_total_amount)
+get_stats_summary = _wrap(database.get_stats_summary)
+get_stats_by_period = _wrap(database.get_stats_by_period)
+get_stats_by_city = _wrap(database.get_stats_by_city)
+get_average_decision_time = _wrap(database.get_average_decision_time)
+verify_stats = _wrap(database.verify_stats)
+export_requests_to_excel = _wrap(database.export_requests_to_excel)
+get_file = _wrap(database.get_file)
+# Без обращения к базе: проверка самого id
+is_imported_user = database.is_imported_user
+STATUS_PENDING = database.STATUS_PENDING
+
+# Чтение через кеш профилей и заявок, запись со сбросом кеша
+get_user_profile = _wrap(cache.get_user_profile)
+get_cached_request = _wrap(cache.get_request)
+is_user_registered = _wrap(cache.is_user_registered)
+add_user = _wrap(cache.add_user)
+update_request_status = _wrap(cache.update_request_status)
+decide_request = _wrap(cache.decide_request)
+
+def _read_file(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read()
+
+# Функции для работы с файлами без блокировки цикла событий
+async def read_file(file_path):
+    return await run_blocking(_read_file, file_path)
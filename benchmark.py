@@ -0,0 +1,502 @@
+"""Бенчмарки бота.
+
+Запуск:
+    python benchmark.py export --rows 100000
+    python benchmark.py export --rows 1000 10000 100000 --variants streaming --repeats 5
+    python benchmark.py stress --threads 16 --operations 200
+    python benchmark.py submit --history 0 1000 10000 100000
+    python benchmark.py stats --rows 100000
+    python benchmark.py archive --rows 100000
+    python benchmark.py import --rows 100000 --formats xlsx csv
+
+Каждый вариант выполняется в отдельном процессе, чтобы пиковое потребление
+памяти (RSS) одного варианта не влияло на замер другого.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+STATUSES = ['В обробці', 'Погоджено', 'Відхилено']
+# Доля статусов в синтетических данных: активных заявок обычно немного
+STATUS_WEIGHTS = [5, 70, 25]
+CITIES = ['Київ', 'Львів', 'Одеса', 'Харків', 'Дніпро']
+
+
+# Функция для заполнения базы синтетическими данными
+def generate_synthetic_db(db_path, rows, users=1000, seed=42):
+    os.environ['FINANCE_BOT_DB'] = db_path
+    import database
+
+    rnd = random.Random(seed)
+    with database.transaction() as connection:
+        connection.executemany(
+            "INSERT INTO users (user_id, name, phone, city) VALUES (?, ?, ?, ?)",
+            ((100000 + i, f"Користувач {i}", f"+380{rnd.randint(100000000, 999999999)}", rnd.choice(CITIES)) for i in range(users))
+        )
+    counters = {}
+
+    def request_rows():
+        for _ in range(rows):
+            user_id = 100000 + rnd.randrange(users)
+            counters[user_id] = counters.get(user_id, 0) + 1
+            created = datetime(2024, rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59))
+            comment = "Коментар " * rnd.randint(1, 8)
+            status = rnd.choices(STATUSES, STATUS_WEIGHTS)[0]
+            decided_at = None
+            if status in database.DECIDED_STATUSES:
+                decided_at = (created + timedelta(minutes=rnd.randint(5, 72 * 60))).strftime('%Y-%m-%d %H:%M:%S')
+            yield (user_id, rnd.randint(100, 100000), comment, None, status, counters[user_id],
+                   created.strftime('%Y-%m-%d %H:%M:%S'), decided_at)
+
+    with database.transaction() as connection:
+        connection.executemany(
+            "INSERT INTO requests (user_id, amount, comment, file_path, status, request_number, created_at, decided_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            request_rows()
+        )
+        database.rebuild_request_counters(connection)
+
+
+# Исходная реализация экспорта (pandas + повторный проход openpyxl) для сравнения
+def legacy_export_requests_to_excel(conn, file_path):
+    import pandas as pd
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+    from openpyxl.utils.dataframe import dataframe_to_rows
+
+    cursor = conn.cursor()
+    cursor.execute('''SELECT requests.id, users.name, users.phone, requests.amount, requests.comment,
+                             requests.file_path, requests.status, requests.request_number, requests.created_at
+                      FROM requests JOIN users ON requests.user_id = users.user_id''')
+    rows = cursor.fetchall()
+    columns = ['id', 'Имя', 'Телефон', 'Сумма', 'Комментарий', 'Файл', 'Статус', 'Номер запроса', 'Дата создания']
+    df = pd.DataFrame(rows, columns=columns)
+    df.to_excel(file_path, index=False)
+
+    workbook = Workbook()
+    worksheet = workbook.active
+    for r in dataframe_to_rows(df, index=False, header=True):
+        worksheet.append(r)
+    for column in worksheet.columns:
+        max_length = 0
+        column_letter = get_column_letter(column[0].column)
+        for cell in column:
+            if len(str(cell.value)) > max_length:
+                max_length = len(str(cell.value))
+        worksheet.column_dimensions[column_letter].width = max_length + 2
+    workbook.save(file_path)
+    return file_path
+
+
+# Пиковое потребление памяти текущим процессом в мегабайтах
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В macOS ru_maxrss в байтах, в Linux - в килобайтах
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+
+# Выполнение одного варианта экспорта в текущем процессе
+def run_export_variant(variant, db_path, output_path):
+    os.environ['FINANCE_BOT_DB'] = db_path
+    import database
+
+    baseline_rss = peak_rss_mb()
+    started = time.perf_counter()
+    if variant == 'legacy':
+        legacy_export_requests_to_excel(database.get_connection(), output_path)
+    else:
+        database.export_requests_to_excel(output_path)
+    elapsed = time.perf_counter() - started
+    return {
+        'variant': variant,
+        'seconds': round(elapsed, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'baseline_rss_mb': round(baseline_rss, 1),
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# Экспорт для каждого размера базы и варианта; каждый повтор - отдельный
+# процесс. Время - перцентили по повторам, память - максимум.
+def run_export_sizes(sizes, variants, repeats=1):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            db_path = os.path.join(tmp, f'bench_{rows}.db')
+            subprocess.run([sys.executable, __file__, '_generate', db_path, str(rows)], check=True)
+            for variant in variants:
+                output_path = os.path.join(tmp, f'{variant}_{rows}.xlsx')
+                runs = []
+                for _ in range(repeats):
+                    completed = subprocess.run(
+                        [sys.executable, __file__, '_export', variant, db_path, output_path],
+                        check=True, capture_output=True, text=True
+                    )
+                    runs.append(json.loads(completed.stdout))
+                seconds = [run['seconds'] for run in runs]
+                p50 = percentile(seconds, 0.5)
+                results.append({
+                    'variant': variant,
+                    'rows': rows,
+                    'repeats': repeats,
+                    'seconds': p50,
+                    'p50_s': p50,
+                    'p95_s': percentile(seconds, 0.95),
+                    'p99_s': percentile(seconds, 0.99),
+                    'rows_per_second': round(rows / p50) if p50 else None,
+                    'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+                    'baseline_rss_mb': runs[0]['baseline_rss_mb'],
+                    'file_size_kb': round(os.path.getsize(output_path) / 1024, 1),
+                })
+    return results
+
+
+def bench_export(args):
+    print(json.dumps(run_export_sizes(args.rows, args.variants, args.repeats), ensure_ascii=False, indent=2))
+
+
+# Нагрузочная проверка пула соединений: потоки одновременно создают и читают
+# заявки, после чего проверяется целостность нумерации и данных
+def run_stress(db_path, threads, operations, batch_size):
+    os.environ['FINANCE_BOT_DB'] = db_path
+    import database
+
+    database.WRITE_BATCH_SIZE = batch_size
+    users = 50
+    for i in range(users):
+        database.add_user(200000 + i, f"Користувач {i}", "+380000000000", "Київ")
+
+    errors = []
+    created = []
+    created_lock = threading.Lock()
+
+    def worker(index):
+        rnd = random.Random(index)
+        for _ in range(operations):
+            user_id = 200000 + rnd.randrange(users)
+            amount = rnd.randint(1, 10000)
+            request_id, request_number = database.add_request(user_id, amount, "Навантаження")
+            info = database.get_request_info(request_id)
+            if info is None or info['user_id'] != user_id or info['amount'] != amount or info['request_number'] != request_number:
+                errors.append(f"заявка {request_id}: очікувалось {(user_id, amount, request_number)}, отримано {info}")
+            with created_lock:
+                created.append((user_id, request_number))
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    # Номера заявок каждого пользователя должны быть уникальны и идти подряд
+    numbers = {}
+    for user_id, request_number in created:
+        numbers.setdefault(user_id, []).append(request_number)
+    for user_id, user_numbers in numbers.items():
+        if sorted(user_numbers) != list(range(1, len(user_numbers) + 1)):
+            errors.append(f"користувач {user_id}: номери заявок не послідовні")
+    if database.get_total_requests() != threads * operations:
+        errors.append(f"очікувалось {threads * operations} заявок, у базі {database.get_total_requests()}")
+    database.close_connections()
+
+    return {
+        'batch_size': batch_size,
+        'threads': threads,
+        'writes': threads * operations,
+        'seconds': round(elapsed, 3),
+        'writes_per_second': round(threads * operations / elapsed, 1),
+        'errors': errors[:10],
+    }
+
+
+def bench_stress(args):
+    results = []
+    for batch_size in args.batch_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'stress.db')
+            completed = subprocess.run(
+                [sys.executable, __file__, '_stress', db_path, str(args.threads), str(args.operations), str(batch_size)],
+                check=True, capture_output=True, text=True
+            )
+            results.append(json.loads(completed.stdout))
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if any(result['errors'] for result in results):
+        sys.exit(1)
+
+
+# Задержка отправки заявки в зависимости от числа заявок пользователя.
+# Для сравнения замеряется и прежний способ нумерации через COUNT(*).
+def run_submit(db_path, history_sizes, submissions):
+    os.environ['FINANCE_BOT_DB'] = db_path
+    import database
+
+    results = []
+    for index, history in enumerate(history_sizes):
+        user_id = 300000 + index
+        database.add_user(user_id, f"Користувач {index}", "+380000000000", "Київ")
+        with database.transaction() as connection:
+            connection.executemany(
+                "INSERT INTO requests (user_id, amount, request_number, status) VALUES (?, ?, ?, 'Погоджено')",
+                ((user_id, 100, number) for number in range(1, history + 1))
+            )
+            database.rebuild_request_counters(connection)
+
+        latencies = []
+        legacy_latencies = []
+        connection = database.get_connection()
+        for _ in range(submissions):
+            started = time.perf_counter()
+            connection.execute("SELECT COUNT(*) FROM requests WHERE user_id = ?", (user_id,)).fetchone()
+            legacy_latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            database.add_request(user_id, 100, "Перевірка")
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        legacy_latencies.sort()
+        results.append({
+            'history': history,
+            'add_request_p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+            'legacy_count_p50_ms': round(legacy_latencies[len(legacy_latencies) // 2] * 1000, 3),
+        })
+    database.close_connections()
+    return results
+
+
+def bench_submit(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        print(json.dumps(run_submit(os.path.join(tmp, 'submit.db'), args.history, args.submissions), ensure_ascii=False, indent=2))
+
+
+# Сравнение статистики из четырех полных проходов по requests со сводной таблицей
+def run_stats(db_path, rows, repeats):
+    generate_synthetic_db(db_path, rows)
+    import database
+
+    connection = database.get_connection()
+    legacy_queries = [
+        "SELECT COUNT(*) FROM requests",
+        "SELECT COUNT(*) FROM requests WHERE status = 'Погоджено'",
+        "SELECT COUNT(*) FROM requests WHERE status = 'Відхилено'",
+        "SELECT SUM(amount) FROM requests",
+    ]
+    legacy_latencies = []
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        legacy = [connection.execute(query).fetchone()[0] for query in legacy_queries]
+        legacy_latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        current = [database.get_total_requests(), database.get_approved_requests(),
+                   database.get_rejected_requests(), database.get_total_amount()]
+        latencies.append(time.perf_counter() - started)
+    legacy_latencies.sort()
+    latencies.sort()
+
+    started = time.perf_counter()
+    mismatches = database.verify_stats()
+    verify_seconds = time.perf_counter() - started
+    database.close_connections()
+    return {
+        'rows': rows,
+        'legacy_p50_ms': round(legacy_latencies[len(legacy_latencies) // 2] * 1000, 3),
+        'rollup_p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+        'results_equal': legacy == current,
+        'verify_seconds': round(verify_seconds, 3),
+        'verify_mismatches': len(mismatches),
+    }
+
+
+def bench_stats(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        print(json.dumps(run_stats(os.path.join(tmp, 'stats.db'), args.rows, args.repeats), ensure_ascii=False, indent=2))
+
+
+# Перенос решенных заявок до середины 2024 года в архив. Часть решенных
+# заявок - без decided_at (решены до миграции 5 или импортированы): они тоже
+# должны попасть в архив. Итоги сводной статистики и число заявок в
+# представлении ALL_REQUESTS_VIEW после переноса не меняются.
+def run_archive(db_path, rows, legacy_share):
+    generate_synthetic_db(db_path, rows)
+    import database
+
+    connection = database.get_connection()
+    cutoff = datetime(2024, 7, 1)
+    with database.transaction() as write_connection:
+        write_connection.execute("UPDATE requests SET decided_at = NULL WHERE status IN (?, ?) AND id % ? = 0",
+                                 (*database.DECIDED_STATUSES, max(1, round(1 / legacy_share))))
+    legacy_ids = [row[0] for row in connection.execute(
+        "SELECT id FROM requests WHERE decided_at IS NULL AND status IN (?, ?) AND created_at < ?",
+        (*database.DECIDED_STATUSES, cutoff.strftime('%Y-%m-%d %H:%M:%S')))]
+    count_query = f"SELECT COUNT(*) FROM {database.ALL_REQUESTS_VIEW}"
+    before = [connection.execute(count_query).fetchone()[0], database.get_total_requests(), database.get_total_amount()]
+
+    started = time.perf_counter()
+    archived = database.archive_requests((datetime.utcnow() - cutoff).days)
+    archive_seconds = time.perf_counter() - started
+
+    after = [connection.execute(count_query).fetchone()[0], database.get_total_requests(), database.get_total_amount()]
+    legacy_left = 0
+    for start in range(0, len(legacy_ids), 500):
+        chunk = legacy_ids[start:start + 500]
+        legacy_left += connection.execute(f"SELECT COUNT(*) FROM requests WHERE id IN ({', '.join('?' * len(chunk))})",
+                                          chunk).fetchone()[0]
+    summary = database.get_archive_summary()
+    database.close_connections()
+    return {
+        'rows': rows,
+        'archived': archived,
+        'archive_seconds': round(archive_seconds, 3),
+        'archive_tables': len(summary) - 1,
+        'legacy_requests': len(legacy_ids),
+        'legacy_left': legacy_left,
+        'results_equal': before == after,
+    }
+
+
+def bench_archive(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        result = run_archive(os.path.join(tmp, 'archive.db'), args.rows, args.legacy_share)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['legacy_left'] or not result['results_equal']:
+        print("Помилка: рішені заявки без decided_at не перенесено в архів або підсумки змінилися", file=sys.stderr)
+        sys.exit(1)
+
+
+# Импорт файла экспорта в новую пустую базу в текущем процессе
+def run_import_variant(db_path, input_path, batch_size):
+    os.environ['FINANCE_BOT_DB'] = db_path
+    import database
+    import importer
+
+    started = time.perf_counter()
+    state = database.start_import(os.path.basename(input_path), os.path.basename(input_path))
+    result = importer.run_import({'import_id': state['id'], 'path': input_path}, batch_size)
+    elapsed = time.perf_counter() - started
+    return {
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(result['rows_done'] / elapsed),
+        'rows_imported': result['rows_imported'],
+        'rows_skipped': result['rows_skipped'],
+        'users_created': result['users_created'],
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'verify_mismatches': len(database.verify_stats()),
+    }
+
+
+# Пересохранение файла экспорта в csv с теми же столбцами
+def _export_to_csv(xlsx_path, csv_path):
+    import csv
+    import importer
+
+    with open(csv_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        for row in importer.read_rows(xlsx_path):
+            writer.writerow(['' if value is None else value for value in row])
+
+
+def bench_import(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, 'source.db')
+        subprocess.run([sys.executable, __file__, '_generate', source_path, str(args.rows)], check=True)
+        xlsx_path = os.path.join(tmp, 'requests.xlsx')
+        subprocess.run([sys.executable, __file__, '_export', 'streaming', source_path, xlsx_path],
+                       check=True, capture_output=True)
+        if 'csv' in args.formats:
+            _export_to_csv(xlsx_path, os.path.join(tmp, 'requests.csv'))
+        results = []
+        for file_format in args.formats:
+            input_path = os.path.join(tmp, f'requests.{file_format}')
+            completed = subprocess.run(
+                [sys.executable, __file__, '_import', os.path.join(tmp, f'import_{file_format}.db'), input_path,
+                 str(args.batch_size)],
+                check=True, capture_output=True, text=True
+            )
+            result = {'format': file_format, 'rows': args.rows, 'batch_size': args.batch_size}
+            result.update(json.loads(completed.stdout))
+            results.append(result)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки FinanceRequestBot")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help="Порівняння експорту в Excel")
+    export_parser.add_argument('--rows', type=int, nargs='+', default=[100000])
+    export_parser.add_argument('--variants', nargs='+', default=['legacy', 'streaming'], choices=['legacy', 'streaming'])
+    export_parser.add_argument('--repeats', type=int, default=1)
+    export_parser.set_defaults(func=bench_export)
+
+    stress_parser = subparsers.add_parser('stress', help="Паралельний запис і читання заявок")
+    stress_parser.add_argument('--threads', type=int, default=16)
+    stress_parser.add_argument('--operations', type=int, default=200)
+    stress_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 64])
+    stress_parser.set_defaults(func=bench_stress)
+
+    submit_parser = subparsers.add_parser('submit', help="Затримка add_request залежно від історії користувача")
+    submit_parser.add_argument('--history', type=int, nargs='+', default=[0, 1000, 10000, 100000])
+    submit_parser.add_argument('--submissions', type=int, default=200)
+    submit_parser.set_defaults(func=bench_submit)
+
+    stats_parser = subparsers.add_parser('stats', help="Статистика зі зведеної таблиці проти повного перерахунку")
+    stats_parser.add_argument('--rows', type=int, default=100000)
+    stats_parser.add_argument('--repeats', type=int, default=50)
+    stats_parser.set_defaults(func=bench_stats)
+
+    archive_parser = subparsers.add_parser('archive', help="Перенесення рішених заявок в архів, зокрема без decided_at")
+    archive_parser.add_argument('--rows', type=int, default=100000)
+    archive_parser.add_argument('--legacy-share', type=float, default=0.1)
+    archive_parser.set_defaults(func=bench_archive)
+
+    import_parser = subparsers.add_parser('import', help="Швидкість імпорту заявок з xlsx і csv")
+    import_parser.add_argument('--rows', type=int, default=100000)
+    import_parser.add_argument('--formats', nargs='+', default=['xlsx', 'csv'], choices=['xlsx', 'csv'])
+    import_parser.add_argument('--batch-size', type=int, default=1000)
+    import_parser.set_defaults(func=bench_import)
+
+    # Внутренние команды для запуска вариантов в отдельном процессе
+    generate_parser = subparsers.add_parser('_generate')
+    generate_parser.add_argument('db_path')
+    generate_parser.add_argument('rows', type=int)
+    generate_parser.set_defaults(func=lambda a: generate_synthetic_db(a.db_path, a.rows))
+
+    run_parser = subparsers.add_parser('_export')
+    run_parser.add_argument('variant')
+    run_parser.add_argument('db_path')
+    run_parser.add_argument('output_path')
+    run_parser.set_defaults(func=lambda a: print(json.dumps(run_export_variant(a.variant, a.db_path, a.output_path))))
+
+    stress_run_parser = subparsers.add_parser('_stress')
+    stress_run_parser.add_argument('db_path')
+    stress_run_parser.add_argument('threads', type=int)
+    stress_run_parser.add_argument('operations', type=int)
+    stress_run_parser.add_argument('batch_size', type=int)
+    stress_run_parser.set_defaults(func=lambda a: print(json.dumps(run_stress(a.db_path, a.threads, a.operations, a.batch_size), ensure_ascii=False)))
+
+    import_run_parser = subparsers.add_parser('_import')
+    import_run_parser.add_argument('db_path')
+    import_run_parser.add_argument('input_path')
+    import_run_parser.add_argument('batch_size', type=int)
+    import_run_parser.set_defaults(func=lambda a: print(json.dumps(run_import_variant(a.db_path, a.input_path, a.batch_size))))
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,289 +1,861 @@
 import telebot
-from telebot import types
+from telebot import apihelper, types
+import cache
+import callbacks
 import config
+import conversations
 import database
+import importer
+import jobs
+import logs
+import metrics
+import outbox
+import reports
+import webhook
 import os
+import json
 import logging
-from cachetools import TTLCache
+import secrets
+import calendar
 from threading import Thread
 import schedule
+import storage
 import time
+from datetime import datetime
 
-logging.basicConfig(filename="bot.log", 
-                    level=logging.INFO, 
-                    format="%(asctime)s - %(levelname)s - %(message)s", 
-                    encoding='utf-8')
+# Запись журнала выполняется отдельным потоком, номера телефонов маскируются
+logs.setup_logging("bot.log", structured=getattr(config, 'LOG_JSON', False),
+                   asynchronous=getattr(config, 'LOG_ASYNC', True))
+metrics.SLOW_QUERY_SECONDS = getattr(config, 'SLOW_QUERY_MS', 100) / 1000
 
 bot = telebot.TeleBot(config.TOKEN)
 database.create_tables()
 
+# Все исходящие вызовы Telegram API проходят через общую очередь с лимитами
+outgoing = outbox.Outbox()
+
+def send_message(chat_id, text, priority=outbox.PRIORITY_USER, **kwargs):
+    return outgoing.submit(chat_id, bot.send_message, chat_id, text, priority=priority, **kwargs)
+
+def edit_message_text(text, chat_id, message_id, priority=outbox.PRIORITY_ADMIN, **kwargs):
+    return outgoing.submit(chat_id, bot.edit_message_text, text, chat_id, message_id, priority=priority, **kwargs)
+
+def _send_file(chat_id, file_path, as_photo):
+    # Файл, уже известный Telegram, отправляется по file_id без повторной загрузки
+    stored = database.get_file(file_path)
+    if stored and stored['telegram_file_id']:
+        try:
+            if stored['telegram_kind'] == 'photo':
+                return bot.send_photo(chat_id, stored['telegram_file_id'])
+            return bot.send_document(chat_id, stored['telegram_file_id'])
+        except apihelper.ApiTelegramException as e:
+            if e.error_code != 400:
+                raise
+            logging.warning(f"file_id файлу {file_path} недійсний, файл буде завантажено повторно: {e}")
+    with open(file_path, 'rb') as file:
+        if as_photo:
+            sent = bot.send_photo(chat_id, file)
+        else:
+            file_name = stored['file_name'] if stored and stored['file_name'] else os.path.basename(file_path)
+            sent = bot.send_document(chat_id, types.InputFile(file, file_name=file_name))
+    storage.remember_sent_file(file_path, sent)
+    return sent
+
+def send_file(chat_id, file_path, as_photo=False, priority=outbox.PRIORITY_USER):
+    return outgoing.submit(chat_id, _send_file, chat_id, file_path, as_photo, priority=priority)
+
+# Уведомление автора заявки о решении. Пользователи из импорта не связаны
+# с чатом Telegram и уведомлений не получают.
+def notify_user(user_id, text, priority=outbox.PRIORITY_USER):
+    if not database.is_imported_user(user_id):
+        send_message(user_id, text, priority=priority)
+
 UPLOAD_FOLDER = config.UPLOAD_FOLDER
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
-user_cache = TTLCache(maxsize=1000, ttl=600)
+# Шаги регистрации и создания заявки хранятся в базе, поэтому после перезапуска
+# бота пользователь продолжает с того же шага
+CONVERSATION_TTL_HOURS = getattr(config, 'CONVERSATION_TTL_HOURS', 24)
+dialogs = conversations.Conversations(ttl=CONVERSATION_TTL_HOURS * 60 * 60)
+
+# Нажатия всех кнопок проходят через один обработчик с таблицей действий
+router = callbacks.CallbackRouter()
+
+# Экспорт и загрузка вложений выполняются в фоновых задачах, чтобы не
+# задерживать обработку сообщений других пользователей
+JOB_RETENTION_DAYS = 7
+
+# Решенные заявки старше этого числа дней переносятся в архив (0 - не переносить)
+ARCHIVE_AFTER_DAYS = getattr(config, 'ARCHIVE_AFTER_DAYS', 365)
+job_queue = jobs.JobQueue(workers=getattr(config, 'JOB_WORKERS', jobs.JOB_WORKERS),
+                          processes=getattr(config, 'JOB_PROCESSES', jobs.JOB_PROCESSES))
 
 @bot.message_handler(commands=['start'])
 def start_registration(message):
     user_id = message.from_user.id
-    if user_id in user_cache or database.is_user_registered(user_id):
-        user_cache[user_id] = True  
+    if cache.is_user_registered(user_id):
         send_main_menu(message.chat.id)
         logging.info(f"Користувач {user_id} вже зареєстрований, надіслано головне меню")
     else:
         markup = types.InlineKeyboardMarkup()
-        button = types.InlineKeyboardButton('🆕 Зареєструватися', callback_data='register')
+        button = types.InlineKeyboardButton('🆕 Зареєструватися', callback_data=callbacks.encode(callbacks.REGISTER))
         markup.add(button)
-        bot.send_message(message.chat.id, "👤 **Натисніть кнопку для реєстрації**", reply_markup=markup, parse_mode='Markdown')
+        send_message(message.chat.id, "👤 **Натисніть кнопку для реєстрації**", reply_markup=markup, parse_mode='Markdown')
         logging.info(f"Користувач {user_id} отримав пропозицію для реєстрації")
 
+ACTIVE_PAGE_SIZE = 10
+
+# Необязательные настройки напоминаний (могут отсутствовать в config.py)
+REMINDER_INCREMENTAL = getattr(config, 'REMINDER_INCREMENTAL', False)
+REMINDER_AGING_HOURS = getattr(config, 'REMINDER_AGING_HOURS', 24)
+
+# Напоминание об активных заявках (reports.format_active_reminder); в
+# инкрементальном режиме полный список доступен кнопками /active.
+# Строка с числом активных заявок отправляется всегда, пока они есть, даже
+# если новых и просроченных нет.
 def send_active_requests_reminder():
-    active_requests = database.get_all_active_requests()
-    if active_requests:
-        messages = [
-            f"📌 **Запит №{req['request_number']}**\n"
-            f"👤 **Користувач:** {req['name']} (Телефон: {req['phone']})\n"
-            f"💰 **Сума:** {req['amount']}\n"
-            f"🖋 **Коментар:** {req['comment']}\n"
-            f"📎 **Файл:** {'Прикріплено' if req['file_path'] else 'Файл не додано.'}\n"
-            f"📅 **Статус:** {req['status']}"
-            for req in active_requests
-        ]
-        bot.send_message(config.ADMIN_CHAT_ID, "🔔 **Нагадування про активні заявки**:\n\n" + "\n\n".join(messages), parse_mode='Markdown')
+    now = datetime.utcnow()
+    now_text = now.strftime('%Y-%m-%d %H:%M:%S')
+    last_run = database.get_bot_state('last_reminder_at')
+    sent = 0
+    for text in reports.format_active_reminder(now, last_run, REMINDER_INCREMENTAL, REMINDER_AGING_HOURS):
+        send_message(config.ADMIN_CHAT_ID, text, parse_mode='Markdown', priority=outbox.PRIORITY_BACKGROUND)
+        sent += 1
+
+    active_count = database.get_active_requests_count()
+    if sent or active_count:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton('📋 Усі активні заявки', callback_data=callbacks.encode(callbacks.ACTIVE_PAGE)))
+        send_message(config.ADMIN_CHAT_ID, f"🔔 Усього активних заявок: {active_count}",
+                     reply_markup=markup, priority=outbox.PRIORITY_BACKGROUND)
         logging.info("Надіслано нагадування про активні заявки адміністратору")
+    database.set_bot_state('last_reminder_at', now_text)
+
+# Ключ страницы (created_at, id) в аргументах кнопки и обратно: время
+# передается числом секунд, чтобы уложиться в ограничение callback_data
+def page_key_args(after):
+    if after is None:
+        return ()
+    return calendar.timegm(datetime.strptime(after[0], '%Y-%m-%d %H:%M:%S').timetuple()), after[1]
+
+def page_key_from_args(created_at=None, request_id=None):
+    if request_id is None:
+        return None
+    return datetime.utcfromtimestamp(created_at).strftime('%Y-%m-%d %H:%M:%S'), request_id
+
+# Страница списка активных заявок с кнопками навигации. after - ключ
+# (created_at, id) последней заявки предыдущей страницы. selected - id
+# отмеченных заявок в режиме массового решения (None - обычный список).
+def build_active_page(after=None, selected=None):
+    page = database.get_active_requests_page(after, ACTIVE_PAGE_SIZE + 1)
+    has_next = len(page) > ACTIVE_PAGE_SIZE
+    page = page[:ACTIVE_PAGE_SIZE]
+    if not page:
+        return "✅ Активних заявок немає.", None
+    text = next(reports.split_messages("📋 **Активні заявки**:", (reports.format_active_request(req) for req in page)))
+    action = callbacks.ACTIVE_PAGE if selected is None else callbacks.BULK_PAGE
+    markup = types.InlineKeyboardMarkup()
+    if selected is not None:
+        for req in page:
+            mark = '✅' if req['id'] in selected else '⬜️'
+            markup.row(types.InlineKeyboardButton(f"{mark} №{req['request_number']} · {req['amount']} · {req['name']}",
+                                                  callback_data=callbacks.encode(callbacks.BULK_TOGGLE, req['id'], *page_key_args(after))))
+    buttons = []
+    if after is not None:
+        buttons.append(types.InlineKeyboardButton('⏮ На початок', callback_data=callbacks.encode(action)))
+    if has_next:
+        last = page[-1]
+        buttons.append(types.InlineKeyboardButton('Далі ▶️', callback_data=callbacks.encode(action, *page_key_args((last['created_at'], last['id'])))))
+    markup.add(*buttons)
+    if selected is None:
+        markup.row(types.InlineKeyboardButton('☑️ Вибрати заявки', callback_data=callbacks.encode(callbacks.BULK_PAGE, *page_key_args(after))))
+    else:
+        if selected:
+            markup.row(types.InlineKeyboardButton(f'✅ Погодити вибрані ({len(selected)})', callback_data=callbacks.encode(callbacks.BULK_APPLY, BULK_APPROVE)),
+                       types.InlineKeyboardButton(f'❌ Відхилити вибрані ({len(selected)})', callback_data=callbacks.encode(callbacks.BULK_APPLY, BULK_REJECT)))
+        markup.row(types.InlineKeyboardButton('✖️ Скасувати', callback_data=callbacks.encode(callbacks.BULK_CANCEL)))
+    return text, markup
+
+@bot.message_handler(commands=['active'])
+def active_requests_command(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        text, markup = build_active_page()
+        send_message(message.chat.id, text, reply_markup=markup, parse_mode='Markdown')
+        logging.info(f"Адміністратор {message.from_user.id} переглядає активні заявки")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для перегляду заявок.")
+        logging.warning(f"Користувач {message.from_user.id} намагався переглянути активні заявки без прав")
+
+@router.action(callbacks.ACTIVE_PAGE)
+def active_requests_page(call, created_at=None, request_id=None):
+    if call.from_user.id not in config.ADMIN_NAMES:
+        return
+    text, markup = build_active_page(page_key_from_args(created_at, request_id))
+    edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown', priority=outbox.PRIORITY_USER)
+
+# Массовые решения по заявкам: отмеченные в списке /active или все активные
+# заявки с суммой не больше порога (/bulk_approve, /bulk_reject). Заявки
+# меняются одной транзакцией с записью в журнал, пользователи получают по
+# одному уведомлению на все свои заявки.
+BULK_APPROVE = 1
+BULK_REJECT = 2
+BULK_STATUSES = {BULK_APPROVE: database.STATUS_APPROVED, BULK_REJECT: database.STATUS_REJECTED}
+
+def show_bulk_page(call, after):
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    text, markup = build_active_page(after, set(database.get_bulk_selection(chat_id, message_id)))
+    edit_message_text(text, chat_id, message_id, reply_markup=markup, parse_mode='Markdown', priority=outbox.PRIORITY_USER)
+
+@router.action(callbacks.BULK_PAGE)
+def bulk_select_page(call, created_at=None, request_id=None):
+    if call.from_user.id not in config.ADMIN_NAMES:
+        return
+    show_bulk_page(call, page_key_from_args(created_at, request_id))
+
+@router.action(callbacks.BULK_TOGGLE)
+def bulk_toggle_request(call, request_id, created_at=None, after_id=None):
+    if call.from_user.id not in config.ADMIN_NAMES:
+        return
+    database.toggle_bulk_selection(call.message.chat.id, call.message.message_id, request_id)
+    show_bulk_page(call, page_key_from_args(created_at, after_id))
+
+@router.action(callbacks.BULK_CANCEL)
+def bulk_cancel(call):
+    if call.from_user.id not in config.ADMIN_NAMES:
+        return
+    database.clear_bulk_selection(call.message.chat.id, call.message.message_id)
+    edit_message_text("✖️ Масове рішення скасовано.", call.message.chat.id, call.message.message_id, priority=outbox.PRIORITY_USER)
+
+# Уведомления пользователей о массовом решении: одно сообщение на
+# пользователя в фоновой очереди, чтобы рассылка не задерживала ответы
+def notify_bulk_decision(updated, status, admin_name):
+    verb = 'погоджено' if status == database.STATUS_APPROVED else 'відхилено'
+    numbers_by_user = {}
+    for request in updated:
+        numbers_by_user.setdefault(request['user_id'], []).append(request['request_number'])
+    for user_id, numbers in numbers_by_user.items():
+        if len(numbers) == 1:
+            text = f"Ваш запит №{numbers[0]} було {verb} адміністратором {admin_name}."
+        else:
+            text = f"Ваші запити {', '.join(f'№{number}' for number in numbers)} було {verb} адміністратором {admin_name}."
+        notify_user(user_id, text, priority=outbox.PRIORITY_BACKGROUND)
+    return len(numbers_by_user)
+
+def apply_bulk_decision(call, request_ids, decision, criteria):
+    admin_id = call.from_user.id
+    admin_name = config.ADMIN_NAMES.get(admin_id, "Адміністратор")
+    status = BULK_STATUSES[decision]
+    action_id, updated = cache.bulk_update_request_status(request_ids, status, admin_id, criteria)
+    notified = notify_bulk_decision(updated, status, admin_name)
+    edit_message_text(reports.format_bulk_result(action_id, status, updated, len(request_ids), admin_name),
+                      call.message.chat.id, call.message.message_id, priority=outbox.PRIORITY_USER)
+    logging.info(f"Адміністратор {admin_id} виконав масову дію #{action_id} ({status}): "
+                 f"змінено {len(updated)} з {len(request_ids)} заявок, сповіщено {notified} користувачів")
+
+@router.action(callbacks.BULK_APPLY)
+def bulk_apply_selection(call, decision):
+    if call.from_user.id not in config.ADMIN_NAMES or decision not in BULK_STATUSES:
+        return
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    request_ids = database.get_bulk_selection(chat_id, message_id)
+    if not request_ids:
+        return
+    apply_bulk_decision(call, request_ids, decision, {'selected': len(request_ids)})
+    database.clear_bulk_selection(chat_id, message_id)
+
+@bot.message_handler(commands=['bulk_approve', 'bulk_reject'])
+def bulk_threshold_command(message):
+    if message.from_user.id not in config.ADMIN_NAMES:
+        send_message(message.chat.id, "⛔️ У вас немає прав для розгляду заявок.")
+        logging.warning(f"Користувач {message.from_user.id} намагався виконати масове рішення без прав")
+        return
+    command, *args = message.text.split()
+    decision = BULK_APPROVE if command.split('@')[0] == '/bulk_approve' else BULK_REJECT
+    if len(args) != 1 or not args[0].isdigit():
+        send_message(message.chat.id, "❗️ Формат: /bulk_approve СУМА або /bulk_reject СУМА - усі активні заявки з сумою не більше СУМА")
+        return
+    max_amount = int(args[0])
+    summary = database.get_active_requests_below(max_amount)
+    if not summary['count']:
+        send_message(message.chat.id, f"✅ Активних заявок із сумою до {max_amount} немає.")
+        return
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton('✔️ Підтвердити', callback_data=callbacks.encode(callbacks.BULK_CONFIRM, decision, max_amount, summary['max_id'])),
+               types.InlineKeyboardButton('✖️ Скасувати', callback_data=callbacks.encode(callbacks.BULK_CANCEL)))
+    send_message(message.chat.id, reports.format_bulk_preview(BULK_STATUSES[decision], max_amount, summary), reply_markup=markup)
+    logging.info(f"Адміністратор {message.from_user.id} готує масове рішення для заявок із сумою до {max_amount}")
+
+# Подтверждение решения по порогу. Заявки, созданные после показа
+# подтверждения (id больше max_id), не затрагиваются.
+@router.action(callbacks.BULK_CONFIRM)
+def bulk_confirm_threshold(call, decision, max_amount, max_id):
+    if call.from_user.id not in config.ADMIN_NAMES or decision not in BULK_STATUSES:
+        return
+    request_ids = database.get_active_request_ids_below(max_amount, max_id)
+    apply_bulk_decision(call, request_ids, decision, {'max_amount': max_amount, 'max_id': max_id})
+
+@bot.message_handler(commands=['bulk_history'])
+def bulk_history_command(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        send_message(message.chat.id, reports.format_bulk_actions(database.get_bulk_actions(), config.ADMIN_NAMES))
+        logging.info(f"Адміністратор {message.from_user.id} переглянув журнал масових рішень")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для перегляду журналу.")
+        logging.warning(f"Користувач {message.from_user.id} намагався переглянути журнал масових рішень без прав")
+
+# Перенос давно решенных заявок в помесячные архивные таблицы. Записи кеша
+# заявок не сбрасываются: данные заявок не меняются, а get_request_info
+# находит заявку и в архиве.
+def archive_closed_requests():
+    archived = database.archive_requests(ARCHIVE_AFTER_DAYS)
+    if archived:
+        logging.info(f"Перенесено в архив {archived} заявок, вирішених понад {ARCHIVE_AFTER_DAYS} днів тому")
 
 def schedule_reminders():
     weekdays = ["monday", "tuesday", "wednesday", "thursday", "friday"]
     for day in weekdays:
         for hour in range(10, 17):
             getattr(schedule.every(), day).at(f"{hour}:00").do(send_active_requests_reminder)
+    schedule.every().hour.do(dialogs.cleanup)
+    schedule.every().day.at("03:00").do(storage.collect_garbage, UPLOAD_FOLDER)
+    schedule.every().day.at("03:30").do(database.delete_finished_jobs, JOB_RETENTION_DAYS * 24 * 60 * 60)
+    if ARCHIVE_AFTER_DAYS:
+        schedule.every().day.at("04:00").do(archive_closed_requests)
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        # Сон до ближайшего задания расписания вместо проверки каждую секунду
+        idle_seconds = schedule.idle_seconds()
+        time.sleep(max(idle_seconds, 0) if idle_seconds is not None else 60)
 
 def run_scheduler():
     scheduler_thread = Thread(target=schedule_reminders)
     scheduler_thread.start()
     logging.info("Запущено планувальник для відправки нагадувань")
 
-@bot.callback_query_handler(func=lambda call: call.data == 'make_request')
+@router.action(callbacks.MAKE_REQUEST)
 def handle_make_request(call):
     user_id = call.from_user.id
-    bot.send_message(call.message.chat.id, "💰 **Введіть суму вашого запиту:**", parse_mode='Markdown')
-    bot.register_next_step_handler(call.message, process_amount)
+    dialogs.set(call.message.chat.id, 'request_amount')
+    send_message(call.message.chat.id, "💰 **Введіть суму вашого запиту:**", parse_mode='Markdown')
     logging.info(f"Користувач {user_id} натиснув кнопку 'Зробити запит'")
 
-@bot.callback_query_handler(func=lambda call: call.data == 'register')
+@router.action(callbacks.REGISTER)
 def process_registration(call):
     user_id = call.from_user.id
-    if user_id in user_cache or database.is_user_registered(user_id):
-        user_cache[user_id] = True
-        bot.send_message(call.message.chat.id, "✅ **Ви вже авторизовані!**", parse_mode='Markdown')
+    if cache.is_user_registered(user_id):
+        send_message(call.message.chat.id, "✅ **Ви вже авторизовані!**", parse_mode='Markdown')
         logging.info(f"Користувач {user_id} вже авторизований")
     else:
-        bot.send_message(call.from_user.id, "✏️ **Введіть ваше ім'я та прізвище:**", parse_mode='Markdown')
-        bot.register_next_step_handler(call.message, get_name)
+        dialogs.set(call.message.chat.id, 'registration_name')
+        send_message(call.from_user.id, "✏️ **Введіть ваше ім'я та прізвище:**", parse_mode='Markdown')
         logging.info(f"Користувач {user_id} почав реєстрацію")
 
-def get_name(message):
+@dialogs.step('registration_name')
+def get_name(message, data):
     user_id = message.from_user.id
     name = message.text
-    bot.send_message(message.chat.id, "📱 **Введіть ваш номер телефону:**", parse_mode='Markdown')
-    bot.register_next_step_handler(message, get_phone, name)
+    dialogs.set(message.chat.id, 'registration_phone', name=name)
+    send_message(message.chat.id, "📱 **Введіть ваш номер телефону:**", parse_mode='Markdown')
     logging.info(f"Користувач {user_id} ввів ім'я: {name}")
 
-def get_phone(message, name):
+@dialogs.step('registration_phone')
+def get_phone(message, data):
     phone = message.text
-    bot.send_message(message.chat.id, "🏙 **Введіть ваше місто:**", parse_mode='Markdown')
-    bot.register_next_step_handler(message, get_city, name, phone)
-    logging.info(f"Користувач {message.from_user.id} ввів телефон: {phone}")
+    dialogs.set(message.chat.id, 'registration_city', name=data['name'], phone=phone)
+    send_message(message.chat.id, "🏙 **Введіть ваше місто:**", parse_mode='Markdown')
+    logging.info(f"Користувач {message.from_user.id} ввів телефон")
 
-def get_city(message, name, phone):
+@dialogs.step('registration_city')
+def get_city(message, data):
     city = message.text
     user_id = message.from_user.id
-    database.add_user(user_id, name, phone, city)
-    user_cache[user_id] = True
-    bot.send_message(message.chat.id, "🎉 **Ви успішно зареєстровані!**", parse_mode='Markdown')
-    logging.info(f"Користувач {user_id} зареєстрований. Місто: {city}, Телефон: {phone}")
+    name, phone = data['name'], data['phone']
+    cache.add_user(user_id, name, phone, city)
+    dialogs.finish(message.chat.id)
+    send_message(message.chat.id, "🎉 **Ви успішно зареєстровані!**", parse_mode='Markdown')
+    logging.info(f"Користувач {user_id} зареєстрований. Місто: {city}")
     send_main_menu(message.chat.id)
 
 def send_main_menu(chat_id):
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton('📝 Зробити запит', callback_data='make_request'))
-    bot.send_message(chat_id, "🔔 **Оберіть одну з опцій:**", reply_markup=markup, parse_mode='Markdown')
+    markup.add(types.InlineKeyboardButton('📝 Зробити запит', callback_data=callbacks.encode(callbacks.MAKE_REQUEST)))
+    send_message(chat_id, "🔔 **Оберіть одну з опцій:**", reply_markup=markup, parse_mode='Markdown')
     logging.info(f"Користувачу {chat_id} надіслано головне меню")
 
+# Функция для разбора необязательного периода из аргументов команды
+def parse_period(args):
+    date_from = datetime.strptime(args[0], '%Y-%m-%d').date() if len(args) > 0 else None
+    date_to = datetime.strptime(args[1], '%Y-%m-%d').date() if len(args) > 1 else None
+    return date_from, date_to
+
 @bot.message_handler(commands=['export_requests'])
 def export_requests_command(message):
     user_id = message.from_user.id
     if user_id in config.ADMIN_NAMES:
-        file_path = database.export_requests_to_excel()
-        with open(file_path, 'rb') as file:
-            bot.send_document(user_id, file)
-        logging.info(f"Адміністратор {user_id} експортував запити в Excel")
+        # Необов'язкові аргументи: /export_requests [з YYYY-MM-DD] [по YYYY-MM-DD] [статус]
+        args = message.text.split(maxsplit=3)[1:]
+        try:
+            date_from, date_to = parse_period(args[:2])
+        except ValueError:
+            send_message(message.chat.id, "❗️ Формат: /export_requests [YYYY-MM-DD] [YYYY-MM-DD] [статус]")
+            return
+        status = args[2] if len(args) > 2 else None
+        payload = {
+            'date_from': date_from.isoformat() if date_from else None,
+            'date_to': date_to.isoformat() if date_to else None,
+            'status': status,
+        }
+        job_id = job_queue.submit('export', payload, chat_id=user_id)
+        send_message(message.chat.id, f"⏳ Експорт поставлено в чергу (завдання №{job_id}). Файл надійде в цей чат.")
+        logging.info(f"Адміністратор {user_id} поставив у чергу експорт запитів (завдання №{job_id})")
     else:
-        bot.send_message(message.chat.id, "⛔️ У вас немає прав для експорту запитів.")
+        send_message(message.chat.id, "⛔️ У вас немає прав для експорту запитів.")
         logging.warning(f"Користувач {user_id} намагався експортувати запити без прав")
 
+def export_done(job, result):
+    file_path = result['file_path']
+    send_message(job['chat_id'], "📊 Експорт готовий.")
+    # Файл экспорта удаляется после отправки
+    send_file(job['chat_id'], file_path).add_done_callback(lambda future: os.remove(file_path))
+
+def export_failed(job, error):
+    send_message(job['chat_id'], f"❗️ Не вдалося сформувати експорт (завдання №{job['id']}): {error}")
+
+job_queue.register('export', jobs.export_requests, export_done, export_failed, in_process=True)
+
+@bot.message_handler(commands=['job'])
+def job_status_command(message):
+    args = message.text.split()[1:]
+    if args and args[0].isdigit():
+        job = database.get_job(int(args[0]))
+        if job is None or (job['chat_id'] != message.chat.id and message.from_user.id not in config.ADMIN_NAMES):
+            send_message(message.chat.id, "❗️ Завдання не знайдено.")
+            return
+        text = f"Завдання №{job['id']} ({job['kind']}): {job['status']}, спроба {job['attempts']} з {job['max_attempts']}"
+        if job['error']:
+            text += f"\nОстання помилка: {job['error']}"
+        send_message(message.chat.id, text)
+    elif message.from_user.id in config.ADMIN_NAMES:
+        counts = database.get_job_counts()
+        if counts:
+            send_message(message.chat.id, "⚙️ Фонові завдання:\n" + "\n".join(f"{status}: {count}" for status, count in sorted(counts.items())))
+        else:
+            send_message(message.chat.id, "⚙️ Фонових завдань немає.")
+    else:
+        send_message(message.chat.id, "❗️ Формат: /job <номер завдання>")
+
 @bot.message_handler(commands=['import_requests'])
 def import_requests_command(message):
     user_id = message.from_user.id
     if user_id in config.ADMIN_NAMES:
-        bot.send_message(user_id, "🗂️ Функція імпорту запитів запущена.")
-        logging.info(f"Адміністратор {user_id} виконав імпорт запитів")
+        dialogs.set(message.chat.id, 'import_file')
+        send_message(message.chat.id, "🗂️ Надішліть файл .xlsx або .csv у форматі експорту (/export_requests). "
+                                      "Будь-яке текстове повідомлення скасує імпорт.")
+        logging.info(f"Адміністратор {user_id} почав імпорт запитів")
     else:
-        bot.send_message(message.chat.id, "⛔️ У вас немає прав для імпорту запитів.")
+        send_message(message.chat.id, "⛔️ У вас немає прав для імпорту запитів.")
         logging.warning(f"Користувач {user_id} намагався виконати імпорт запитів без прав")
 
-def process_amount(message):
+@dialogs.step('import_file')
+def process_import_file(message, data):
+    dialogs.finish(message.chat.id)
+    if message.content_type != 'document':
+        send_message(message.chat.id, "Імпорт скасовано.")
+        return
+    extension = os.path.splitext(message.document.file_name or '')[-1].lower()
+    if extension not in importer.IMPORT_EXTENSIONS:
+        send_message(message.chat.id, "❗️ Підтримуються лише файли .xlsx і .csv. Почніть знову: /import_requests")
+        return
+    payload = {'file_id': message.document.file_id, 'extension': extension, 'file_name': message.document.file_name}
+    job_id = job_queue.submit('import_download', payload, chat_id=message.chat.id)
+    send_message(message.chat.id, f"⏳ Файл отримано, імпорт поставлено в чергу (завдання №{job_id}).")
+    logging.info(f"Адміністратор {message.from_user.id} надіслав файл для імпорту (завдання №{job_id})")
+
+# Загрузка файла импорта и проверка заголовков. Сам импорт - отдельная
+# задача в процессе, который не делит процессор с обработкой сообщений.
+def download_import(payload):
+    file_info = bot.get_file(payload['file_id'])
+    url = storage.telegram_file_url(bot.token, file_info.file_path, apihelper.FILE_URL)
+    path, sha256 = importer.download(url, payload['extension'], proxies=apihelper.proxy)
+    try:
+        importer.check_file(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return {'path': path, 'sha256': sha256, 'file_name': payload['file_name']}
+
+def download_import_done(job, result):
+    state = database.start_import_job(result['sha256'], result['file_name'], 'import', result['path'],
+                                      job['chat_id'], job_queue.max_attempts('import'))
+    if state['status'] == database.IMPORT_DONE:
+        os.remove(result['path'])
+        send_message(job['chat_id'], f"ℹ️ Цей файл уже імпортовано ({state['updated_at']}).")
+        return
+    if not state['started']:
+        # Файл не удаляется: по тому же пути его читает выполняющийся импорт
+        send_message(job['chat_id'], f"⏳ Імпорт цього файлу вже виконується (завдання №{state['job_id']}). "
+                                     f"Хід імпорту: /job {state['job_id']}")
+        return
+    job_queue.wake()
+    import_job_id = state['job_id']
+    if state['rows_done']:
+        send_message(job['chat_id'], f"↩️ Продовження перерваного імпорту з рядка {state['rows_done'] + 2}.")
+    progress_message = send_message(job['chat_id'], reports.format_import_progress(state))
+    Thread(target=watch_import, args=(state['id'], import_job_id, job['chat_id'], progress_message), daemon=True).start()
+
+def download_import_failed(job, error):
+    send_message(job['chat_id'], f"❗️ Не вдалося прийняти файл для імпорту: {error}")
+
+# Обновление сообщения о ходе импорта, пока задача импорта выполняется.
+# Прогресс читается из таблицы imports, куда его пишет процесс импорта.
+IMPORT_PROGRESS_INTERVAL = 5
+
+def watch_import(import_id, job_id, chat_id, progress_message):
+    try:
+        message_id = progress_message.result().message_id
+    except Exception:
+        return
+    rows_done = None
+    while True:
+        time.sleep(IMPORT_PROGRESS_INTERVAL)
+        state = database.get_import(import_id)
+        job = database.get_job(job_id)
+        if state is None or job is None or job['status'] in (database.JOB_DONE, database.JOB_FAILED):
+            return
+        if state['rows_done'] != rows_done:
+            rows_done = state['rows_done']
+            edit_message_text(reports.format_import_progress(state), chat_id, message_id)
+
+def import_done(job, result):
+    send_message(job['chat_id'], reports.format_import_result(result))
+    os.remove(json.loads(job['payload'])['path'])
+    logging.info(f"Імпорт №{result['id']} завершено: додано {result['rows_imported']} запитів")
+
+def import_failed(job, error):
+    payload = json.loads(job['payload'])
+    database.finish_import(payload['import_id'], database.IMPORT_FAILED)
+    # Файл остается: повторная отправка того же файла продолжит импорт
+    send_message(job['chat_id'], f"❗️ Імпорт перервано (завдання №{job['id']}): {error}\n"
+                                 "Надішліть той самий файл ще раз, щоб продовжити з місця зупинки.")
+
+job_queue.register('import_download', download_import, download_import_done, download_import_failed)
+job_queue.register('import', importer.run_import, import_done, import_failed, in_process=True)
+
+@dialogs.step('request_amount')
+def process_amount(message, data):
     amount = message.text
-    if not amount.isdigit():
-        bot.send_message(message.chat.id, "❗️ **Будь ласка, введіть коректне число для суми.**", parse_mode='Markdown')
+    if not amount or not amount.isdigit():
+        send_message(message.chat.id, "❗️ **Будь ласка, введіть коректне число для суми.**", parse_mode='Markdown')
         logging.warning(f"Користувач {message.from_user.id} ввів некоректну суму: {amount}")
-        bot.register_next_step_handler(message, process_amount)
         return
-    bot.send_message(message.chat.id, "🖋 **Введіть коментар:**", parse_mode='Markdown')
-    bot.register_next_step_handler(message, process_comment, amount)
+    dialogs.set(message.chat.id, 'request_comment', amount=amount)
+    send_message(message.chat.id, "🖋 **Введіть коментар:**", parse_mode='Markdown')
     logging.info(f"Користувач {message.from_user.id} ввів суму: {amount}")
 
-def process_comment(message, amount):
+@dialogs.step('request_comment')
+def process_comment(message, data):
     comment = message.text
+    # Черновик хранится в диалоге под коротким ключом; кнопка несет только ключ,
+    # поэтому устаревшая кнопка от прошлого черновика не срабатывает
+    draft = secrets.randbits(48)
+    dialogs.set(message.chat.id, 'request_file', amount=data['amount'], comment=comment, draft=draft)
     markup = types.InlineKeyboardMarkup()
-    skip_button = types.InlineKeyboardButton('⏭ Пропустити', callback_data=f'skip_file|{amount}|{comment}')
+    skip_button = types.InlineKeyboardButton('⏭ Пропустити', callback_data=callbacks.encode(callbacks.SKIP_FILE, draft))
     markup.add(skip_button)
-    bot.send_message(message.chat.id, "📎 **Тепер можна прикріпити фото або PDF-файл. Якщо файл не потрібен, пропустіть цей крок.**", reply_markup=markup, parse_mode='Markdown')
-    logging.info(f"Користувач {message.from_user.id} додав коментар: {comment}")
-    bot.register_next_step_handler(message, process_file, amount, comment)
+    send_message(message.chat.id, "📎 **Тепер можна прикріпити фото або PDF-файл. Якщо файл не потрібен, пропустіть цей крок.**", reply_markup=markup, parse_mode='Markdown')
+    logging.info(f"Користувач {message.from_user.id} додав коментар ({len(comment)} символів)")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('skip_file'))
-def skip_file(call):
-    _, amount, comment = call.data.split('|')
+@router.action(callbacks.SKIP_FILE)
+def skip_file(call, draft=None):
     user_id = call.from_user.id
+    # Черновик заявки берется из состояния диалога; повторное нажатие кнопки
+    # после отправки заявки ничего не создает
+    conversation = dialogs.get(call.message.chat.id)
+    if conversation is None or conversation[0] != 'request_file' or (draft is not None and conversation[1].get('draft') != draft):
+        logging.warning(f"Користувач {user_id} натиснув 'Пропустити' без активного запиту")
+        return
+    amount, comment = conversation[1]['amount'], conversation[1]['comment']
+    dialogs.finish(call.message.chat.id)
     request_id, request_number = database.add_request(user_id, amount, comment, None)
     notify_admin_about_request(request_id, request_number, amount, comment, user_id)
-    bot.send_message(call.message.chat.id, f"📩 **Ваш запит №{request_number}: {amount} прийнятий на розгляд.**", parse_mode='Markdown')
+    send_message(call.message.chat.id, f"📩 **Ваш запит №{request_number}: {amount} прийнятий на розгляд.**", parse_mode='Markdown')
     logging.info(f"Запит №{request_number} від користувача {user_id} додано без файлу")
 
-def process_file(message, amount, comment):
-    try:
-        file_path = None
-        user_id = message.from_user.id
-        if message.content_type == 'photo':
-            file_info = bot.get_file(message.photo[-1].file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-            file_path = os.path.join(UPLOAD_FOLDER, file_info.file_unique_id + '.jpg')
-            with open(file_path, 'wb') as new_file:
-                new_file.write(downloaded_file)
-        elif message.content_type == 'document':
-            file_extension = os.path.splitext(message.document.file_name)[-1].lower()
-            supported_formats = ['.pdf', '.jpg', '.jpeg', '.png', '.txt', '.doc', '.docx', '.xls', '.xlsx']
-            if file_extension not in supported_formats:
-                bot.send_message(message.chat.id, "❗️ **Формат файла не поддерживается. Разрешенные форматы: PDF, JPG, JPEG, PNG, TXT, DOC, DOCX, XLS, XLSX.**")
-                logging.warning(f"Формат файла {file_extension} не поддерживается для пользователя {user_id}")
-                return
-            file_info = bot.get_file(message.document.file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-            file_path = os.path.join(UPLOAD_FOLDER, message.document.file_name)
-            with open(file_path, 'wb') as new_file:
-                new_file.write(downloaded_file)
-
-        request_id, request_number = database.add_request(user_id, amount, comment, file_path)
-        notify_admin_about_request(request_id, request_number, amount, comment, user_id, file_path)
-        bot.send_message(message.chat.id, f"📩 **Ваш запит №{request_number}: {amount} прийнятий на розгляд.**", parse_mode='Markdown')
-        logging.info(f"Запит №{request_number} від користувача {user_id} додано з файлом {file_path if file_path else 'без файлу'}")
-
-    except Exception as e:
-        error_message = f"❗️ **Произошла ошибка при обработке файла. Причина: {str(e)}.** Пожалуйста, попробуйте снова или загрузите другой файл."
-        bot.send_message(message.chat.id, error_message)
-        logging.error(f"Ошибка при обработке файла для пользователя {message.from_user.id}: {str(e)}")
+# Функция для потоковой загрузки вложения пользователя в хранилище. file_id
+# сообщения пользователя запоминается, чтобы переслать файл администратору
+# без повторной загрузки.
+def save_upload(file_id, extension, file_name, kind):
+    file_info = bot.get_file(file_id)
+    url = storage.telegram_file_url(bot.token, file_info.file_path, apihelper.FILE_URL)
+    return storage.download(url, UPLOAD_FOLDER, extension, file_name, file_id, kind, proxies=apihelper.proxy)
+
+@dialogs.step('request_file')
+def process_file(message, data):
+    amount, comment = data['amount'], data['comment']
+    user_id = message.from_user.id
+    if message.content_type == 'photo':
+        upload = {'file_id': message.photo[-1].file_id, 'extension': '.jpg', 'file_name': None, 'kind': 'photo'}
+    elif message.content_type == 'document':
+        file_extension = os.path.splitext(message.document.file_name or '')[-1].lower()
+        supported_formats = ['.pdf', '.jpg', '.jpeg', '.png', '.txt', '.doc', '.docx', '.xls', '.xlsx']
+        if file_extension not in supported_formats:
+            send_message(message.chat.id, "❗️ **Формат файла не поддерживается. Разрешенные форматы: PDF, JPG, JPEG, PNG, TXT, DOC, DOCX, XLS, XLSX.**")
+            logging.warning(f"Формат файла {file_extension} не поддерживается для пользователя {user_id}")
+            return
+        upload = {'file_id': message.document.file_id, 'extension': file_extension, 'file_name': message.document.file_name, 'kind': 'document'}
+    else:
+        dialogs.finish(message.chat.id)
+        request_id, request_number = database.add_request(user_id, amount, comment, None)
+        notify_admin_about_request(request_id, request_number, amount, comment, user_id)
+        send_message(message.chat.id, f"📩 **Ваш запит №{request_number}: {amount} прийнятий на розгляд.**", parse_mode='Markdown')
+        logging.info(f"Запит №{request_number} від користувача {user_id} додано без файлу")
+        return
+
+    # Загрузка файла и создание заявки выполняются фоновой задачей
+    dialogs.finish(message.chat.id)
+    job_id = job_queue.submit('upload', dict(upload, user_id=user_id, amount=amount, comment=comment), chat_id=message.chat.id)
+    send_message(message.chat.id, "⏳ Файл отримано, запит обробляється.")
+    logging.info(f"Файл користувача {user_id} поставлено в чергу обробки (завдання №{job_id})")
+
+def process_upload(payload):
+    file_path = save_upload(payload['file_id'], payload['extension'], payload['file_name'], payload['kind'])
+    request_id, request_number = database.add_request(payload['user_id'], payload['amount'], payload['comment'], file_path)
+    return {'request_id': request_id, 'request_number': request_number, 'file_path': file_path}
+
+def upload_done(job, result):
+    payload = json.loads(job['payload'])
+    user_id, amount, comment = payload['user_id'], payload['amount'], payload['comment']
+    notify_admin_about_request(result['request_id'], result['request_number'], amount, comment, user_id, result['file_path'])
+    send_message(job['chat_id'], f"📩 **Ваш запит №{result['request_number']}: {amount} прийнятий на розгляд.**", parse_mode='Markdown')
+    logging.info(f"Запит №{result['request_number']} від користувача {user_id} додано з файлом {result['file_path']}")
+
+def upload_failed(job, error):
+    payload = json.loads(job['payload'])
+    # Черновик возвращается в диалог, чтобы пользователь мог отправить файл еще раз
+    dialogs.set(job['chat_id'], 'request_file', amount=payload['amount'], comment=payload['comment'], draft=secrets.randbits(48))
+    error_message = f"❗️ **Произошла ошибка при обработке файла. Причина: {str(error)}.** Пожалуйста, попробуйте снова или загрузите другой файл."
+    send_message(job['chat_id'], error_message)
+    logging.error(f"Ошибка при обработке файла для пользователя {payload['user_id']}: {str(error)}")
+
+job_queue.register('upload', process_upload, upload_done, upload_failed)
 
 def notify_admin_about_request(request_id, request_number, amount, comment, user_id, file_path=None):
-    user_info = database.get_user_info(user_id)
-    request_text = (f"🆕 **Запит №{request_number}** від {user_info['name']}, {user_info['city']} (📞 Телефон: {user_info['phone']}):\n"
+    user_info = cache.get_user_profile(user_id)
+    # Текст пользователя экранируется: сообщение отправляется с разметкой Markdown
+    request_text = (f"🆕 **Запит №{request_number}** від {reports.escape_markdown(user_info['name'])}, "
+                    f"{reports.escape_markdown(user_info['city'])} (📞 Телефон: {reports.escape_markdown(user_info['phone'])}):\n"
                     f"💰 **Сума:** {amount}\n"
-                    f"🖋 **Коментар:** {comment}\n"
+                    f"🖋 **Коментар:** {reports.escape_markdown(comment)}\n"
                     f"📎 **Файл:** {'Прикріплено' if file_path else 'Файл не додано.'}")
-    request_message = bot.send_message(config.ADMIN_CHAT_ID, request_text, parse_mode='Markdown')
-
-    if file_path:
-        with open(file_path, 'rb') as file:
-            bot.send_document(config.ADMIN_CHAT_ID, file) if file_path.endswith(('.pdf', '.txt', '.doc', '.docx', '.xls', '.xlsx')) else bot.send_photo(config.ADMIN_CHAT_ID, file)
-
+    # Кнопки отправляются вместе с текстом одним вызовом
     markup = types.InlineKeyboardMarkup()
-    approve_button = types.InlineKeyboardButton('✅ Погодити без коментаря', callback_data=f'approve_without_comment_{request_id}')
-    approve_with_comment_button = types.InlineKeyboardButton('✏️ Погодити з коментарем', callback_data=f'approve_with_comment_{request_id}')
-    reject_button = types.InlineKeyboardButton('❌ Відхилити', callback_data=f'reject_{request_id}')
+    approve_button = types.InlineKeyboardButton('✅ Погодити без коментаря', callback_data=callbacks.encode(callbacks.APPROVE, request_id))
+    approve_with_comment_button = types.InlineKeyboardButton('✏️ Погодити з коментарем', callback_data=callbacks.encode(callbacks.APPROVE_WITH_COMMENT, request_id))
+    reject_button = types.InlineKeyboardButton('❌ Відхилити', callback_data=callbacks.encode(callbacks.REJECT, request_id))
     markup.add(approve_button, approve_with_comment_button, reject_button)
-    bot.edit_message_reply_markup(config.ADMIN_CHAT_ID, request_message.message_id, reply_markup=markup)
+    send_message(config.ADMIN_CHAT_ID, request_text, reply_markup=markup, parse_mode='Markdown', priority=outbox.PRIORITY_ADMIN)
+
+    if file_path:
+        send_file(config.ADMIN_CHAT_ID, file_path, as_photo=not file_path.endswith(('.pdf', '.txt', '.doc', '.docx', '.xls', '.xlsx')), priority=outbox.PRIORITY_ADMIN)
     logging.info(f"Надіслано запит №{request_number} адміністратору")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('approve_without_comment_'))
-def approve_without_comment(call):
-    request_id = int(call.data.split('_')[-1])
+# Заявка могла быть уже решена массовым действием или другим администратором
+def already_decided_text(request_id, request_info):
+    status = request_info['status'] if request_info else "не знайдено"
+    return f"Запит №{request_id} вже розглянуто: {status}."
+
+def is_pending(call, request_info, request_id):
+    if request_info is not None and request_info['status'] == database.STATUS_PENDING:
+        return True
+    edit_message_text(already_decided_text(request_id, request_info), call.message.chat.id, call.message.message_id)
+    return False
+
+# Запись решения, только если заявка еще в обработке: между проверкой
+# is_pending и записью ее мог решить другой администратор. Иначе сообщение
+# с кнопками заменяется текущим статусом.
+def decide(request_id, status, admin_id, chat_id, message_id, comment=None):
+    if cache.decide_request(request_id, status, comment, admin_id):
+        return True
+    edit_message_text(already_decided_text(request_id, cache.get_request(request_id)), chat_id, message_id)
+    return False
+
+@router.action(callbacks.APPROVE)
+def approve_without_comment(call, request_id):
     admin_name = config.ADMIN_NAMES.get(call.from_user.id, "Адміністратор")
     
-    database.update_request_status(request_id, "Погоджено")
-    request_info = database.get_request_info(request_id)
-    bot.send_message(request_info['user_id'], f"Ваш запит №{request_info['request_number']} було погоджено адміністратором {admin_name} без коментаря.")
-    bot.edit_message_text(f"Запит №{request_id} погоджено адміністратором {admin_name}.", config.ADMIN_CHAT_ID, call.message.message_id)
+    request_info = cache.get_request(request_id)
+    if not is_pending(call, request_info, request_id):
+        return
+    if not decide(request_id, "Погоджено", call.from_user.id, call.message.chat.id, call.message.message_id):
+        return
+    notify_user(request_info['user_id'], f"Ваш запит №{request_info['request_number']} було погоджено адміністратором {admin_name} без коментаря.")
+    edit_message_text(f"Запит №{request_id} погоджено адміністратором {admin_name}.", config.ADMIN_CHAT_ID, call.message.message_id)
     logging.info(f"Запит №{request_id} погоджено без коментаря")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('approve_with_comment_'))
-def approve_with_comment(call):
-    request_id = int(call.data.split('_')[-1])
-    bot.send_message(call.message.chat.id, "✏️ Введіть ваш коментар до погодження:", parse_mode='Markdown')
-    bot.register_next_step_handler(call.message, process_approve_comment, request_id, call.message.message_id)
+@router.action(callbacks.APPROVE_WITH_COMMENT)
+def approve_with_comment(call, request_id):
+    if not is_pending(call, cache.get_request(request_id), request_id):
+        return
+    dialogs.set(call.message.chat.id, 'approve_comment', request_id=request_id, admin_message_id=call.message.message_id)
+    send_message(call.message.chat.id, "✏️ Введіть ваш коментар до погодження:", parse_mode='Markdown')
     logging.info(f"Адміністратор обрав погодження з коментарем для запиту №{request_id}")
 
-def process_approve_comment(message, request_id, admin_message_id):
+@dialogs.step('approve_comment')
+def process_approve_comment(message, data):
+    request_id, admin_message_id = data['request_id'], data['admin_message_id']
     admin_comment = message.text
-    request_info = database.get_request_info(request_id)
-    database.update_request_status(request_id, "Погоджено", admin_comment)
+    dialogs.finish(message.chat.id)
+    # Комментарий вводится после нажатия кнопки: за это время заявку мог
+    # решить другой администратор
+    if not decide(request_id, "Погоджено", message.from_user.id, config.ADMIN_CHAT_ID, admin_message_id, admin_comment):
+        send_message(message.chat.id, "❗️ Коментар не збережено: запит уже розглянуто.")
+        return
+    request_info = cache.get_request(request_id)
 
-    try:
-        bot.edit_message_text(
-            f"Запит №{request_info['request_number']} погоджено з коментарем адміністратора: {admin_comment}",
-            chat_id=config.ADMIN_CHAT_ID,
-            message_id=admin_message_id,
-            parse_mode='Markdown'
-        )
-    except telebot.apihelper.ApiTelegramException as e:
-        logging.warning(f"Не вдалося оновити повідомлення з кнопками: {e}")
-
-    bot.send_message(
+    edit_message_text(
+        f"Запит №{request_info['request_number']} погоджено з коментарем адміністратора: {reports.escape_markdown(admin_comment)}",
+        config.ADMIN_CHAT_ID,
+        admin_message_id,
+        parse_mode='Markdown'
+    )
+
+    notify_user(
         request_info['user_id'],
         f"Ваш запит №{request_info['request_number']} погоджено з коментарем адміністратора: {admin_comment}"
     )
-    logging.info(f"Запит №{request_id} погоджено адміністратором з коментарем: {admin_comment}")
+    logging.info(f"Запит №{request_id} погоджено адміністратором з коментарем")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('reject_'))
-def reject_request(call):
-    request_id = int(call.data.split('_')[-1])
+@router.action(callbacks.REJECT)
+def reject_request(call, request_id):
     admin_name = config.ADMIN_NAMES.get(call.from_user.id, "Адміністратор")
     
-    database.update_request_status(request_id, "Відхилено")
-    request_info = database.get_request_info(request_id)
-    bot.send_message(request_info['user_id'], f"Ваш запит №{request_info['request_number']} було відхилено адміністратором {admin_name}.")
-    bot.edit_message_text(f"Запит №{request_id} відхилено адміністратором {admin_name}.", config.ADMIN_CHAT_ID, call.message.message_id)
+    request_info = cache.get_request(request_id)
+    if not is_pending(call, request_info, request_id):
+        return
+    if not decide(request_id, "Відхилено", call.from_user.id, call.message.chat.id, call.message.message_id):
+        return
+    notify_user(request_info['user_id'], f"Ваш запит №{request_info['request_number']} було відхилено адміністратором {admin_name}.")
+    edit_message_text(f"Запит №{request_id} відхилено адміністратором {admin_name}.", config.ADMIN_CHAT_ID, call.message.message_id)
     logging.info(f"Запит №{request_id} відхилено адміністратором {admin_name}")
 
+@bot.message_handler(commands=['history'])
+def request_history_command(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        args = message.text.split()[1:]
+        if len(args) != 1 or not args[0].isdigit():
+            send_message(message.chat.id, "❗️ Формат: /history ID_ЗАПИТУ")
+            return
+        request_id = int(args[0])
+        send_message(message.chat.id, reports.format_request_history(request_id, cache.get_request(request_id),
+                                                                     database.get_request_history(request_id), config.ADMIN_NAMES))
+        logging.info(f"Адміністратор {message.from_user.id} переглянув історію запиту №{request_id}")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для перегляду історії запитів.")
+        logging.warning(f"Користувач {message.from_user.id} намагався переглянути історію запиту без прав")
+
+@bot.message_handler(commands=['storage_gc'])
+def storage_gc_command(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        removed, freed = storage.collect_garbage(UPLOAD_FOLDER)
+        send_message(message.chat.id, f"🧹 Видалено файлів: {removed}, звільнено {freed / 1024 / 1024:.1f} МБ.")
+        logging.info(f"Адміністратор {message.from_user.id} запустив очищення сховища")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для очищення сховища.")
+        logging.warning(f"Користувач {message.from_user.id} намагався очистити сховище без прав")
+
 @bot.message_handler(commands=['stats'])
 def send_stats(message):
     if message.from_user.id in config.ADMIN_NAMES:
-        total_requests = database.get_total_requests()
-        approved_requests = database.get_approved_requests()
-        rejected_requests = database.get_rejected_requests()
-
-        bot.send_message(
-            message.chat.id,
-            f"📊 Статистика запитів:\nЗагалом запитів: {total_requests}\nПогоджено: {approved_requests}\nВідхилено: {rejected_requests}",
-            parse_mode='Markdown'
-        )
+        # /stats - за весь час, /stats YYYY-MM-DD [YYYY-MM-DD] - за період,
+        # /stats cities [YYYY-MM-DD] [YYYY-MM-DD] - за містами
+        args = message.text.split()[1:]
+        by_city = bool(args) and args[0] == 'cities'
+        if by_city:
+            args = args[1:]
+        try:
+            date_from, date_to = parse_period(args)
+        except ValueError:
+            send_message(message.chat.id, "❗️ Формат: /stats [cities] [YYYY-MM-DD] [YYYY-MM-DD]")
+            return
+        period = f" з {date_from or '...'} по {date_to or '...'}" if args else ''
+
+        if by_city:
+            text = reports.format_city_stats(database.get_stats_by_city(date_from, date_to), f"🏙 Статистика за містами{period}:")
+        elif args:
+            text = reports.format_stats(database.get_stats_by_period(date_from, date_to), f"📊 Статистика запитів{period}:")
+        else:
+            text = reports.format_stats(database.get_stats_summary())
+        send_message(message.chat.id, text)
         logging.info(f"Адміністратор {message.from_user.id} запросив статистику")
     else:
-        bot.send_message(message.chat.id, "⛔️ У вас немає прав для перегляду статистики.")
+        send_message(message.chat.id, "⛔️ У вас немає прав для перегляду статистики.")
         logging.warning(f"Користувач {message.from_user.id} намагався отримати доступ до статистики без прав")
 
+@bot.message_handler(commands=['stats_verify'])
+def verify_stats_command(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        # /stats_verify fix - перерахувати зведену статистику при розбіжностях
+        fix = message.text.split()[1:2] == ['fix']
+        mismatches = database.verify_stats(fix=fix)
+        send_message(message.chat.id, reports.format_stats_verification(mismatches, fixed=fix))
+        if mismatches:
+            logging.warning(f"Зведена статистика має {len(mismatches)} розбіжностей з перерахунком")
+        logging.info(f"Адміністратор {message.from_user.id} перевірив статистику")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для перевірки статистики.")
+        logging.warning(f"Користувач {message.from_user.id} намагався перевірити статистику без прав")
+
+# Текущее состояние очередей и кеша для /metrics
+def collect_metrics():
+    values = []
+    for name, value in outgoing.metrics().items():
+        if isinstance(value, dict):
+            values.extend((f'outbox_{name}', 'gauge', {'priority': priority}, count) for priority, count in value.items())
+        else:
+            values.append((f'outbox_{name}', 'gauge', {}, value))
+    values.extend(('jobs', 'gauge', {'status': status}, count) for status, count in database.get_job_counts().items())
+    for name, cache_stats in cache.stats().items():
+        values.extend((f'cache_{key}', 'gauge', {'cache': name}, value) for key, value in cache_stats.items())
+    return values
+
+metrics.add_collector(collect_metrics)
+
+@bot.message_handler(commands=['metrics'])
+def send_metrics(message):
+    if message.from_user.id in config.ADMIN_NAMES:
+        for text in reports.split_messages("", metrics.format_summary().split('\n\n')):
+            send_message(message.chat.id, text)
+        logging.info(f"Адміністратор {message.from_user.id} переглянув метрики")
+    else:
+        send_message(message.chat.id, "⛔️ У вас немає прав для перегляду метрик.")
+        logging.warning(f"Користувач {message.from_user.id} намагався переглянути метрики без прав")
+
+@bot.callback_query_handler(func=lambda call: True)
+def handle_callback(call):
+    router.dispatch(call)
+
+# Ответы на шаги диалогов. Обработчик зарегистрирован последним, поэтому
+# команды обрабатываются своими обработчиками и во время диалога.
+@bot.message_handler(func=lambda message: True, content_types=['text', 'photo', 'document'])
+def handle_conversation_step(message):
+    dialogs.dispatch(message)
+
+# Замер времени всех обработчиков; вызывается после регистрации обработчиков
+metrics.instrument_bot(bot)
+
 if __name__ == "__main__":
     run_scheduler()
-    bot.polling(none_stop=True)
+    job_queue.start()
+    if getattr(config, 'METRICS_PORT', None):
+        metrics.start_http_server(config.METRICS_PORT, getattr(config, 'METRICS_HOST', '127.0.0.1'))
+    if getattr(config, 'WEBHOOK_URL', None):
+        webhook.run(bot, config.WEBHOOK_URL,
+                    host=getattr(config, 'WEBHOOK_HOST', '0.0.0.0'),
+                    port=getattr(config, 'WEBHOOK_PORT', 8443),
+                    secret=getattr(config, 'WEBHOOK_SECRET', None),
+                    workers=getattr(config, 'WEBHOOK_WORKERS', webhook.WEBHOOK_WORKERS))
+    else:
+        # Telegram не выдает обновления через getUpdates, пока установлен вебхук
+        bot.remove_webhook()
+        bot.polling(none_stop=True)
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+
+import database
+
+# Размеры и время жизни кешей. Время жизни ограничивает устаревание данных,
+# измененных другим процессом с той же базой: изменения из этого процесса
+# сбрасывают записи сразу.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 10 * 60
+REQUEST_CACHE_SIZE = 10000
+REQUEST_CACHE_TTL = 5 * 60
+
+_MISSING = object()
+
+
+# Кеш с вытеснением давно не использованных записей (LRU) и временем жизни.
+# Значение None тоже кешируется: например, незарегистрированный пользователь
+# не приводит к запросу в базу на каждое сообщение.
+class Cache:
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Номер сброса: значение, загруженное до сброса, в кеш не попадает
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Чтение через кеш: при промахе значение загружается loader(key)
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+        value = loader(key)
+        with self._lock:
+            if generation == self._generation:
+                self._store(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else None,
+            }
+
+
+# Профили пользователей (имя, телефон, город) по user_id
+user_profiles = Cache('users', USER_CACHE_SIZE, USER_CACHE_TTL)
+# Записи заявок с именем автора (результат database.get_request_info) по id
+request_records = Cache('requests', REQUEST_CACHE_SIZE, REQUEST_CACHE_TTL)
+
+
+def _copy(value):
+    return dict(value) if value is not None else None
+
+
+# Функция для получения профиля пользователя. Возвращает None, если
+# пользователь не зарегистрирован.
+def get_user_profile(user_id):
+    return _copy(user_profiles.get(user_id, database.get_user_info))
+
+def is_user_registered(user_id):
+    return user_profiles.get(user_id, database.get_user_info) is not None
+
+def get_request(request_id):
+    return _copy(request_records.get(request_id, database.get_request_info))
+
+# Функции записи: изменение в базе и сброс соответствующей записи кеша
+def add_user(user_id, name, phone, city):
+    try:
+        database.add_user(user_id, name, phone, city)
+    finally:
+        user_profiles.invalidate(user_id)
+
+def update_request_status(request_id, status, comment=None, admin_id=None):
+    try:
+        database.update_request_status(request_id, status, comment, admin_id)
+    finally:
+        request_records.invalidate(request_id)
+
+def decide_request(request_id, status, comment=None, admin_id=None):
+    try:
+        return database.decide_request(request_id, status, comment, admin_id)
+    finally:
+        request_records.invalidate(request_id)
+
+def bulk_update_request_status(request_ids, status, admin_id, criteria=None):
+    request_ids = list(request_ids)
+    try:
+        return database.bulk_update_request_status(request_ids, status, admin_id, criteria)
+    finally:
+        for request_id in request_ids:
+            request_records.invalidate(request_id)
+
+def stats():
+    return {cache.name: cache.stats() for cache in (user_profiles, request_records)}
@@ -0,0 +1,151 @@
+import base64
+import binascii
+import inspect
+import logging
+
+import metrics
+
+# Компактный формат callback_data: PREFIX + base64url(код действия, аргументы),
+# где аргументы - неотрицательные целые в кодировке varint. Telegram допускает
+# не больше 64 байт, поэтому текст (комментарии, суммы) в кнопки не пишется:
+# он хранится на сервере, а кнопка несет только короткий ключ.
+PREFIX = '~'
+MAX_LENGTH = 64
+
+# Коды действий записаны в кнопках уже отправленных сообщений, поэтому
+# существующие коды не меняются, новые добавляются с новыми номерами
+REGISTER = 1
+MAKE_REQUEST = 2
+SKIP_FILE = 3
+APPROVE = 4
+APPROVE_WITH_COMMENT = 5
+REJECT = 6
+ACTIVE_PAGE = 7
+BULK_PAGE = 8
+BULK_TOGGLE = 9
+BULK_APPLY = 10
+BULK_CANCEL = 11
+BULK_CONFIRM = 12
+
+# Кнопки, отправленные до перехода на компактный формат
+LEGACY_ACTIONS = {
+    'register': REGISTER,
+    'make_request': MAKE_REQUEST,
+    'skip_file': SKIP_FILE,
+    'active_page': ACTIVE_PAGE,
+    'approve_without_comment': APPROVE,
+    'approve_with_comment': APPROVE_WITH_COMMENT,
+    'reject': REJECT,
+}
+
+
+def _pack_varint(value, out):
+    if value < 0:
+        raise ValueError(f"Від'ємне значення в callback_data: {value}")
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _unpack_varints(data):
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value = shift = 0
+    if shift:
+        raise ValueError("Обрізане значення в callback_data")
+    return values
+
+
+# Функция для кодирования действия и целых аргументов в callback_data
+def encode(action, *args):
+    out = bytearray()
+    for value in (action, *args):
+        _pack_varint(int(value), out)
+    data = PREFIX + base64.urlsafe_b64encode(bytes(out)).decode().rstrip('=')
+    if len(data) > MAX_LENGTH:
+        raise ValueError(f"callback_data довша за {MAX_LENGTH} символів: {data}")
+    return data
+
+
+# Функция для разбора callback_data. Возвращает (код действия, аргументы).
+def decode(data):
+    if data.startswith(PREFIX):
+        payload = data[len(PREFIX):]
+        try:
+            raw = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+        except (binascii.Error, ValueError):
+            raise ValueError(f"Некоректні callback_data: {data}") from None
+        values = _unpack_varints(raw)
+        if not values:
+            raise ValueError(f"Порожні callback_data: {data}")
+        return values[0], values[1:]
+    return _decode_legacy(data)
+
+
+# Старые кнопки: 'register', 'approve_without_comment_15', 'active_page|...'.
+# Данные после '|' (черновик заявки, ключ страницы) не используются: черновик
+# берется из диалога, а список открывается с первой страницы.
+def _decode_legacy(data):
+    name = data.split('|', 1)[0]
+    if name in LEGACY_ACTIONS:
+        return LEGACY_ACTIONS[name], []
+    name, _, request_id = name.rpartition('_')
+    if name in LEGACY_ACTIONS and request_id.isdigit():
+        return LEGACY_ACTIONS[name], [int(request_id)]
+    raise ValueError(f"Невідомі callback_data: {data}")
+
+
+# Допустимое число аргументов кнопки для обработчика (без call):
+# (минимум, максимум или None, если обработчик принимает *args)
+def _arity(handler):
+    parameters = list(inspect.signature(handler).parameters.values())[1:]
+    positional = [p for p in parameters if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    required = sum(1 for p in positional if p.default is p.empty)
+    if any(p.kind == p.VAR_POSITIONAL for p in parameters):
+        return required, None
+    return required, len(positional)
+
+
+# Маршрутизация нажатий кнопок: обработчик выбирается по коду действия одним
+# поиском в словаре и получает аргументы кнопки после call
+class CallbackRouter:
+    def __init__(self):
+        self._handlers = {}
+
+    # Декоратор для регистрации обработчика действия. Время обработчика
+    # замеряется отдельно для каждого действия.
+    def action(self, code):
+        def decorator(handler):
+            self._handlers[code] = (metrics.timed(metrics.HANDLER, f'callback:{handler.__name__}')(handler), _arity(handler))
+            return handler
+        return decorator
+
+    # Вызов обработчика нажатия. Для асинхронных обработчиков возвращается
+    # корутина, которую нужно дождаться.
+    def dispatch(self, call):
+        try:
+            action, args = decode(call.data or '')
+        except ValueError as e:
+            logging.warning(f"Натискання кнопки від {call.from_user.id} не розпізнано: {e}")
+            return None
+        if action not in self._handlers:
+            logging.warning(f"Немає обробника для дії {action} від {call.from_user.id}")
+            return None
+        handler, (min_args, max_args) = self._handlers[action]
+        # Устаревшая или подделанная кнопка с другим числом аргументов
+        if len(args) < min_args or (max_args is not None and len(args) > max_args):
+            logging.warning(f"Натискання кнопки від {call.from_user.id} не розпізнано: "
+                            f"дія {action} з {len(args)} аргументами")
+            return None
+        metrics.inc('callbacks_total', action=handler.__name__)
+        return handler(call, *args)
@@ -0,0 +1,166 @@
+"""Проверка планов запросов database.py.
+
+Запуск:
+    python check_query_plans.py
+
+Скрипт создает временную базу с синтетическими данными, вызывает каждую
+публичную функцию database.py, перехватывает выполненные ею SQL-запросы и
+прогоняет их через EXPLAIN QUERY PLAN. Если какой-либо запрос читает таблицу
+полным сканированием без индекса, скрипт завершается с кодом 1.
+"""
+import inspect
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+# Аргументы для вызова функций database.py. Новая публичная функция должна
+# быть добавлена сюда, иначе проверка завершится ошибкой.
+SAMPLE_USER_ID = 100001
+CALLS = {
+    'is_user_registered': lambda db: db.is_user_registered(SAMPLE_USER_ID),
+    'add_user': lambda db: db.add_user(999999, "Перевірка", "+380000000000", "Київ"),
+    'add_request': lambda db: db.add_request(SAMPLE_USER_ID, 100, "Перевірка"),
+    'decide_request': lambda db: db.decide_request(2, "Відхилено", None, SAMPLE_USER_ID),
+    'update_request_status': lambda db: db.update_request_status(1, "Погоджено", "Перевірка"),
+    'get_request_info': lambda db: db.get_request_info(1),
+    'get_request_history': lambda db: db.get_request_history(1),
+    # Архив до середины 2024 года: часть заявок остается в рабочей таблице
+    'archive_requests': lambda db: db.archive_requests((datetime.utcnow() - datetime(2024, 7, 1)).days),
+    'get_archive_summary': lambda db: db.get_archive_summary(),
+    'get_active_requests': lambda db: db.get_active_requests(SAMPLE_USER_ID),
+    'get_user_info': lambda db: db.get_user_info(SAMPLE_USER_ID),
+    'get_next_request_number': lambda db: db.get_next_request_number(SAMPLE_USER_ID),
+    'get_all_active_requests': lambda db: db.get_all_active_requests(),
+    'get_total_requests': lambda db: db.get_total_requests(),
+    'get_approved_requests': lambda db: db.get_approved_requests(),
+    'get_rejected_requests': lambda db: db.get_rejected_requests(),
+    'get_total_amount': lambda db: db.get_total_amount(),
+    'get_schema_version': lambda db: db.get_schema_version(),
+    'rebuild_request_counters': lambda db: db.rebuild_request_counters(db.get_connection()),
+    'get_active_requests_page': lambda db: db.get_active_requests_page(('2024-06-01 00:00:00', 1), 20, created_before='2024-12-01 00:00:00'),
+    'iter_active_requests': lambda db: list(db.iter_active_requests(50, created_after='2024-06-01 00:00:00')),
+    'get_active_requests_count': lambda db: db.get_active_requests_count(),
+    'get_bot_state': lambda db: db.get_bot_state('last_reminder_at'),
+    'set_bot_state': lambda db: db.set_bot_state('last_reminder_at', '2024-06-01 00:00:00'),
+    'get_stats_summary': lambda db: db.get_stats_summary(),
+    'get_stats_by_period': lambda db: db.get_stats_by_period('2024-03-01', '2024-03-31'),
+    'get_stats_by_city': lambda db: db.get_stats_by_city('2024-03-01', '2024-03-31'),
+    'get_average_decision_time': lambda db: db.get_average_decision_time(date_from='2024-03-01'),
+    'verify_stats': lambda db: db.verify_stats(),
+    'rebuild_request_stats': lambda db: db.rebuild_request_stats(db.get_connection()),
+    'get_conversation': lambda db: db.get_conversation(SAMPLE_USER_ID, 3600),
+    'set_conversation': lambda db: db.set_conversation(SAMPLE_USER_ID, 'request_amount', '{}'),
+    'delete_conversation': lambda db: db.delete_conversation(SAMPLE_USER_ID),
+    'delete_expired_conversations': lambda db: db.delete_expired_conversations(3600),
+    'register_file': lambda db: db.register_file('0' * 64, 'uploads/00/00/' + '0' * 64 + '.pdf', 10, 'check.pdf'),
+    'get_file': lambda db: db.get_file('uploads/00/00/' + '0' * 64 + '.pdf'),
+    'set_file_telegram_id': lambda db: db.set_file_telegram_id('uploads/00/00/' + '0' * 64 + '.pdf', 'file-1', 'document'),
+    'get_unreferenced_files': lambda db: db.get_unreferenced_files(3600),
+    'delete_file': lambda db: db.delete_file('0' * 64, 3600),
+    'enqueue_job': lambda db: db.enqueue_job('export', '{}', SAMPLE_USER_ID),
+    'claim_job': lambda db: db.claim_job('perf-check'),
+    'complete_job': lambda db: db.complete_job(1, '{}'),
+    'fail_job': lambda db: db.fail_job(1, 'Перевірка', 5),
+    'get_job': lambda db: db.get_job(1),
+    'heartbeat_jobs': lambda db: db.heartbeat_jobs('perf-check'),
+    'get_next_job_delay': lambda db: db.get_next_job_delay(),
+    'get_job_counts': lambda db: db.get_job_counts(),
+    'requeue_stale_jobs': lambda db: db.requeue_stale_jobs(300),
+    'delete_finished_jobs': lambda db: db.delete_finished_jobs(3600),
+    'start_import': lambda db: db.start_import('1' * 64, 'check.xlsx'),
+    'start_import_job': lambda db: db.start_import_job('3' * 64, 'check.xlsx', 'import', 'imports/check.xlsx', SAMPLE_USER_ID),
+    'get_import': lambda db: db.get_import(1),
+    'import_requests_batch': lambda db: db.import_requests_batch(
+        db.start_import('2' * 64)['id'], [("Імпорт", "+380000000001", 100, "Перевірка", None, "Погоджено", "2024-01-01 10:00:00")], 1),
+    'finish_import': lambda db: db.finish_import(1, 'done'),
+    'toggle_bulk_selection': lambda db: db.toggle_bulk_selection(SAMPLE_USER_ID, 1, 1),
+    'get_bulk_selection': lambda db: db.get_bulk_selection(SAMPLE_USER_ID, 1),
+    'clear_bulk_selection': lambda db: db.clear_bulk_selection(SAMPLE_USER_ID, 1),
+    'get_active_requests_below': lambda db: db.get_active_requests_below(1000),
+    'get_active_request_ids_below': lambda db: db.get_active_request_ids_below(1000, 5000),
+    'bulk_update_request_status': lambda db: db.bulk_update_request_status([1, 2, 3], "Погоджено", SAMPLE_USER_ID, {'selected': 3}),
+    'get_bulk_actions': lambda db: db.get_bulk_actions(),
+    'get_bulk_action_requests': lambda db: db.get_bulk_action_requests(1),
+    'export_requests_to_excel': lambda db: db.export_requests_to_excel(os.path.join(os.path.dirname(db.DB_PATH), 'check.xlsx'), status="Погоджено"),
+}
+
+# Функции, которым полный проход по таблице нужен по смыслу
+FULL_SCAN_ALLOWED = {
+    'get_total_amount',
+    'export_requests_to_excel',
+    'rebuild_request_counters',
+    'rebuild_request_stats',
+    'verify_stats',
+    # Сводные таблицы содержат не больше строки на статус, день и город
+    'get_total_requests',
+    'get_stats_summary',
+    'get_stats_by_city',
+    # Проход по первичному ключу в обратном порядке останавливается после LIMIT строк
+    'get_bulk_actions',
+}
+
+# Служебные функции, не выполняющие запросов к данным
+SKIPPED = {'create_tables', 'migrate', 'apply_pragmas', 'get_connection', 'set_trace_callback', 'transaction', 'close_connections',
+           'is_imported_user'}
+
+
+# Функция для определения полного сканирования таблицы по строке плана
+def is_full_scan(detail):
+    # SQLite < 3.36 пишет "SCAN TABLE x", новые версии - "SCAN x". Схема базы
+    # (sqlite_master) читается целиком при поиске архивных таблиц, она мала.
+    return detail.startswith('SCAN') and 'INDEX' not in detail and 'sqlite_master' not in detail
+
+
+def collect_plans(db, name):
+    statements = []
+    db.set_trace_callback(statements.append)
+    try:
+        CALLS[name](db)
+    finally:
+        db.set_trace_callback(None)
+
+    plans = []
+    for statement in statements:
+        keyword = statement.lstrip().split(None, 1)[0].upper()
+        if keyword not in ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH'):
+            continue
+        rows = db.get_connection().execute("EXPLAIN QUERY PLAN " + statement).fetchall()
+        plans.append((statement, [row[-1] for row in rows]))
+    return plans
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'plans.db')
+        os.environ['FINANCE_BOT_DB'] = db_path
+        import benchmark
+        import database
+
+        benchmark.generate_synthetic_db(db_path, 5000, users=200)
+        database.get_connection().execute("ANALYZE")
+
+        public = [
+            name for name, value in inspect.getmembers(database, inspect.isfunction)
+            if value.__module__ == database.__name__ and not name.startswith('_') and name not in SKIPPED
+        ]
+        failures = []
+        for name in sorted(public):
+            if name not in CALLS:
+                failures.append(f"{name}: немає аргументів для перевірки в CALLS")
+                continue
+            for statement, details in collect_plans(database, name):
+                for detail in details:
+                    if is_full_scan(detail) and name not in FULL_SCAN_ALLOWED:
+                        failures.append(f"{name}: {detail}\n    {' '.join(statement.split())}")
+            print(f"OK {name}" if not any(f.startswith(name + ':') for f in failures) else f"FAIL {name}")
+
+        if failures:
+            print("\nПовне сканування таблиць:")
+            for failure in failures:
+                print("  " + failure)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
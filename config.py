@@ -6,3 +6,38 @@ UPLOAD_FOLDER = "uploads"
 ADMIN_NAMES = {
     
 }
+
+# Нагадування про активні заявки: True - лише нові та прострочені з минулого
+# нагадування (плюс загальна кількість активних), False - повний список
+REMINDER_INCREMENTAL = False
+REMINDER_AGING_HOURS = 24
+
+# Незавершені діалоги (реєстрація, створення запиту) забуваються через цей час
+CONVERSATION_TTL_HOURS = 24
+
+# Фонові завдання (експорт, обробка файлів): кількість потоків і процесів
+JOB_WORKERS = 4
+JOB_PROCESSES = 1
+
+# Вирішені запити, старші за цю кількість днів, щоночі переносяться в
+# помісячні архівні таблиці (0 - не переносити)
+ARCHIVE_AFTER_DAYS = 365
+
+# Режим вебхука: якщо WEBHOOK_URL задано, бот отримує оновлення через HTTP
+# замість опитування. Адреса має бути HTTPS (через зворотний проксі), сервер
+# бота слухає WEBHOOK_HOST:WEBHOOK_PORT
+WEBHOOK_URL = None
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET = None
+WEBHOOK_WORKERS = 8
+
+# Журнал: запис у файл окремим потоком (LOG_ASYNC) і формат JSON (LOG_JSON)
+LOG_ASYNC = True
+LOG_JSON = False
+# Запити до бази, довші за цей час (мс), записуються в журнал
+SLOW_QUERY_MS = 100
+# Метрики у форматі Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+# (None - не запускати)
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
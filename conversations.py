@@ -0,0 +1,111 @@
+import json
+import logging
+import threading
+import time
+
+import database
+import metrics
+
+# Диалог, в котором пользователь не отвечал дольше этого времени, забывается
+CONVERSATION_TTL = 24 * 60 * 60
+
+
+# Хранилище состояний в SQLite: состояние переживает перезапуск бота и общее
+# для нескольких процессов, работающих с одной базой
+class SQLiteConversationStore:
+    def get(self, chat_id, max_age):
+        conversation = database.get_conversation(chat_id, max_age)
+        if conversation is None:
+            return None
+        return conversation['state'], json.loads(conversation['data'])
+
+    def set(self, chat_id, state, data):
+        database.set_conversation(chat_id, state, json.dumps(data, ensure_ascii=False))
+
+    def delete(self, chat_id):
+        database.delete_conversation(chat_id)
+
+    def delete_expired(self, max_age):
+        return database.delete_expired_conversations(max_age)
+
+
+# Хранилище состояний в памяти процесса (для одного процесса без перезапусков)
+class MemoryConversationStore:
+    def __init__(self):
+        self._conversations = {}
+        self._lock = threading.Lock()
+
+    def get(self, chat_id, max_age):
+        with self._lock:
+            conversation = self._conversations.get(chat_id)
+        if conversation is None or time.monotonic() - conversation[2] >= max_age:
+            return None
+        return conversation[0], dict(conversation[1])
+
+    def set(self, chat_id, state, data):
+        with self._lock:
+            self._conversations[chat_id] = (state, dict(data), time.monotonic())
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._conversations.pop(chat_id, None)
+
+    def delete_expired(self, max_age):
+        now = time.monotonic()
+        with self._lock:
+            expired = [chat_id for chat_id, conversation in self._conversations.items() if now - conversation[2] >= max_age]
+            for chat_id in expired:
+                del self._conversations[chat_id]
+        return len(expired)
+
+
+# Конечный автомат диалогов. Для каждого чата хранится текущий шаг и данные,
+# собранные на предыдущих шагах; обработчик шага получает сообщение и эти
+# данные и сам переводит диалог на следующий шаг через set() или завершает
+# его через finish(). Обработка сообщения - одно чтение состояния по ключу.
+class Conversations:
+    def __init__(self, store=None, ttl=CONVERSATION_TTL):
+        self.store = store if store is not None else SQLiteConversationStore()
+        self.ttl = ttl
+        self._handlers = {}
+
+    # Декоратор для регистрации обработчика шага. Время обработчика
+    # замеряется отдельно для каждого шага.
+    def step(self, state):
+        def decorator(handler):
+            self._handlers[state] = metrics.timed(metrics.HANDLER, f'step:{state}')(handler)
+            return handler
+        return decorator
+
+    def get(self, chat_id):
+        return self.store.get(chat_id, self.ttl)
+
+    def set(self, chat_id, state, **data):
+        if state not in self._handlers:
+            raise ValueError(f"Невідомий крок діалогу: {state}")
+        self.store.set(chat_id, state, data)
+
+    def finish(self, chat_id):
+        self.store.delete(chat_id)
+
+    # Передача сообщения обработчику текущего шага. Возвращает False, если
+    # в чате нет активного диалога.
+    def dispatch(self, message):
+        conversation = self.get(message.chat.id)
+        if conversation is None:
+            return False
+        state, data = conversation
+        handler = self._handlers.get(state)
+        if handler is None:
+            logging.warning(f"Невідомий крок діалогу {state} у чаті {message.chat.id}, діалог завершено")
+            self.finish(message.chat.id)
+            return False
+        handler(message, data)
+        return True
+
+    # Удаление просроченных диалогов
+    def cleanup(self):
+        removed = self.store.delete_expired(self.ttl)
+        if removed:
+            logging.info(f"Видалено {removed} покинутих діалогів")
+        return removed
@@ -1,22 +1,158 @@
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import queue
 import sqlite3
-import pandas as pd
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
-from openpyxl.utils.dataframe import dataframe_to_rows
 
-# Подключение к базе данных
-conn = sqlite3.connect('users.db', check_same_thread=False)
-cursor = conn.cursor()
+import metrics
 
-def create_tables():
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+# Путь к базе данных можно переопределить через переменную окружения
+DB_PATH = os.environ.get('FINANCE_BOT_DB', 'users.db')
+
+# Статусы заявок; для итоговых статусов фиксируется время решения
+STATUS_PENDING = 'В обробці'
+STATUS_APPROVED = 'Погоджено'
+STATUS_REJECTED = 'Відхилено'
+DECIDED_STATUSES = (STATUS_APPROVED, STATUS_REJECTED)
+
+# Параметры экспорта в Excel
+EXPORT_COLUMNS = ['id', 'Имя', 'Телефон', 'Сумма', 'Комментарий', 'Файл', 'Статус', 'Номер запроса', 'Дата создания']
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_MAX_COLUMN_WIDTH = 60
+
+# Архив решенных заявок: давно решенные заявки переносятся из requests в
+# помесячные таблицы requests_archive_ГГГГ_ММ (по месяцу создания), чтобы
+# рабочая таблица оставалась небольшой. Представление all_requests
+# объединяет requests и все архивные таблицы для отчетов.
+ARCHIVE_TABLE_PREFIX = 'requests_archive_'
+ARCHIVE_BATCH_SIZE = 1000
+ALL_REQUESTS_VIEW = 'all_requests'
+# Столбцы заявки в requests и в архивных таблицах. Миграция, добавляющая
+# столбец в requests, должна добавить его и в существующие архивные таблицы.
+_REQUEST_COLUMNS = 'id, user_id, amount, comment, file_path, status, request_number, created_at, decided_at, admin_comment, decided_by'
+
+# Максимальное число операций записи, объединяемых в одну транзакцию
+WRITE_BATCH_SIZE = 64
+
+# Соединения с базой данных создаются отдельно для каждого потока, так как
+# обработчики бота и планировщик не должны делить один курсор
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_trace_callback = None
+
+# Все изменения данных выполняет один поток записи
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+# Настройки соединения, применяемые при каждом подключении
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+]
+
+# Функция для перенумерации заявок, получивших одинаковый номер при
+# одновременной отправке. Первая заявка сохраняет номер, остальные получают
+# следующие свободные номера пользователя.
+def _renumber_duplicate_requests(connection):
+    duplicates = connection.execute('''SELECT id, user_id FROM requests
+                                        WHERE EXISTS (SELECT 1 FROM requests AS earlier
+                                                      WHERE earlier.user_id = requests.user_id
+                                                        AND earlier.request_number = requests.request_number
+                                                        AND earlier.id < requests.id)
+                                        ORDER BY id''').fetchall()
+    for request_id, user_id in duplicates:
+        connection.execute("UPDATE requests SET request_number = (SELECT MAX(request_number) FROM requests WHERE user_id = ?) + 1 WHERE id = ?",
+                           (user_id, request_id))
+
+# Функция для получения имен архивных таблиц в порядке месяцев
+def _archive_tables(connection):
+    cursor = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ? ORDER BY name",
+                                (ARCHIVE_TABLE_PREFIX + '[0-9]*',))
+    return [row[0] for row in cursor.fetchall()]
+
+# Функция для пересоздания представления all_requests по текущему списку
+# архивных таблиц
+def _create_all_requests_view(connection):
+    selects = [f"SELECT {_REQUEST_COLUMNS} FROM {table}" for table in ['requests'] + _archive_tables(connection)]
+    connection.execute(f"DROP VIEW IF EXISTS {ALL_REQUESTS_VIEW}")
+    connection.execute(f"CREATE VIEW {ALL_REQUESTS_VIEW} AS " + " UNION ALL ".join(selects))
+
+# Таблица или представление со всеми заявками для пересчетов: до миграции 11
+# архива еще нет
+def _all_requests_source(connection):
+    cursor = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?", (ALL_REQUESTS_VIEW,))
+    return ALL_REQUESTS_VIEW if cursor.fetchone() else 'requests'
+
+# Функция для пересчета счетчиков номеров заявок по всем заявкам, включая архив
+def rebuild_request_counters(connection):
+    connection.execute(f'''INSERT OR REPLACE INTO request_counters (user_id, last_number)
+                           SELECT user_id, MAX(request_number) FROM {_all_requests_source(connection)}
+                           WHERE request_number IS NOT NULL GROUP BY user_id''')
+
+# Функция для пересчета сводной статистики по всем заявкам, включая архив.
+# Заявки без решения не участвуют в расчете среднего времени решения.
+def rebuild_request_stats(connection):
+    source = _all_requests_source(connection)
+    connection.execute("DELETE FROM request_stats")
+    connection.execute("DELETE FROM request_totals")
+    connection.execute(f'''INSERT INTO request_stats (day, city, status, request_count, amount_sum, decision_count, decision_seconds)
+                          SELECT day, city, status, COUNT(*), TOTAL(amount), COUNT(decided_at), TOTAL(decision_seconds)
+                          FROM (SELECT date(requests.created_at) AS day, COALESCE(users.city, '') AS city, requests.status,
+                                       requests.amount, requests.decided_at,
+                                       (julianday(requests.decided_at) - julianday(requests.created_at)) * 86400 AS decision_seconds
+                                FROM {source} AS requests LEFT JOIN users ON users.user_id = requests.user_id)
+                          GROUP BY day, city, status''')
+    connection.execute('''INSERT INTO request_totals (status, request_count, amount_sum, decision_count, decision_seconds)
+                          SELECT status, SUM(request_count), SUM(amount_sum), SUM(decision_count), SUM(decision_seconds)
+                          FROM request_stats GROUP BY status''')
+
+# Выражения для триггеров сводной статистики
+_STATS_CITY = "COALESCE((SELECT city FROM users WHERE user_id = {row}.user_id), '')"
+_STATS_DECISION_SECONDS = "COALESCE((julianday({row}.decided_at) - julianday({row}.created_at)) * 86400, 0)"
+
+# Функция для построения запроса, прибавляющего заявку row к сводным таблицам
+# (sign = -1 вычитает заявку при смене статуса)
+def _stats_upsert(row, sign):
+    city = _STATS_CITY.format(row=row)
+    seconds = _STATS_DECISION_SECONDS.format(row=row)
+    values = f"{sign}, {sign} * COALESCE({row}.amount, 0), {sign} * ({row}.decided_at IS NOT NULL), {sign} * {seconds}"
+    update = '''DO UPDATE SET request_count = request_count + excluded.request_count,
+                              amount_sum = amount_sum + excluded.amount_sum,
+                              decision_count = decision_count + excluded.decision_count,
+                              decision_seconds = decision_seconds + excluded.decision_seconds'''
+    return f'''INSERT INTO request_stats (day, city, status, request_count, amount_sum, decision_count, decision_seconds)
+                VALUES (date({row}.created_at), {city}, {row}.status, {values})
+                ON CONFLICT (day, city, status) {update};
+              INSERT INTO request_totals (status, request_count, amount_sum, decision_count, decision_seconds)
+                VALUES ({row}.status, {values})
+                ON CONFLICT (status) {update};'''
+
+# Версионированные миграции схемы. Номер последней примененной миграции
+# хранится в PRAGMA user_version, поэтому существующая база обновляется на месте.
+MIGRATIONS = [
+    # 1: исходная схема
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
                         id INTEGER PRIMARY KEY,
                         user_id INTEGER UNIQUE,
                         name TEXT,
                         phone TEXT,
                         city TEXT
-                    )''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS requests (
+                    )''',
+        '''CREATE TABLE IF NOT EXISTS requests (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         user_id INTEGER,
                         amount INTEGER,
@@ -24,42 +160,421 @@ def create_tables():
                         file_path TEXT,
                         status TEXT DEFAULT 'В обробці',
                         request_number INTEGER,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Добавляем столбец для даты создания
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         FOREIGN KEY (user_id) REFERENCES users(user_id)
-                    )''')
-    conn.commit()
+                    )''',
+    ],
+    # 2: индексы для выборок по пользователю и статусу
+    [
+        "CREATE INDEX IF NOT EXISTS idx_requests_user_status ON requests (user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_requests_status_created ON requests (status, created_at)",
+        "ANALYZE",
+    ],
+    # 3: счетчик номеров заявок по пользователям и уникальность номера
+    [
+        "CREATE TABLE IF NOT EXISTS request_counters (user_id INTEGER PRIMARY KEY, last_number INTEGER NOT NULL)",
+        _renumber_duplicate_requests,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_requests_user_number ON requests (user_id, request_number)",
+        rebuild_request_counters,
+    ],
+    # 4: служебные значения бота (например, время последнего напоминания)
+    [
+        "CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value TEXT)",
+    ],
+    # 5: время решения по заявке и сводная статистика, которую ведут триггеры.
+    # Удаление заявок статистику не меняет: она учитывает все заявки за все время.
+    [
+        "ALTER TABLE requests ADD COLUMN decided_at TIMESTAMP",
+        '''CREATE TABLE IF NOT EXISTS request_stats (
+                        day TEXT NOT NULL,
+                        city TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        request_count INTEGER NOT NULL DEFAULT 0,
+                        amount_sum INTEGER NOT NULL DEFAULT 0,
+                        decision_count INTEGER NOT NULL DEFAULT 0,
+                        decision_seconds REAL NOT NULL DEFAULT 0,
+                        PRIMARY KEY (day, city, status)
+                    ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS request_totals (
+                        status TEXT PRIMARY KEY,
+                        request_count INTEGER NOT NULL DEFAULT 0,
+                        amount_sum INTEGER NOT NULL DEFAULT 0,
+                        decision_count INTEGER NOT NULL DEFAULT 0,
+                        decision_seconds REAL NOT NULL DEFAULT 0
+                    ) WITHOUT ROWID''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_requests_stats_insert AFTER INSERT ON requests
+            BEGIN
+                {_stats_upsert('NEW', 1)}
+            END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_requests_stats_update AFTER UPDATE OF status, amount, decided_at ON requests
+            BEGIN
+                {_stats_upsert('OLD', -1)}
+                {_stats_upsert('NEW', 1)}
+            END''',
+        rebuild_request_stats,
+    ],
+    # 6: состояние диалогов с пользователями (шаг и собранные данные)
+    [
+        '''CREATE TABLE IF NOT EXISTS conversations (
+                        chat_id INTEGER PRIMARY KEY,
+                        state TEXT NOT NULL,
+                        data TEXT NOT NULL DEFAULT '{}',
+                        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )''',
+        "CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at)",
+    ],
+    # 7: хранилище вложений по SHA-256 содержимого; число заявок, ссылающихся
+    # на файл, ведут триггеры
+    [
+        '''CREATE TABLE IF NOT EXISTS files (
+                        sha256 TEXT PRIMARY KEY,
+                        path TEXT NOT NULL UNIQUE,
+                        size INTEGER NOT NULL,
+                        file_name TEXT,
+                        telegram_file_id TEXT,
+                        telegram_kind TEXT,
+                        ref_count INTEGER NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )''',
+        "CREATE INDEX IF NOT EXISTS idx_files_unreferenced ON files (ref_count, created_at)",
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_files_insert AFTER INSERT ON requests WHEN NEW.file_path IS NOT NULL
+            BEGIN
+                UPDATE files SET ref_count = ref_count + 1 WHERE path = NEW.file_path;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_files_delete AFTER DELETE ON requests WHEN OLD.file_path IS NOT NULL
+            BEGIN
+                UPDATE files SET ref_count = ref_count - 1 WHERE path = OLD.file_path;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_files_update AFTER UPDATE OF file_path ON requests
+            WHEN OLD.file_path IS NOT NEW.file_path
+            BEGIN
+                UPDATE files SET ref_count = ref_count - 1 WHERE path = OLD.file_path;
+                UPDATE files SET ref_count = ref_count + 1 WHERE path = NEW.file_path;
+            END''',
+    ],
+    # 8: очередь фоновых задач (экспорт, обработка файлов)
+    [
+        '''CREATE TABLE IF NOT EXISTS jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        payload TEXT NOT NULL DEFAULT '{}',
+                        chat_id INTEGER,
+                        status TEXT NOT NULL DEFAULT 'queued',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        max_attempts INTEGER NOT NULL DEFAULT 3,
+                        run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        result TEXT,
+                        error TEXT,
+                        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )''',
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)",
+    ],
+    # 9: импорт заявок из файлов экспорта с сохранением прогресса для
+    # продолжения после остановки; пользователи из файла ищутся по телефону
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_phone ON users (phone)",
+        '''CREATE TABLE IF NOT EXISTS imports (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        sha256 TEXT NOT NULL UNIQUE,
+                        file_name TEXT,
+                        status TEXT NOT NULL DEFAULT 'running',
+                        rows_done INTEGER NOT NULL DEFAULT 0,
+                        rows_imported INTEGER NOT NULL DEFAULT 0,
+                        rows_skipped INTEGER NOT NULL DEFAULT 0,
+                        users_created INTEGER NOT NULL DEFAULT 0,
+                        errors TEXT NOT NULL DEFAULT '[]',
+                        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )''',
+    ],
+    # 10: массовые решения по заявкам: журнал действий с перечнем измененных
+    # заявок и заявки, отмеченные администратором в списке
+    [
+        '''CREATE TABLE IF NOT EXISTS bulk_actions (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        admin_id INTEGER NOT NULL,
+                        status TEXT NOT NULL,
+                        criteria TEXT NOT NULL DEFAULT '{}',
+                        request_count INTEGER NOT NULL DEFAULT 0,
+                        amount_sum INTEGER NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )''',
+        '''CREATE TABLE IF NOT EXISTS bulk_action_requests (
+                        action_id INTEGER NOT NULL REFERENCES bulk_actions (id),
+                        request_id INTEGER NOT NULL,
+                        PRIMARY KEY (action_id, request_id)
+                    ) WITHOUT ROWID''',
+        "CREATE INDEX IF NOT EXISTS idx_bulk_action_requests_request ON bulk_action_requests (request_id)",
+        '''CREATE TABLE IF NOT EXISTS bulk_selections (
+                        chat_id INTEGER NOT NULL,
+                        message_id INTEGER NOT NULL,
+                        request_id INTEGER NOT NULL,
+                        PRIMARY KEY (chat_id, message_id, request_id)
+                    ) WITHOUT ROWID''',
+    ],
+    # 11: комментарий администратора отдельно от комментария автора, история
+    # смен статуса (только добавление, строки ведут триггеры) и представление
+    # all_requests для архива. Для существующих заявок история начинается с
+    # создания и текущего решения.
+    [
+        "ALTER TABLE requests ADD COLUMN admin_comment TEXT",
+        "ALTER TABLE requests ADD COLUMN decided_by INTEGER",
+        '''CREATE TABLE IF NOT EXISTS request_status_history (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        request_id INTEGER NOT NULL,
+                        status TEXT NOT NULL,
+                        previous_status TEXT,
+                        admin_id INTEGER,
+                        comment TEXT,
+                        changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )''',
+        "CREATE INDEX IF NOT EXISTS idx_request_status_history_request ON request_status_history (request_id, id)",
+        '''INSERT INTO request_status_history (request_id, status, changed_at)
+           SELECT id, 'В обробці', COALESCE(created_at, CURRENT_TIMESTAMP) FROM requests ORDER BY id''',
+        '''INSERT INTO request_status_history (request_id, status, previous_status, changed_at)
+           SELECT id, status, 'В обробці', COALESCE(decided_at, created_at, CURRENT_TIMESTAMP) FROM requests
+           WHERE status IS NOT 'В обробці' ORDER BY id''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_history_insert AFTER INSERT ON requests
+            BEGIN
+                INSERT INTO request_status_history (request_id, status, admin_id, comment)
+                VALUES (NEW.id, NEW.status, NEW.decided_by, NEW.admin_comment);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_history_update AFTER UPDATE OF status ON requests
+            WHEN OLD.status IS NOT NEW.status
+            BEGIN
+                INSERT INTO request_status_history (request_id, status, previous_status, admin_id, comment)
+                VALUES (NEW.id, NEW.status, OLD.status, NEW.decided_by, NEW.admin_comment);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_request_status_history_no_update BEFORE UPDATE ON request_status_history
+            BEGIN
+                SELECT RAISE(ABORT, 'request_status_history is append-only');
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_request_status_history_no_delete BEFORE DELETE ON request_status_history
+            BEGIN
+                SELECT RAISE(ABORT, 'request_status_history is append-only');
+            END''',
+        _create_all_requests_view,
+    ],
+    # 12: владелец выполняемой задачи и время его последней отметки: задача
+    # возвращается в очередь, только если владелец перестал отмечаться
+    [
+        "ALTER TABLE jobs ADD COLUMN worker_id TEXT",
+        "ALTER TABLE jobs ADD COLUMN heartbeat_at TIMESTAMP",
+    ],
+    # 13: задача, выполняющая импорт: пока она в очереди или выполняется,
+    # повторная отправка того же файла не запускает второй импорт
+    [
+        "ALTER TABLE imports ADD COLUMN job_id INTEGER",
+    ],
+]
+
+# Функция для применения настроек соединения
+def apply_pragmas(connection):
+    for pragma in PRAGMAS:
+        connection.execute(pragma)
+
+# Функция для получения соединения текущего потока
+def get_connection():
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        # isolation_level=None: транзакции открываются явно в transaction() и в потоке записи
+        connection = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+        apply_pragmas(connection)
+        connection.set_trace_callback(_trace_callback)
+        _local.connection = connection
+        with _connections_lock:
+            _connections.append(connection)
+    return connection
+
+# Функция для установки обработчика трассировки SQL на всех соединениях
+def set_trace_callback(callback):
+    global _trace_callback
+    _trace_callback = callback
+    with _connections_lock:
+        for connection in _connections:
+            connection.set_trace_callback(callback)
+
+# Контекстный менеджер транзакции на соединении текущего потока
+@contextmanager
+def transaction():
+    connection = get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+# Цикл потока записи. Операции, накопившиеся в очереди, выполняются в одной
+# транзакции: каждая в своей точке сохранения, чтобы ошибка одной операции
+# не отменяла остальные, а коммит был один на всю пачку.
+def _writer_loop():
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in batch
+        operations = [item for item in batch if item is not None]
+        if operations:
+            _run_write_batch(operations)
+        if stop:
+            return
+
+def _run_write_batch(operations):
+    connection = get_connection()
+    results = []
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        for func, args, kwargs, future in operations:
+            connection.execute("SAVEPOINT write_operation")
+            try:
+                result = func(connection.cursor(), *args, **kwargs)
+            except Exception as e:
+                connection.execute("ROLLBACK TO write_operation")
+                connection.execute("RELEASE write_operation")
+                results.append((future, None, e))
+            else:
+                connection.execute("RELEASE write_operation")
+                results.append((future, result, None))
+        connection.execute("COMMIT")
+    except Exception as e:
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        for _, _, _, future in operations:
+            future.set_exception(e)
+        return
+
+    # Результаты отдаются только после коммита
+    for future, result, error in results:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+def _start_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name='database-writer', daemon=True)
+            _writer_thread.start()
+
+# Функция для выполнения операции записи в потоке записи. Первым аргументом
+# операция получает курсор открытой транзакции.
+def _execute_write(func, *args, **kwargs):
+    if threading.current_thread() is _writer_thread:
+        return func(get_connection().cursor(), *args, **kwargs)
+    _start_writer()
+    future = Future()
+    _write_queue.put((func, args, kwargs, future))
+    return future.result()
+
+# Функция для остановки потока записи и закрытия всех соединений
+def close_connections():
+    global _writer_thread, _local
+    with _writer_lock:
+        if _writer_thread is not None and _writer_thread.is_alive():
+            _write_queue.put(None)
+            _writer_thread.join()
+        _writer_thread = None
+    with _connections_lock:
+        for connection in _connections:
+            connection.close()
+        _connections.clear()
+    _local = threading.local()
+
+# Функция для получения версии схемы базы данных
+def get_schema_version():
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+# Функция для применения недостающих миграций. Каждая миграция выполняется
+# в отдельной транзакции вместе с обновлением user_version. Шаг миграции -
+# SQL-запрос или функция, получающая соединение.
+def migrate():
+    current_version = get_schema_version()
+    for version, statements in enumerate(MIGRATIONS, 1):
+        if version <= current_version:
+            continue
+        with transaction() as connection:
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {version}")
+    return get_schema_version()
+
+def create_tables():
+    migrate()
 
 # Функция для проверки, зарегистрирован ли пользователь
 def is_user_registered(user_id):
-    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+    cursor = get_connection().execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     return cursor.fetchone() is not None
 
 # Функция для добавления нового пользователя
 def add_user(user_id, name, phone, city):
+    _execute_write(_add_user, user_id, name, phone, city)
+
+def _add_user(cursor, user_id, name, phone, city):
     cursor.execute("INSERT INTO users (user_id, name, phone, city) VALUES (?, ?, ?, ?)", (user_id, name, phone, city))
-    conn.commit()
 
 # Функция для добавления запроса
 def add_request(user_id, amount, comment=None, file_path=None):
-    request_number = get_next_request_number(user_id)
+    return _execute_write(_add_request, user_id, amount, comment, file_path)
+
+def _add_request(cursor, user_id, amount, comment, file_path):
+    # Номер берется из счетчика пользователя в той же транзакции, что и вставка
+    cursor.execute('''INSERT INTO request_counters (user_id, last_number) VALUES (?, 1)
+                      ON CONFLICT (user_id) DO UPDATE SET last_number = last_number + 1''', (user_id,))
+    cursor.execute("SELECT last_number FROM request_counters WHERE user_id = ?", (user_id,))
+    request_number = cursor.fetchone()[0]
     cursor.execute("INSERT INTO requests (user_id, amount, comment, file_path, request_number) VALUES (?, ?, ?, ?, ?)", 
                    (user_id, amount, comment, file_path, request_number))
-    conn.commit()
     request_id = cursor.lastrowid
     return request_id, request_number
 
-# Функция для обновления статуса запроса
-def update_request_status(request_id, status, comment=None):
-    if comment:
-        cursor.execute("UPDATE requests SET status = ?, comment = ? WHERE id = ?", (status, comment, request_id))
-    else:
-        cursor.execute("UPDATE requests SET status = ? WHERE id = ?", (status, request_id))
-    conn.commit()
+# Функция для обновления статуса запроса. comment - комментарий
+# администратора: комментарий автора заявки не меняется, прежние статусы и
+# комментарии остаются в истории.
+def update_request_status(request_id, status, comment=None, admin_id=None):
+    _execute_write(_update_request_status, request_id, status, comment, admin_id)
+
+# Время решения фиксируется при первом переходе в итоговый статус
+def _decided_at_expression(status):
+    return "COALESCE(decided_at, CURRENT_TIMESTAMP)" if status in DECIDED_STATUSES else "NULL"
+
+def _update_request_status(cursor, request_id, status, comment, admin_id):
+    cursor.execute(f'''UPDATE requests SET status = ?, admin_comment = ?, decided_by = ?, decided_at = {_decided_at_expression(status)}
+                       WHERE id = ?''', (status, comment or None, admin_id, request_id))
 
-# Функция для получения информации о запросе
+# Функция для решения по заявке, которая еще в обработке. Проверка статуса и
+# запись - один запрос, поэтому решение другого администратора или массового
+# действия не перезаписывается. Возвращает True, если решение записано.
+def decide_request(request_id, status, comment=None, admin_id=None):
+    return _execute_write(_decide_request, request_id, status, comment, admin_id)
+
+def _decide_request(cursor, request_id, status, comment, admin_id):
+    cursor.execute(f'''UPDATE requests SET status = ?, admin_comment = ?, decided_by = ?, decided_at = {_decided_at_expression(status)}
+                       WHERE id = ? AND status = ?''', (status, comment or None, admin_id, request_id, STATUS_PENDING))
+    return cursor.rowcount == 1
+
+# Функция для получения информации о запросе. Заявка, перенесенная в архив,
+# ищется во всех архивных таблицах.
 def get_request_info(request_id):
-    cursor.execute("SELECT requests.*, users.name FROM requests JOIN users ON requests.user_id = users.user_id WHERE requests.id = ?", (request_id,))
-    result = cursor.fetchone()
+    for source in ('requests', ALL_REQUESTS_VIEW):
+        cursor = get_connection().execute(f'''SELECT requests.id, requests.user_id, requests.amount, requests.comment, requests.file_path,
+                                                    requests.status, requests.request_number, requests.created_at, requests.decided_at,
+                                                    users.name, requests.admin_comment, requests.decided_by
+                                             FROM {source} AS requests JOIN users ON requests.user_id = users.user_id
+                                             WHERE requests.id = ?''', (request_id,))
+        result = cursor.fetchone()
+        if result:
+            break
     if result:
         return {
             'id': result[0],
@@ -70,13 +585,31 @@ def get_request_info(request_id):
             'status': result[5],
             'request_number': result[6],
             'created_at': result[7],
-            'name': result[8]
+            'decided_at': result[8],
+            'name': result[9],
+            'admin_comment': result[10],
+            'decided_by': result[11]
         }
     return None
 
+# Функция для получения истории статусов заявки в порядке изменений
+def get_request_history(request_id):
+    cursor = get_connection().execute('''SELECT status, previous_status, admin_id, comment, changed_at
+                                         FROM request_status_history WHERE request_id = ? ORDER BY id''', (request_id,))
+    return [
+        {
+            'status': row[0],
+            'previous_status': row[1],
+            'admin_id': row[2],
+            'comment': row[3],
+            'changed_at': row[4]
+        }
+        for row in cursor.fetchall()
+    ]
+
 # Функция для получения активных запросов пользователя
 def get_active_requests(user_id):
-    cursor.execute("SELECT request_number, amount, status FROM requests WHERE user_id = ? AND status = 'В обробці'", (user_id,))
+    cursor = get_connection().execute("SELECT request_number, amount, status FROM requests WHERE user_id = ? AND status = 'В обробці'", (user_id,))
     rows = cursor.fetchall()
     requests = []
     for row in rows:
@@ -89,7 +622,7 @@ def get_active_requests(user_id):
 
 # Функция для получения информации о пользователе
 def get_user_info(user_id):
-    cursor.execute("SELECT name, phone, city FROM users WHERE user_id = ?", (user_id,))
+    cursor = get_connection().execute("SELECT name, phone, city FROM users WHERE user_id = ?", (user_id,))
     result = cursor.fetchone()
     if result:
         return {'name': result[0], 'phone': result[1], 'city': result[2]}
@@ -97,13 +630,14 @@ def get_user_info(user_id):
 
 # Функция для получения следующего порядкового номера запроса для пользователя
 def get_next_request_number(user_id):
-    cursor.execute("SELECT COUNT(*) FROM requests WHERE user_id = ?", (user_id,))
-    request_count = cursor.fetchone()[0]
-    return request_count + 1
+    cursor = get_connection().execute("SELECT last_number FROM request_counters WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    return result[0] + 1 if result else 1
 
 # Функция для получения всех активных запросов в системе
+# CROSS JOIN фиксирует порядок соединения: сначала поиск по индексу статуса, затем пользователь по user_id
 def get_all_active_requests():
-    cursor.execute("SELECT request_number, name, phone, amount, comment, file_path, status, created_at FROM requests JOIN users ON requests.user_id = users.user_id WHERE status = 'В обробці'")
+    cursor = get_connection().execute("SELECT request_number, name, phone, amount, comment, file_path, status, created_at FROM requests CROSS JOIN users ON requests.user_id = users.user_id WHERE status = 'В обробці'")
     rows = cursor.fetchall()
     active_requests = []
     for row in rows:
@@ -119,72 +653,802 @@ def get_all_active_requests():
         })
     return active_requests
 
+# Функция для получения страницы активных запросов. Страницы идут по ключу
+# (created_at, id): after - ключ последней строки предыдущей страницы, поэтому
+# каждая страница читается по индексу статуса без OFFSET.
+def get_active_requests_page(after=None, limit=20, created_after=None, created_before=None):
+    conditions = ["status = 'В обробці'"]
+    params = []
+    if after is not None:
+        conditions.append("(requests.created_at, requests.id) > (?, ?)")
+        params.extend(after)
+    if created_after is not None:
+        conditions.append("requests.created_at > ?")
+        params.append(created_after)
+    if created_before is not None:
+        conditions.append("requests.created_at <= ?")
+        params.append(created_before)
+    params.append(limit)
+    cursor = get_connection().execute(f'''SELECT requests.id, request_number, name, phone, amount, comment, file_path, status, requests.created_at
+                                          FROM requests CROSS JOIN users ON requests.user_id = users.user_id
+                                          WHERE {" AND ".join(conditions)}
+                                          ORDER BY requests.created_at, requests.id
+                                          LIMIT ?''', params)
+    return [
+        {
+            'id': row[0],
+            'request_number': row[1],
+            'name': row[2],
+            'phone': row[3],
+            'amount': row[4],
+            'comment': row[5],
+            'file_path': row[6],
+            'status': row[7],
+            'created_at': row[8]
+        }
+        for row in cursor.fetchall()
+    ]
+
+# Функция для перебора активных запросов страницами
+def iter_active_requests(page_size=100, created_after=None, created_before=None):
+    after = None
+    while True:
+        page = get_active_requests_page(after, page_size, created_after, created_before)
+        yield from page
+        if len(page) < page_size:
+            return
+        after = (page[-1]['created_at'], page[-1]['id'])
+
+# Функция для получения количества активных запросов
+def get_active_requests_count():
+    cursor = get_connection().execute("SELECT COUNT(*) FROM requests WHERE status = 'В обробці'")
+    return cursor.fetchone()[0]
+
+# Функции для чтения и записи служебных значений бота
+def get_bot_state(key, default=None):
+    cursor = get_connection().execute("SELECT value FROM bot_state WHERE key = ?", (key,))
+    result = cursor.fetchone()
+    return result[0] if result else default
+
+def set_bot_state(key, value):
+    _execute_write(_set_bot_state, key, value)
+
+def _set_bot_state(cursor, key, value):
+    cursor.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)", (key, value))
+
+# Функция для получения состояния диалога в чате. Диалог, не обновлявшийся
+# дольше max_age секунд, считается завершенным.
+def get_conversation(chat_id, max_age=None):
+    if max_age is None:
+        cursor = get_connection().execute("SELECT state, data, updated_at FROM conversations WHERE chat_id = ?", (chat_id,))
+    else:
+        cursor = get_connection().execute("SELECT state, data, updated_at FROM conversations WHERE chat_id = ? AND updated_at > datetime('now', ?)",
+                                          (chat_id, f"-{int(max_age)} seconds"))
+    result = cursor.fetchone()
+    if result:
+        return {'state': result[0], 'data': result[1], 'updated_at': result[2]}
+    return None
+
+def set_conversation(chat_id, state, data):
+    _execute_write(_set_conversation, chat_id, state, data)
+
+def _set_conversation(cursor, chat_id, state, data):
+    cursor.execute('''INSERT INTO conversations (chat_id, state, data, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                      ON CONFLICT (chat_id) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at''',
+                   (chat_id, state, data))
+
+def delete_conversation(chat_id):
+    _execute_write(_delete_conversation, chat_id)
+
+def _delete_conversation(cursor, chat_id):
+    cursor.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+
+# Функция для удаления диалогов, не обновлявшихся дольше max_age секунд.
+# Возвращает число удаленных диалогов.
+def delete_expired_conversations(max_age):
+    return _execute_write(_delete_expired_conversations, max_age)
+
+def _delete_expired_conversations(cursor, max_age):
+    cursor.execute("DELETE FROM conversations WHERE updated_at <= datetime('now', ?)", (f"-{int(max_age)} seconds",))
+    return cursor.rowcount
+
+# Функция для регистрации файла хранилища. Если файл с таким содержимым уже
+# зарегистрирован, возвращается его путь, иначе - path. Повторная регистрация
+# обновляет created_at: файл без ссылок, который сейчас прикрепляется к новой
+# заявке, не удаляется сборщиком мусора до ее создания.
+def register_file(sha256, path, size, file_name=None, telegram_file_id=None, telegram_kind=None):
+    return _execute_write(_register_file, sha256, path, size, file_name, telegram_file_id, telegram_kind)
+
+def _register_file(cursor, sha256, path, size, file_name, telegram_file_id, telegram_kind):
+    cursor.execute('''INSERT INTO files (sha256, path, size, file_name, telegram_file_id, telegram_kind) VALUES (?, ?, ?, ?, ?, ?)
+                      ON CONFLICT (sha256) DO UPDATE SET telegram_file_id = COALESCE(excluded.telegram_file_id, telegram_file_id),
+                                                         telegram_kind = COALESCE(excluded.telegram_kind, telegram_kind),
+                                                         created_at = CURRENT_TIMESTAMP''',
+                   (sha256, path, size, file_name, telegram_file_id, telegram_kind))
+    cursor.execute("SELECT path FROM files WHERE sha256 = ?", (sha256,))
+    return cursor.fetchone()[0]
+
+# Функция для получения сведений о файле хранилища по пути
+def get_file(path):
+    cursor = get_connection().execute('''SELECT sha256, path, size, file_name, telegram_file_id, telegram_kind, ref_count, created_at
+                                         FROM files WHERE path = ?''', (path,))
+    result = cursor.fetchone()
+    if result:
+        return {
+            'sha256': result[0],
+            'path': result[1],
+            'size': result[2],
+            'file_name': result[3],
+            'telegram_file_id': result[4],
+            'telegram_kind': result[5],
+            'ref_count': result[6],
+            'created_at': result[7]
+        }
+    return None
+
+# Функция для сохранения file_id Telegram, под которым файл уже отправлялся
+def set_file_telegram_id(path, telegram_file_id, telegram_kind):
+    _execute_write(_set_file_telegram_id, path, telegram_file_id, telegram_kind)
+
+def _set_file_telegram_id(cursor, path, telegram_file_id, telegram_kind):
+    cursor.execute("UPDATE files SET telegram_file_id = ?, telegram_kind = ? WHERE path = ?", (telegram_file_id, telegram_kind, path))
+
+# Функция для получения файлов, на которые не ссылается ни одна заявка и
+# которые добавлены раньше, чем min_age секунд назад
+def get_unreferenced_files(min_age):
+    cursor = get_connection().execute("SELECT sha256, path FROM files WHERE ref_count <= 0 AND created_at <= datetime('now', ?)",
+                                      (f"-{int(min_age)} seconds",))
+    return [{'sha256': sha256, 'path': path} for sha256, path in cursor.fetchall()]
+
+# Функция для удаления записи о файле, если на него по-прежнему нет ссылок и
+# он не регистрировался повторно за последние min_age секунд. Возвращает True,
+# если запись удалена.
+def delete_file(sha256, min_age=0):
+    return _execute_write(_delete_file, sha256, min_age)
+
+def _delete_file(cursor, sha256, min_age):
+    cursor.execute("DELETE FROM files WHERE sha256 = ? AND ref_count <= 0 AND created_at <= datetime('now', ?)",
+                   (sha256, f"-{int(min_age)} seconds"))
+    return cursor.rowcount > 0
+
+# Статусы фоновых задач
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# Функция для постановки фоновой задачи в очередь. payload - строка JSON,
+# delay - через сколько секунд задачу можно начинать. Возвращает id задачи.
+def enqueue_job(kind, payload, chat_id=None, delay=0, max_attempts=3):
+    return _execute_write(_enqueue_job, kind, payload, chat_id, delay, max_attempts)
+
+def _enqueue_job(cursor, kind, payload, chat_id, delay, max_attempts):
+    cursor.execute("INSERT INTO jobs (kind, payload, chat_id, max_attempts, run_at) VALUES (?, ?, ?, ?, datetime('now', ?))",
+                   (kind, payload, chat_id, max_attempts, f"+{int(delay)} seconds"))
+    return cursor.lastrowid
+
+# Функция для получения следующей готовой к выполнению задачи с отметкой о
+# начале выполнения. Выбор и отметка - одна операция, поэтому задачу не
+# получат два обработчика, в том числе из разных процессов. worker_id -
+# владелец задачи, который затем отмечается через heartbeat_jobs.
+def claim_job(worker_id=None):
+    return _execute_write(_claim_job, worker_id)
+
+def _claim_job(cursor, worker_id):
+    cursor.execute('''UPDATE jobs SET status = 'running', attempts = attempts + 1, worker_id = ?,
+                                     heartbeat_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                      WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND run_at <= CURRENT_TIMESTAMP ORDER BY run_at, id LIMIT 1)
+                      RETURNING id, kind, payload, chat_id, attempts, max_attempts''', (worker_id,))
+    result = cursor.fetchone()
+    if result:
+        return {
+            'id': result[0],
+            'kind': result[1],
+            'payload': result[2],
+            'chat_id': result[3],
+            'attempts': result[4],
+            'max_attempts': result[5]
+        }
+    return None
+
+def complete_job(job_id, result):
+    _execute_write(_complete_job, job_id, result)
+
+def _complete_job(cursor, job_id, result):
+    cursor.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (result, job_id))
+
+# Функция для отметки ошибки задачи. При retry_delay задача возвращается в
+# очередь и будет повторена через retry_delay секунд, иначе считается неудачной.
+def fail_job(job_id, error, retry_delay=None):
+    _execute_write(_fail_job, job_id, error, retry_delay)
+
+def _fail_job(cursor, job_id, error, retry_delay):
+    if retry_delay is None:
+        cursor.execute("UPDATE jobs SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (error, job_id))
+    else:
+        cursor.execute('''UPDATE jobs SET status = 'queued', error = ?, run_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+                          WHERE id = ?''', (error, f"+{int(retry_delay)} seconds", job_id))
+
+# Функция для получения задачи по id
+def get_job(job_id):
+    cursor = get_connection().execute('''SELECT id, kind, chat_id, status, attempts, max_attempts, run_at, result, error, created_at, updated_at
+                                         FROM jobs WHERE id = ?''', (job_id,))
+    result = cursor.fetchone()
+    if result:
+        return dict(zip(('id', 'kind', 'chat_id', 'status', 'attempts', 'max_attempts', 'run_at', 'result', 'error', 'created_at', 'updated_at'), result))
+    return None
+
+# Функция для получения числа секунд до ближайшей задачи в очереди
+# (0 - есть готовая задача, None - очередь пуста)
+def get_next_job_delay():
+    cursor = get_connection().execute("SELECT (julianday(MIN(run_at)) - julianday('now')) * 86400 FROM jobs WHERE status = 'queued'")
+    result = cursor.fetchone()[0]
+    return None if result is None else max(result, 0)
+
+# Функция для получения числа задач по статусам
+def get_job_counts():
+    cursor = get_connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+    return dict(cursor.fetchall())
+
+# Ошибка задачи, процесс которой перестал отмечаться на последней попытке
+STALE_JOB_ERROR = "Виконання завдання перервано: обробник зупинився або завис"
+
+# Функция для отметки владельца о том, что его задачи еще выполняются
+def heartbeat_jobs(worker_id):
+    return _execute_write(_heartbeat_jobs, worker_id)
+
+def _heartbeat_jobs(cursor, worker_id):
+    cursor.execute('''UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP
+                      WHERE status = 'running' AND worker_id = ?''', (worker_id,))
+    return cursor.rowcount
+
+# Функция для возврата в очередь задач, владелец которых не отмечался дольше
+# timeout секунд (процесс, выполнявший их, остановлен или завис). У задач,
+# начатых до появления отметок, учитывается время начала. Задачи, у которых
+# попытки закончились (задача сама роняет или подвешивает процесс), не
+# возвращаются, а завершаются с ошибкой. Возвращает число возвращенных задач
+# и список завершенных с ошибкой в формате claim_job.
+def requeue_stale_jobs(timeout):
+    return _execute_write(_requeue_stale_jobs, timeout)
+
+def _requeue_stale_jobs(cursor, timeout):
+    stale_before = f"-{int(timeout)} seconds"
+    cursor.execute('''UPDATE jobs SET status = 'failed', error = ?, worker_id = NULL, updated_at = CURRENT_TIMESTAMP
+                      WHERE status = 'running' AND COALESCE(heartbeat_at, updated_at) <= datetime('now', ?)
+                        AND attempts >= max_attempts
+                      RETURNING id, kind, payload, chat_id, attempts, max_attempts, error''', (STALE_JOB_ERROR, stale_before))
+    failed = [dict(zip(('id', 'kind', 'payload', 'chat_id', 'attempts', 'max_attempts', 'error'), row))
+              for row in cursor.fetchall()]
+    cursor.execute('''UPDATE jobs SET status = 'queued', worker_id = NULL, updated_at = CURRENT_TIMESTAMP
+                      WHERE status = 'running' AND COALESCE(heartbeat_at, updated_at) <= datetime('now', ?)''',
+                   (stale_before,))
+    return cursor.rowcount, failed
+
+# Функция для удаления завершенных задач старше max_age секунд
+def delete_finished_jobs(max_age):
+    return _execute_write(_delete_finished_jobs, max_age)
+
+def _delete_finished_jobs(cursor, max_age):
+    cursor.execute('''DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at <= datetime('now', ?)''',
+                   (f"-{int(max_age)} seconds",))
+    return cursor.rowcount
+
+# Статусы импорта
+IMPORT_RUNNING = 'running'
+IMPORT_DONE = 'done'
+IMPORT_FAILED = 'failed'
+# Сколько ошибок строк хранится для отчета
+IMPORT_MAX_ERRORS = 20
+# Ограничение SQLite на число параметров запроса
+_MAX_PARAMS = 500
+
+_IMPORT_COLUMNS = 'id, sha256, file_name, status, rows_done, rows_imported, rows_skipped, users_created, errors, created_at, updated_at, job_id'
+
+def _import_dict(result):
+    if result is None:
+        return None
+    return {
+        'id': result[0],
+        'sha256': result[1],
+        'file_name': result[2],
+        'status': result[3],
+        'rows_done': result[4],
+        'rows_imported': result[5],
+        'rows_skipped': result[6],
+        'users_created': result[7],
+        'errors': json.loads(result[8]),
+        'created_at': result[9],
+        'updated_at': result[10],
+        'job_id': result[11]
+    }
+
+# Функция для начала импорта файла с содержимым sha256. Повторный импорт того
+# же файла продолжается с сохраненной позиции, завершенный не повторяется.
+def start_import(sha256, file_name=None):
+    return _execute_write(_start_import, sha256, file_name)
+
+def _start_import(cursor, sha256, file_name):
+    cursor.execute(f'''INSERT INTO imports (sha256, file_name) VALUES (?, ?)
+                       ON CONFLICT (sha256) DO UPDATE SET
+                           status = CASE WHEN status = 'done' THEN status ELSE 'running' END,
+                           updated_at = CURRENT_TIMESTAMP
+                       RETURNING {_IMPORT_COLUMNS}''', (sha256, file_name))
+    return _import_dict(cursor.fetchone())
+
+# Функция для начала импорта вместе с постановкой задачи импорта kind в
+# очередь. Если задача, уже выполняющая импорт этого файла, в очереди или
+# выполняется, новая не создается. Проверка и постановка - одна транзакция,
+# поэтому один файл не импортируется двумя задачами одновременно.
+# Возвращает состояние импорта; started - создана ли задача этим вызовом.
+def start_import_job(sha256, file_name, kind, path, chat_id=None, max_attempts=3):
+    return _execute_write(_start_import_job, sha256, file_name, kind, path, chat_id, max_attempts)
+
+def _start_import_job(cursor, sha256, file_name, kind, path, chat_id, max_attempts):
+    state = _start_import(cursor, sha256, file_name)
+    state['started'] = False
+    if state['status'] == IMPORT_DONE:
+        return state
+    if state['job_id'] is not None:
+        cursor.execute("SELECT status FROM jobs WHERE id = ?", (state['job_id'],))
+        row = cursor.fetchone()
+        if row and row[0] in (JOB_QUEUED, JOB_RUNNING):
+            return state
+    state['job_id'] = _enqueue_job(cursor, kind, json.dumps({'import_id': state['id'], 'path': path}), chat_id, 0, max_attempts)
+    cursor.execute("UPDATE imports SET job_id = ? WHERE id = ?", (state['job_id'], state['id']))
+    state['started'] = True
+    return state
+
+def get_import(import_id):
+    cursor = get_connection().execute(f"SELECT {_IMPORT_COLUMNS} FROM imports WHERE id = ?", (import_id,))
+    return _import_dict(cursor.fetchone())
+
+def finish_import(import_id, status):
+    _execute_write(_finish_import, import_id, status)
+
+def _finish_import(cursor, import_id, status):
+    cursor.execute("UPDATE imports SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (status, import_id))
+
+# Пользователь из файла, не найденный по телефону, получает отрицательный
+# user_id из хеша телефона: настоящие id Telegram положительные, а один и тот
+# же телефон в разных пачках и при повторном запуске дает один id
+def _imported_user_id(phone):
+    return -int(hashlib.sha256(phone.encode()).hexdigest()[:12], 16)
+
+def is_imported_user(user_id):
+    return user_id < 0
+
+def _find_users_by_phone(cursor, phones):
+    found = {}
+    phones = list(phones)
+    for start in range(0, len(phones), _MAX_PARAMS):
+        chunk = phones[start:start + _MAX_PARAMS]
+        # Если телефон есть у нескольких пользователей, выбирается настоящий
+        # пользователь Telegram (наибольший id)
+        cursor.execute(f"SELECT phone, MAX(user_id) FROM users WHERE phone IN ({', '.join('?' * len(chunk))}) GROUP BY phone", chunk)
+        found.update(cursor.fetchall())
+    return found
+
+def _get_last_numbers(cursor, user_ids):
+    numbers = {}
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), _MAX_PARAMS):
+        chunk = user_ids[start:start + _MAX_PARAMS]
+        cursor.execute(f"SELECT user_id, last_number FROM request_counters WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk)
+        numbers.update(cursor.fetchall())
+    return numbers
+
+# Функция для записи пачки строк импорта одной транзакцией вместе с позицией
+# в файле (rows_done), поэтому после остановки импорт продолжается ровно с
+# первой незаписанной строки. rows - кортежи (имя, телефон, сумма,
+# комментарий, файл, статус, дата создания или None); errors - ошибки
+# пропущенных строк пачки. Номера заявок назначаются по счетчику пользователя.
+def import_requests_batch(import_id, rows, rows_done, skipped=0, errors=()):
+    return _execute_write(_import_requests_batch, import_id, rows, rows_done, skipped, list(errors))
+
+def _import_requests_batch(cursor, import_id, rows, rows_done, skipped, errors):
+    users = _find_users_by_phone(cursor, {row[1] for row in rows})
+    new_users = {}
+    for name, phone, *_ in rows:
+        if phone not in users:
+            users[phone] = _imported_user_id(phone)
+            new_users[users[phone]] = (users[phone], name, phone)
+    users_created = 0
+    if new_users:
+        cursor.executemany("INSERT INTO users (user_id, name, phone) VALUES (?, ?, ?) ON CONFLICT (user_id) DO NOTHING",
+                           list(new_users.values()))
+        users_created = cursor.rowcount
+
+    last_numbers = _get_last_numbers(cursor, set(users.values()))
+    requests = []
+    for name, phone, amount, comment, file_path, status, created_at in rows:
+        user_id = users[phone]
+        last_numbers[user_id] = last_numbers.get(user_id, 0) + 1
+        requests.append((user_id, amount, comment, file_path, status, last_numbers[user_id], created_at))
+    cursor.executemany('''INSERT INTO requests (user_id, amount, comment, file_path, status, request_number, created_at)
+                          VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))''', requests)
+    cursor.executemany('''INSERT INTO request_counters (user_id, last_number) VALUES (?, ?)
+                          ON CONFLICT (user_id) DO UPDATE SET last_number = excluded.last_number''',
+                       [(user_id, last_numbers[user_id]) for user_id in {request[0] for request in requests}])
+
+    cursor.execute("SELECT errors FROM imports WHERE id = ?", (import_id,))
+    stored_errors = json.loads(cursor.fetchone()[0])
+    stored_errors.extend(errors[:max(IMPORT_MAX_ERRORS - len(stored_errors), 0)])
+    cursor.execute(f'''UPDATE imports SET rows_done = ?, rows_imported = rows_imported + ?, rows_skipped = rows_skipped + ?,
+                                         users_created = users_created + ?, errors = ?, updated_at = CURRENT_TIMESTAMP
+                       WHERE id = ? RETURNING {_IMPORT_COLUMNS}''',
+                   (rows_done, len(requests), skipped, users_created, json.dumps(stored_errors, ensure_ascii=False), import_id))
+    return _import_dict(cursor.fetchone())
+
+# Функции для отметки заявок в списке активных заявок. Отметки привязаны к
+# сообщению со списком (chat_id, message_id).
+def toggle_bulk_selection(chat_id, message_id, request_id):
+    return _execute_write(_toggle_bulk_selection, chat_id, message_id, request_id)
+
+def _toggle_bulk_selection(cursor, chat_id, message_id, request_id):
+    cursor.execute("DELETE FROM bulk_selections WHERE chat_id = ? AND message_id = ? AND request_id = ?",
+                   (chat_id, message_id, request_id))
+    if not cursor.rowcount:
+        cursor.execute("INSERT INTO bulk_selections (chat_id, message_id, request_id) VALUES (?, ?, ?)",
+                       (chat_id, message_id, request_id))
+
+def get_bulk_selection(chat_id, message_id):
+    cursor = get_connection().execute("SELECT request_id FROM bulk_selections WHERE chat_id = ? AND message_id = ?",
+                                      (chat_id, message_id))
+    return [row[0] for row in cursor.fetchall()]
+
+def clear_bulk_selection(chat_id, message_id):
+    _execute_write(_clear_bulk_selection, chat_id, message_id)
+
+def _clear_bulk_selection(cursor, chat_id, message_id):
+    cursor.execute("DELETE FROM bulk_selections WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+
+# Функция для получения активных заявок с суммой не больше max_amount:
+# число, сумма и наибольший id. Наибольший id ограничивает массовое решение
+# заявками, которые администратор видел при подтверждении.
+def get_active_requests_below(max_amount):
+    cursor = get_connection().execute('''SELECT COUNT(*), TOTAL(amount), MAX(id) FROM requests
+                                         WHERE status = 'В обробці' AND amount <= ?''', (max_amount,))
+    count, amount_sum, max_id = cursor.fetchone()
+    return {'count': count, 'amount': int(amount_sum), 'max_id': max_id}
+
+def get_active_request_ids_below(max_amount, max_id):
+    cursor = get_connection().execute('''SELECT id FROM requests
+                                         WHERE status = 'В обробці' AND amount <= ? AND id <= ?''', (max_amount, max_id))
+    return [row[0] for row in cursor.fetchall()]
+
+# Функция для массового решения по заявкам одной транзакцией. Меняются только
+# заявки, еще ожидающие решения: заявка, решенная другим администратором,
+# пропускается. Действие записывается в журнал bulk_actions вместе со списком
+# измененных заявок. criteria - условия выбора заявок для журнала.
+# Возвращает id действия и измененные заявки (id, user_id, номер, сумма).
+def bulk_update_request_status(request_ids, status, admin_id, criteria=None):
+    return _execute_write(_bulk_update_request_status, list(request_ids), status, admin_id, criteria or {})
+
+def _bulk_update_request_status(cursor, request_ids, status, admin_id, criteria):
+    updated = []
+    for start in range(0, len(request_ids), _MAX_PARAMS):
+        chunk = request_ids[start:start + _MAX_PARAMS]
+        cursor.execute(f'''UPDATE requests SET status = ?, admin_comment = NULL, decided_by = ?,
+                                               decided_at = {_decided_at_expression(status)}
+                           WHERE id IN ({', '.join('?' * len(chunk))}) AND status = 'В обробці'
+                           RETURNING id, user_id, request_number, amount''', [status, admin_id] + chunk)
+        updated.extend({'id': row[0], 'user_id': row[1], 'request_number': row[2], 'amount': row[3]}
+                       for row in cursor.fetchall())
+    cursor.execute('''INSERT INTO bulk_actions (admin_id, status, criteria, request_count, amount_sum)
+                      VALUES (?, ?, ?, ?, ?)''',
+                   (admin_id, status, json.dumps(criteria, ensure_ascii=False), len(updated),
+                    sum(request['amount'] or 0 for request in updated)))
+    action_id = cursor.lastrowid
+    cursor.executemany("INSERT INTO bulk_action_requests (action_id, request_id) VALUES (?, ?)",
+                       [(action_id, request['id']) for request in updated])
+    updated.sort(key=lambda request: request['id'])
+    return action_id, updated
+
+# Функция для получения последних массовых действий
+def get_bulk_actions(limit=10):
+    cursor = get_connection().execute('''SELECT id, admin_id, status, criteria, request_count, amount_sum, created_at
+                                         FROM bulk_actions ORDER BY id DESC LIMIT ?''', (limit,))
+    return [
+        {
+            'id': row[0],
+            'admin_id': row[1],
+            'status': row[2],
+            'criteria': json.loads(row[3]),
+            'request_count': row[4],
+            'amount_sum': row[5],
+            'created_at': row[6]
+        }
+        for row in cursor.fetchall()
+    ]
+
+# Функция для получения заявок, измененных массовым действием
+def get_bulk_action_requests(action_id):
+    cursor = get_connection().execute("SELECT request_id FROM bulk_action_requests WHERE action_id = ? ORDER BY request_id",
+                                      (action_id,))
+    return [row[0] for row in cursor.fetchall()]
+
+# Функция для создания архивной таблицы месяца. Ссылки архивных заявок на
+# вложения учитываются в files.ref_count так же, как ссылки из requests,
+# поэтому перенос в архив не освобождает файлы.
+def _create_archive_table(connection, table):
+    connection.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                            id INTEGER PRIMARY KEY,
+                            user_id INTEGER,
+                            amount INTEGER,
+                            comment TEXT,
+                            file_path TEXT,
+                            status TEXT,
+                            request_number INTEGER,
+                            created_at TIMESTAMP,
+                            decided_at TIMESTAMP,
+                            admin_comment TEXT,
+                            decided_by INTEGER
+                        )''')
+    connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user ON {table} (user_id)")
+    connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_created ON {table} (created_at)")
+    connection.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_files_insert AFTER INSERT ON {table} WHEN NEW.file_path IS NOT NULL
+                           BEGIN
+                               UPDATE files SET ref_count = ref_count + 1 WHERE path = NEW.file_path;
+                           END''')
+    connection.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_files_delete AFTER DELETE ON {table} WHEN OLD.file_path IS NOT NULL
+                           BEGIN
+                               UPDATE files SET ref_count = ref_count - 1 WHERE path = OLD.file_path;
+                           END''')
+    _create_all_requests_view(connection)
+
+# Функция для переноса в архив заявок, решенных и созданных больше
+# older_than_days дней назад. Заявки переносятся пачками по batch_size, каждая
+# пачка - отдельная транзакция, поэтому запись заявок ботом не ждет весь
+# перенос. Сводная статистика не меняется: удаление заявок ее не затрагивает.
+# У заявок, решенных до появления decided_at, и у импортированных время
+# решения не записано: для них учитывается время создания.
+# Возвращает число перенесенных заявок.
+def archive_requests(older_than_days, batch_size=ARCHIVE_BATCH_SIZE):
+    cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).strftime('%Y-%m-%d %H:%M:%S')
+    archived = 0
+    while True:
+        count = _execute_write(_archive_requests_batch, cutoff, batch_size)
+        archived += count
+        if count < batch_size:
+            return archived
+
+def _archive_requests_batch(cursor, cutoff, limit):
+    cursor.execute('''SELECT id, strftime('%Y_%m', created_at) FROM requests
+                      WHERE status IN (?, ?) AND created_at < ? AND COALESCE(decided_at, created_at) < ?
+                        AND strftime('%Y_%m', created_at) IS NOT NULL
+                      LIMIT ?''', (*DECIDED_STATUSES, cutoff, cutoff, limit))
+    months = {}
+    for request_id, month in cursor.fetchall():
+        months.setdefault(month, []).append(request_id)
+    tables = set(_archive_tables(cursor.connection))
+    for month, request_ids in sorted(months.items()):
+        table = ARCHIVE_TABLE_PREFIX + month
+        if table not in tables:
+            _create_archive_table(cursor.connection, table)
+        for start in range(0, len(request_ids), _MAX_PARAMS):
+            chunk = request_ids[start:start + _MAX_PARAMS]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor.execute(f"INSERT INTO {table} ({_REQUEST_COLUMNS}) SELECT {_REQUEST_COLUMNS} FROM requests WHERE id IN ({placeholders})", chunk)
+            cursor.execute(f"DELETE FROM requests WHERE id IN ({placeholders})", chunk)
+    return sum(len(request_ids) for request_ids in months.values())
+
+# Функция для получения числа заявок в рабочей таблице и в архивных таблицах
+def get_archive_summary():
+    connection = get_connection()
+    return {table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ['requests'] + _archive_tables(connection)}
+
 # Функция для получения общего количества запросов
 def get_total_requests():
-    cursor.execute("SELECT COUNT(*) FROM requests")
-    return cursor.fetchone()[0]
+    cursor = get_connection().execute("SELECT TOTAL(request_count) FROM request_totals")
+    return int(cursor.fetchone()[0])
 
 # Функция для получения количества утвержденных запросов
 def get_approved_requests():
-    cursor.execute("SELECT COUNT(*) FROM requests WHERE status = 'Погоджено'")
-    return cursor.fetchone()[0]
+    return _get_status_count(STATUS_APPROVED)
 
 # Функция для получения общей суммы запросов
 def get_total_amount():
-    cursor.execute("SELECT SUM(amount) FROM requests")
+    cursor = get_connection().execute("SELECT TOTAL(amount_sum) FROM request_totals")
+    return int(cursor.fetchone()[0])
+
+# Функция для получения числа заявок в статусе из сводной таблицы
+def _get_status_count(status):
+    cursor = get_connection().execute("SELECT request_count FROM request_totals WHERE status = ?", (status,))
     result = cursor.fetchone()
-    return result[0] if result[0] else 0
-
-# Функция для экспорта запросов в Excel с именами пользователей и датой создания
-def export_requests_to_excel():
-    cursor.execute('''SELECT 
-            requests.id,
-            users.name,
-            users.phone,
-            requests.amount,
-            requests.comment,
-            requests.file_path,
-            requests.status,
-            requests.request_number,
-            requests.created_at  -- Добавляем дату создания
-        FROM 
-            requests 
-        JOIN 
-            users ON requests.user_id = users.user_id
-    ''')
-    rows = cursor.fetchall()
-    
-    # Определение названий столбцов
-    columns = ['id', 'Имя', 'Телефон', 'Сумма', 'Комментарий', 'Файл', 'Статус', 'Номер запроса', 'Дата создания']  
-    
-    # Создание DataFrame
-    df = pd.DataFrame(rows, columns=columns)
-    
-    # Путь к файлу Excel
-    file_path = 'requests.xlsx'
-    
-    # Запись в файл Excel
-    df.to_excel(file_path, index=False)
-
-    # Открытие файла Excel для настройки ширины столбцов
-    workbook = Workbook()
-    worksheet = workbook.active
-
-    for r in dataframe_to_rows(df, index=False, header=True):
-        worksheet.append(r)
-
-    # Настройка ширины столбцов
-    for column in worksheet.columns:
-        max_length = 0
-        column_letter = get_column_letter(column[0].column)  
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = max_length + 2  
-        worksheet.column_dimensions[column_letter].width = adjusted_width
+    return result[0] if result else 0
+
+# Функция для преобразования строк сводной таблицы в словарь по статусам
+def _stats_by_status(rows):
+    stats = {}
+    for status, request_count, amount_sum, decision_count, decision_seconds in rows:
+        if request_count:
+            stats[status] = {
+                'count': request_count,
+                'amount': amount_sum,
+                'avg_decision_seconds': decision_seconds / decision_count if decision_count else None,
+            }
+    return stats
+
+# Функция для получения сводной статистики по статусам (число заявок, сумма,
+# среднее время решения). Читает не больше строки на статус.
+def get_stats_summary():
+    cursor = get_connection().execute("SELECT status, request_count, amount_sum, decision_count, decision_seconds FROM request_totals")
+    return _stats_by_status(cursor.fetchall())
+
+# Функция для построения условий на день сводной таблицы
+def _stats_period_conditions(date_from, date_to):
+    conditions = []
+    params = []
+    if date_from is not None:
+        conditions.append("day >= ?")
+        params.append(str(date_from))
+    if date_to is not None:
+        conditions.append("day <= ?")
+        params.append(str(date_to))
+    return conditions, params
+
+# Функция для получения статистики по статусам за период. Границы - даты
+# (date или строка 'YYYY-MM-DD'), обе включаются в период.
+def get_stats_by_period(date_from=None, date_to=None):
+    conditions, params = _stats_period_conditions(date_from, date_to)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cursor = get_connection().execute(f'''SELECT status, SUM(request_count), SUM(amount_sum), SUM(decision_count), SUM(decision_seconds)
+                                         FROM request_stats {where} GROUP BY status''', params)
+    return _stats_by_status(cursor.fetchall())
+
+# Функция для получения статистики по городам за период: {город: {статус: ...}}
+def get_stats_by_city(date_from=None, date_to=None):
+    conditions, params = _stats_period_conditions(date_from, date_to)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cursor = get_connection().execute(f'''SELECT city, status, SUM(request_count), SUM(amount_sum), SUM(decision_count), SUM(decision_seconds)
+                                         FROM request_stats {where} GROUP BY city, status ORDER BY city''', params)
+    stats = {}
+    for city, *row in cursor.fetchall():
+        stats.setdefault(city, {}).update(_stats_by_status([row]))
+    return {city: by_status for city, by_status in stats.items() if by_status}
+
+# Функция для получения среднего времени решения по заявке в секундах
+# (по умолчанию - для погодженных заявок)
+def get_average_decision_time(status=STATUS_APPROVED, date_from=None, date_to=None):
+    if date_from is None and date_to is None:
+        cursor = get_connection().execute("SELECT decision_count, decision_seconds FROM request_totals WHERE status = ?", (status,))
+    else:
+        conditions, params = _stats_period_conditions(date_from, date_to)
+        cursor = get_connection().execute(f'''SELECT SUM(decision_count), SUM(decision_seconds) FROM request_stats
+                                             WHERE {' AND '.join(conditions)} AND status = ?''', params + [status])
+    result = cursor.fetchone()
+    if not result or not result[0]:
+        return None
+    return result[1] / result[0]
+
+# Функция для сверки сводной статистики с полным пересчетом по всем заявкам,
+# включая архив. Возвращает список расхождений (пустой, если статистика верна).
+# При fix=True расхождения исправляются пересчетом сводных таблиц.
+def verify_stats(fix=False):
+    connection = get_connection()
+    expected = {}
+    cursor = connection.execute('''SELECT date(requests.created_at), COALESCE(users.city, ''), requests.status, COUNT(*), TOTAL(requests.amount),
+                                         COUNT(requests.decided_at),
+                                         TOTAL((julianday(requests.decided_at) - julianday(requests.created_at)) * 86400)
+                                  FROM all_requests AS requests LEFT JOIN users ON users.user_id = requests.user_id
+                                  GROUP BY 1, 2, 3''')
+    for day, city, status, *values in cursor:
+        expected[(day, city, status)] = values
+    actual = {}
+    for day, city, status, *values in connection.execute('''SELECT day, city, status, request_count, amount_sum, decision_count, decision_seconds
+                                                           FROM request_stats WHERE request_count != 0'''):
+        actual[(day, city, status)] = values
+
+    mismatches = []
+    for key in sorted(set(expected) | set(actual), key=lambda key: tuple(part or '' for part in key)):
+        have = actual.get(key, [0, 0, 0, 0])
+        want = expected.get(key, [0, 0, 0, 0])
+        # Время решения - число с плавающей точкой, поэтому сравнивается с допуском
+        if have[:3] != [int(value) for value in want[:3]] or abs(have[3] - want[3]) > 1:
+            mismatches.append({'day': key[0], 'city': key[1], 'status': key[2], 'stats': have, 'recount': want})
+
+    totals = {status: values for status, *values in connection.execute(
+        "SELECT status, request_count, amount_sum, decision_count, decision_seconds FROM request_totals WHERE request_count != 0")}
+    recount = {}
+    for (day, city, status), values in expected.items():
+        summed = recount.setdefault(status, [0, 0, 0, 0])
+        for index, value in enumerate(values):
+            summed[index] += value
+    for status in sorted(set(totals) | set(recount), key=lambda status: status or ''):
+        have = totals.get(status, [0, 0, 0, 0])
+        want = recount.get(status, [0, 0, 0, 0])
+        if have[:3] != [int(value) for value in want[:3]] or abs(have[3] - want[3]) > 1:
+            mismatches.append({'day': None, 'city': None, 'status': status, 'stats': have, 'recount': want})
+
+    if mismatches and fix:
+        _execute_write(lambda cursor: rebuild_request_stats(cursor.connection))
+    return mismatches
+
+# Функция для приведения границы периода к формату столбца created_at
+def _format_export_bound(value, end=False):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        # Дата без времени включает весь день, поэтому верхняя граница - начало следующего дня
+        if end:
+            value += timedelta(days=1)
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+# Функция для экспорта запросов в Excel с именами пользователей и датой создания,
+# включая архивные заявки. Строки читаются из курсоров по одной и сразу пишутся
+# в книгу в режиме write-only, поэтому память не зависит от количества запросов.
+# Ширина столбцов считается по первой порции строк, так как в режиме write-only
+# её нужно задать до записи данных.
+def export_requests_to_excel(file_path='requests.xlsx', date_from=None, date_to=None, status=None, chunk_size=EXPORT_CHUNK_SIZE):
+    conditions = []
+    params = []
+    tables = ['requests'] + _archive_tables(get_connection())
+    if date_from is not None:
+        conditions.append("requests.created_at >= ?")
+        params.append(_format_export_bound(date_from))
+        # Архивные таблицы месяцев до начала периода не читаются
+        first_table = ARCHIVE_TABLE_PREFIX + params[-1][:7].replace('-', '_')
+        tables = ['requests'] + [table for table in tables[1:] if table >= first_table]
+    if date_to is not None:
+        if isinstance(date_to, date) and not isinstance(date_to, datetime):
+            conditions.append("requests.created_at < ?")
+        else:
+            conditions.append("requests.created_at <= ?")
+        params.append(_format_export_bound(date_to, end=True))
+        last_table = ARCHIVE_TABLE_PREFIX + params[-1][:7].replace('-', '_')
+        tables = ['requests'] + [table for table in tables[1:] if table <= last_table]
+    if status is not None:
+        conditions.append("requests.status = ?")
+        params.append(status)
+
+    # Рабочая таблица и каждая архивная таблица читаются по порядку id,
+    # строки сливаются по id без сортировки всего результата
+    cursors = []
+    try:
+        for table in tables:
+            query = f'''SELECT 
+                    requests.id,
+                    users.name,
+                    users.phone,
+                    requests.amount,
+                    requests.comment,
+                    requests.file_path,
+                    requests.status,
+                    requests.request_number,
+                    requests.created_at
+                FROM 
+                    {table} AS requests 
+                JOIN 
+                    users ON requests.user_id = users.user_id'''
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            query += " ORDER BY requests.id"
+            cursors.append(get_connection().execute(query, params))
+        export_rows = heapq.merge(*cursors, key=lambda row: row[0])
+        first_chunk = list(itertools.islice(export_rows, chunk_size))
+
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet()
+
+        # Настройка ширины столбцов по заголовкам и первой порции строк
+        widths = [len(column) for column in EXPORT_COLUMNS]
+        for row in first_chunk:
+            for index, value in enumerate(row):
+                if value is not None:
+                    widths[index] = max(widths[index], len(str(value)))
+        for index, width in enumerate(widths, 1):
+            worksheet.column_dimensions[get_column_letter(index)].width = min(width + 2, EXPORT_MAX_COLUMN_WIDTH)
+
+        worksheet.append(EXPORT_COLUMNS)
+        for row in first_chunk:
+            worksheet.append(row)
+        for row in export_rows:
+            worksheet.append(row)
+    finally:
+        for cursor in cursors:
+            cursor.close()
 
     # Сохранение файла
     workbook.save(file_path)
@@ -193,8 +1457,14 @@ def export_requests_to_excel():
 
 # Функция для получения количества отклоненных запросов
 def get_rejected_requests():
-    cursor.execute("SELECT COUNT(*) FROM requests WHERE status = 'Відхилено'")
-    return cursor.fetchone()[0]
+    return _get_status_count(STATUS_REJECTED)
+
+# Замер времени всех функций запросов (гистограмма и журнал медленных
+# запросов в metrics.py); служебные функции соединения и миграций не замеряются
+_UNTIMED = {'apply_pragmas', 'get_connection', 'set_trace_callback', 'transaction', 'close_connections',
+            'get_schema_version', 'migrate', 'create_tables', 'rebuild_request_counters', 'rebuild_request_stats',
+            'is_imported_user'}
+metrics.instrument_module(globals(), metrics.DB, exclude=_UNTIMED)
 
 # Создание таблиц при импорте модуля
 create_tables()
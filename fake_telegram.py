@@ -0,0 +1,368 @@
+"""Локальная замена Telegram Bot API для нагрузочных тестов и бенчмарков.
+
+Сервер принимает запросы бота по адресам /bot<token>/<method> и
+/file/bot<token>/<path>, выдает обновления из очереди через getUpdates (или,
+после setWebhook, отправляет их POST-запросами на адрес вебхука) и
+запоминает все отправленные ботом сообщения, чтобы симулированные
+пользователи могли дождаться ответа.
+"""
+import email.parser
+import email.policy
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import callbacks
+
+BOT_ID = 123456
+TOKEN = f"{BOT_ID}:FAKE-TOKEN"
+
+# Методы, которые создают новое сообщение в чате
+SEND_METHODS = {'sendMessage', 'sendDocument', 'sendPhoto'}
+EDIT_METHODS = {'editMessageText', 'editMessageReplyMarkup'}
+
+
+# Очередь соединений больше стандартных 5: при сотнях одновременных
+# пользователей соединения иначе отбрасываются и клиенты ждут таймаута
+class _Server(ThreadingHTTPServer):
+    request_queue_size = 256
+
+
+class FakeTelegram:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, flood_limit=None):
+        # Задержка ответа на методы отправки, имитирующая сеть до Telegram
+        self.latency = latency
+        # Допустимое число отправок в один чат за секунду; сверх него - ответ 429
+        self.flood_limit = flood_limit
+        self._chat_sends = {}
+        self.updates = []
+        self.chats = {}
+        self.messages = {}
+        self.files = {}
+        self.calls = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.delivered = 0
+        self._webhook_queue = []
+        self._webhook_thread = None
+        self._server = _Server((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        return self.base_url + "/bot{0}/{1}"
+
+    @property
+    def file_url(self):
+        return self.base_url + "/file/bot{0}/{1}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-telegram', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self.webhook_url = None
+            self._condition.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Добавление входящего обновления (сообщения или нажатия кнопки)
+    def push_update(self, **update):
+        with self._condition:
+            update['update_id'] = next(self._update_ids)
+            if self.webhook_url:
+                self._webhook_queue.append(update)
+            else:
+                self.updates.append(update)
+            self._condition.notify_all()
+        return update['update_id']
+
+    # Доставка обновлений на вебхук по одному, в порядке поступления. Ошибка
+    # доставки повторяется, как это делает Telegram.
+    def _deliver_webhook_updates(self):
+        while True:
+            with self._condition:
+                while self.webhook_url and not self._webhook_queue:
+                    self._condition.wait()
+                if not self.webhook_url:
+                    return
+                update = self._webhook_queue[0]
+                url, secret = self.webhook_url, self.webhook_secret
+            request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST',
+                                             headers={'Content-Type': 'application/json'})
+            if secret:
+                request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    response.read()
+            except (urllib.error.URLError, OSError):
+                time.sleep(0.1)
+                continue
+            with self._condition:
+                self.delivered += 1
+                self._webhook_queue.pop(0)
+
+    def add_file(self, content, file_name=None):
+        file_id = f"file-{next(self._file_ids)}"
+        self.files[file_id] = {'content': content, 'file_name': file_name}
+        return file_id
+
+    # Ожидание сообщения бота в чате. Возвращает первое сообщение, начиная с
+    # позиции start, для которого predicate вернул True, и его позицию.
+    def wait_for_message(self, chat_id, predicate=None, start=0, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                history = self.chats.get(chat_id, [])
+                for index in range(start, len(history)):
+                    if predicate is None or predicate(history[index]):
+                        return history[index], index
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Бот не відповів у чаті {chat_id}")
+                self._condition.wait(remaining)
+
+    def wait_for_call(self, method, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not any(call['method'] == method for call in self.calls):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Бот не викликав {method}")
+                self._condition.wait(remaining)
+
+    # Проверка лимита отправок в чат. Возвращает retry_after или None.
+    def _check_flood(self, method, params):
+        if self.flood_limit is None or method not in SEND_METHODS:
+            return None
+        now = time.monotonic()
+        with self._condition:
+            sends = [moment for moment in self._chat_sends.get(params.get('chat_id'), []) if now - moment < 1]
+            if len(sends) >= self.flood_limit:
+                self.calls.append({'method': method, 'params': params, 'time': now, 'rate_limited': True})
+                return 1
+            sends.append(now)
+            self._chat_sends[params.get('chat_id')] = sends
+        return None
+
+    # Обработка вызова метода Bot API
+    def call(self, method, params):
+        if method in SEND_METHODS and self.latency:
+            time.sleep(self.latency)
+        with self._condition:
+            self.calls.append({'method': method, 'params': params, 'time': time.monotonic()})
+            handler = getattr(self, '_api_' + method, None)
+            result = handler(params) if handler else True
+            self._condition.notify_all()
+        return result
+
+    def _api_getMe(self, params):
+        return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+
+    def _api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        # Длинный опрос ограничен полсекундой: бот быстро останавливается, а ответ
+        # гарантированно приходит раньше таймаута чтения на стороне клиента
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 0.5)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        while not self.updates:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._condition.wait(remaining)
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        return self.updates[:limit]
+
+    def _api_setWebhook(self, params):
+        self.webhook_url = params.get('url') or None
+        self.webhook_secret = params.get('secret_token') or None
+        # Обновления, еще не полученные через getUpdates, уходят на вебхук
+        self._webhook_queue.extend(self.updates)
+        self.updates = []
+        if self.webhook_url and (self._webhook_thread is None or not self._webhook_thread.is_alive()):
+            self._webhook_thread = threading.Thread(target=self._deliver_webhook_updates, name='fake-telegram-webhook', daemon=True)
+            self._webhook_thread.start()
+        return True
+
+    def _api_deleteWebhook(self, params):
+        self.webhook_url = None
+        self.updates = self._webhook_queue + self.updates
+        self._webhook_queue = []
+        return True
+
+    def _new_message(self, params, **content):
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Fake'},
+            **content,
+        }
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        self.messages[(chat_id, message['message_id'])] = message
+        # В истории чата хранится снимок: последующие изменения добавляются отдельно
+        self.chats.setdefault(chat_id, []).append(dict(message))
+        return message
+
+    def _api_sendMessage(self, params):
+        return self._new_message(params, text=params.get('text', ''))
+
+    def _api_sendDocument(self, params):
+        file_id = params.get('document') if isinstance(params.get('document'), str) else self.add_file(b'', 'document')
+        return self._new_message(params, document={'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'document'})
+
+    def _api_sendPhoto(self, params):
+        file_id = params.get('photo') if isinstance(params.get('photo'), str) else self.add_file(b'', 'photo.jpg')
+        return self._new_message(params, photo=[{'file_id': file_id, 'file_unique_id': file_id, 'width': 1, 'height': 1}])
+
+    def _edit_message(self, params, **changes):
+        key = (int(params['chat_id']), int(params['message_id']))
+        message = self.messages.get(key)
+        if message is None:
+            return True
+        message.update(changes)
+        # Как и в Telegram, изменение текста без reply_markup убирает кнопки
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        else:
+            message.pop('reply_markup', None)
+        # Изменение сообщения тоже считается ответом бота в чате
+        self.chats.setdefault(key[0], []).append(dict(message, edited=True))
+        return message
+
+    def _api_editMessageText(self, params):
+        return self._edit_message(params, text=params.get('text', ''))
+
+    def _api_editMessageReplyMarkup(self, params):
+        return self._edit_message(params)
+
+    def _api_getFile(self, params):
+        file_id = params['file_id']
+        stored = self.files.get(file_id, {'content': b''})
+        return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(stored['content']), 'file_path': f"files/{file_id}"}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _read_params(self):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/form-data'):
+                    parser = email.parser.BytesParser(policy=email.policy.HTTP)
+                    form = parser.parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+                    for part in form.iter_parts():
+                        name = part.get_param('name', header='content-disposition')
+                        payload = part.get_payload(decode=True)
+                        # Загруженные файлы передаются как bytes, обычные поля - как строки
+                        params[name] = payload if part.get_filename() else payload.decode()
+                elif body and content_type.startswith('application/json'):
+                    params.update(json.loads(body))
+                elif body:
+                    params.update(parse_qsl(body.decode()))
+                return url.path, params
+
+            def _reply(self, status, payload, content_type='application/json'):
+                body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                path, params = self._read_params()
+                parts = path.strip('/').split('/')
+                if parts[0] == 'file':
+                    stored = fake.files.get(parts[-1])
+                    if stored is None:
+                        self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                    else:
+                        self._reply(200, stored['content'], 'application/octet-stream')
+                    return
+                method = parts[-1]
+                retry_after = fake._check_flood(method, params)
+                if retry_after is not None:
+                    self._reply(429, {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {retry_after}",
+                                      'parameters': {'retry_after': retry_after}})
+                    return
+                self._reply(200, {'ok': True, 'result': fake.call(method, params)})
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+
+# Функции для построения входящих обновлений от имени пользователя
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+
+def make_message(user_id, text=None, message_id=None, **content):
+    message = {
+        'message_id': message_id or int(time.time() * 1000) % 1000000000,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': make_user(user_id),
+        **content,
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return message
+
+
+def make_callback(user_id, data, message):
+    return {
+        'id': f"{user_id}-{message['message_id']}-{time.monotonic_ns()}",
+        'from': make_user(user_id),
+        'chat_instance': str(user_id),
+        'data': data,
+        'message': {key: value for key, value in message.items() if key != 'edited'},
+    }
+
+
+# Функция для получения callback_data кнопки с действием action (код из
+# callbacks.py) или, если action не задан, кнопки с данными, начинающимися с prefix
+def find_button(message, prefix='', action=None):
+    markup = message.get('reply_markup') or {}
+    for row in markup.get('inline_keyboard', []):
+        for button in row:
+            data = button.get('callback_data', '')
+            if action is not None:
+                try:
+                    if callbacks.decode(data)[0] == action:
+                        return data
+                except ValueError:
+                    pass
+            elif data.startswith(prefix):
+                return data
+    return None
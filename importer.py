@@ -0,0 +1,197 @@
+import csv
+import hashlib
+import itertools
+import os
+import tempfile
+from datetime import date, datetime
+
+import openpyxl
+import requests
+
+import database
+import storage
+
+# Импорт заявок из файлов в формате export_requests_to_excel (xlsx или csv с
+# теми же столбцами). Файл читается потоком, строки записываются пачками в
+# одной транзакции вместе с позицией в файле, поэтому прерванный импорт
+# продолжается с первой незаписанной строки.
+IMPORT_FOLDER = 'imports'
+IMPORT_BATCH_SIZE = 1000
+IMPORT_EXTENSIONS = ('.xlsx', '.csv')
+STATUSES = (database.STATUS_PENDING, database.STATUS_APPROVED, database.STATUS_REJECTED)
+
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y')
+
+
+# Ошибка в строке файла: строка пропускается, причина попадает в отчет
+class RowError(ValueError):
+    pass
+
+
+# Функция для потоковой загрузки файла импорта. Файл называется по SHA-256
+# содержимого, по нему же находится ранее начатый импорт этого файла.
+# Возвращает путь и хеш.
+def download(url, extension, folder=IMPORT_FOLDER, proxies=None):
+    os.makedirs(folder, exist_ok=True)
+    digest = hashlib.sha256()
+    descriptor, temp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+    try:
+        with os.fdopen(descriptor, 'wb') as temp_file:
+            with requests.get(url, stream=True, timeout=storage.DOWNLOAD_TIMEOUT, proxies=proxies) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(storage.CHUNK_SIZE):
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+        path = os.path.join(folder, digest.hexdigest() + extension.lower())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path, digest.hexdigest()
+
+
+def _read_xlsx(path):
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _read_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        sample = file.read(4096)
+        file.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        for row in csv.reader(file, dialect):
+            yield [value if value != '' else None for value in row]
+
+
+# Функция для построчного чтения файла импорта, включая строку заголовков
+def read_rows(path):
+    if path.lower().endswith('.csv'):
+        return _read_csv(path)
+    return _read_xlsx(path)
+
+
+def _text(value):
+    if value is None:
+        return None
+    # Телефоны в Excel часто сохраняются числом
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    value = str(value).strip()
+    return value or None
+
+
+def _amount(value):
+    if isinstance(value, bool):
+        raise RowError(f"некоректна сума: {value}")
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, str):
+        value = value.replace(' ', '').replace(' ', '')
+        if not value.isdigit():
+            raise RowError(f"некоректна сума: {value}")
+        value = int(value)
+    if not isinstance(value, int) or value < 0:
+        raise RowError(f"некоректна сума: {value}")
+    return value
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime(_TIMESTAMP_FORMAT)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day).strftime(_TIMESTAMP_FORMAT)
+    text = str(value).strip()
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime(_TIMESTAMP_FORMAT)
+        except ValueError:
+            pass
+    raise RowError(f"некоректна дата: {text}")
+
+
+# Функция для проверки строки заголовков файла
+def check_header(header):
+    columns = [_text(value) for value in (header or ())[:len(database.EXPORT_COLUMNS)]]
+    if columns != database.EXPORT_COLUMNS:
+        raise ValueError(f"файл не у форматі експорту, очікувані стовпці: {', '.join(database.EXPORT_COLUMNS)}")
+
+
+# Функция для проверки заголовков файла без чтения всего файла
+def check_file(path):
+    rows = read_rows(path)
+    try:
+        check_header(next(rows, None))
+    finally:
+        rows.close()
+
+
+# Функция для разбора строки файла. id и номер заявки из файла не
+# используются: заявка получает новый id и номер по счетчику пользователя.
+# Возвращает кортеж для database.import_requests_batch.
+def parse_row(values):
+    values = list(values)[:len(database.EXPORT_COLUMNS)]
+    values += [None] * (len(database.EXPORT_COLUMNS) - len(values))
+    _, name, phone, amount, comment, file_path, status, _, created_at = values
+    name = _text(name)
+    if not name:
+        raise RowError("немає імені")
+    phone = _text(phone)
+    if not phone:
+        raise RowError("немає телефону")
+    status = _text(status) or database.STATUS_PENDING
+    if status not in STATUSES:
+        raise RowError(f"невідомий статус: {status}")
+    return (name, phone, _amount(amount), _text(comment), _text(file_path), status, _timestamp(created_at))
+
+
+# Обработчик задачи импорта. Выполняется в отдельном процессе: разбор файла
+# занимает процессор, а записи идут через поток записи этого процесса.
+# progress(state) вызывается после каждой записанной пачки.
+def run_import(payload, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    import_id, path = payload['import_id'], payload['path']
+    state = database.get_import(import_id)
+    if state['status'] == database.IMPORT_DONE:
+        return _summary(state)
+    rows = read_rows(path)
+    try:
+        check_header(next(rows, None))
+        done = state['rows_done']
+        batch, errors, skipped = [], [], 0
+        # Строки, записанные до остановки, пропускаются
+        for values in itertools.islice(rows, done, None):
+            done += 1
+            if any(value is not None for value in values):
+                try:
+                    batch.append(parse_row(values))
+                except RowError as e:
+                    skipped += 1
+                    # Номер строки в файле с учетом строки заголовков
+                    errors.append(f"рядок {done + 1}: {e}")
+            if done % batch_size == 0:
+                state = database.import_requests_batch(import_id, batch, done, skipped, errors)
+                batch, errors, skipped = [], [], 0
+                if progress:
+                    progress(state)
+        if done != state['rows_done']:
+            state = database.import_requests_batch(import_id, batch, done, skipped, errors)
+            if progress:
+                progress(state)
+    finally:
+        rows.close()
+    database.finish_import(import_id, database.IMPORT_DONE)
+    return _summary(database.get_import(import_id))
+
+
+def _summary(state):
+    return {key: state[key] for key in ('id', 'status', 'rows_done', 'rows_imported', 'rows_skipped', 'users_created', 'errors')}
@@ -0,0 +1,226 @@
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import database
+import metrics
+
+# Параметры пула по умолчанию: потоки выполняют задачи, а задачи, нагружающие
+# процессор (экспорт), передаются в отдельные процессы, чтобы не занимать GIL
+# потока, обрабатывающего сообщения
+JOB_WORKERS = 4
+JOB_PROCESSES = 1
+MAX_ATTEMPTS = 3
+RETRY_BASE = 5
+# Задачи, добавленные другими процессами, замечаются не позже этого времени
+POLL_INTERVAL = 30
+# Владелец выполняемых задач отмечается с этим интервалом; задача, чей
+# владелец не отмечался дольше HEARTBEAT_TIMEOUT, считается прерванной и
+# возвращается в очередь (проверка тоже выполняется каждые HEARTBEAT_INTERVAL)
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 5 * 60
+EXPORT_FOLDER = 'exports'
+
+
+class _Kind:
+    def __init__(self, handler, on_success, on_failure, max_attempts, in_process):
+        self.handler = handler
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.max_attempts = max_attempts
+        self.in_process = in_process
+
+
+# Очередь фоновых задач. Задачи хранятся в таблице jobs, поэтому переживают
+# перезапуск и видны всем процессам бота. Поток-диспетчер берет готовые задачи
+# и передает их пулу потоков; между задачами он спит до срока ближайшей из
+# них или до добавления новой. Ошибка задачи приводит к повтору с
+# экспоненциальной задержкой, после последней попытки вызывается on_failure.
+# Взятые задачи помечаются worker_id очереди, пока они выполняются, очередь
+# периодически отмечается в базе; задачи остановленных процессов любая
+# очередь возвращает после пропуска отметок.
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS, processes=JOB_PROCESSES, poll_interval=POLL_INTERVAL):
+        self.workers = workers
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._kinds = {}
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs')
+        self._process_pool = None
+        self._busy = 0
+        self._thread = None
+        self._stopped = False
+
+    # Регистрация вида задачи. handler(payload) выполняет работу и возвращает
+    # результат, пригодный для JSON; on_success(job, result) и
+    # on_failure(job, error) сообщают результат в чат. При in_process=True
+    # handler выполняется в отдельном процессе и должен быть функцией уровня
+    # модуля, импортируемого без побочных эффектов.
+    def register(self, kind, handler, on_success=None, on_failure=None, max_attempts=MAX_ATTEMPTS, in_process=False):
+        self._kinds[kind] = _Kind(handler, on_success, on_failure, max_attempts, in_process)
+
+    # Постановка задачи в очередь. Возвращает id задачи.
+    def submit(self, kind, payload=None, chat_id=None, delay=0):
+        if kind not in self._kinds:
+            raise ValueError(f"Невідомий вид завдання: {kind}")
+        job_id = database.enqueue_job(kind, json.dumps(payload or {}, ensure_ascii=False), chat_id, delay,
+                                      self._kinds[kind].max_attempts)
+        self.wake()
+        return job_id
+
+    # Число попыток зарегистрированного вида задачи
+    def max_attempts(self, kind):
+        return self._kinds[kind].max_attempts
+
+    # Оповещение диспетчера о задаче, добавленной в базу не через submit
+    # (в одной транзакции с другими изменениями)
+    def wake(self):
+        self.start()
+        with self._condition:
+            self._condition.notify_all()
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._dispatch_loop, name='jobs-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+
+    def _dispatch_loop(self):
+        next_heartbeat = 0
+        while True:
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                self._heartbeat()
+                next_heartbeat = now + HEARTBEAT_INTERVAL
+            with self._condition:
+                if self._stopped:
+                    return
+                # Все потоки заняты: ожидание освобождения или следующей отметки
+                if self._busy >= self.workers:
+                    self._condition.wait(max(next_heartbeat - time.monotonic(), 0))
+                    continue
+            job = database.claim_job(self.worker_id)
+            if job is None:
+                delay = database.get_next_job_delay()
+                timeout = min(self.poll_interval if delay is None else delay, next_heartbeat - time.monotonic())
+                with self._condition:
+                    if not self._stopped:
+                        self._condition.wait(max(timeout, 0))
+                continue
+            with self._condition:
+                self._busy += 1
+            self._executor.submit(self._run, job)
+
+    # Отметка о выполнении своих задач и возврат в очередь задач, владелец
+    # которых перестал отмечаться. Для задач без оставшихся попыток
+    # вызывается on_failure.
+    def _heartbeat(self):
+        try:
+            if self._busy:
+                database.heartbeat_jobs(self.worker_id)
+            requeued, failed = database.requeue_stale_jobs(HEARTBEAT_TIMEOUT)
+            if requeued:
+                logging.warning(f"Повернуто в чергу {requeued} перерваних завдань")
+        except Exception as e:
+            logging.error(f"Помилка перевірки виконуваних завдань: {e}")
+            return
+        for job in failed:
+            logging.error(f"Завдання {job['id']} ({job['kind']}) не виконано після {job['attempts']} спроб: {job['error']}")
+            kind = self._kinds.get(job['kind'])
+            if kind is None or kind.on_failure is None:
+                continue
+            try:
+                kind.on_failure(job, RuntimeError(job['error']))
+            except Exception as e:
+                logging.error(f"Помилка обробки завдання {job['id']}: {e}")
+
+    def _process_executor(self):
+        with self._condition:
+            if self._process_pool is None:
+                # spawn: дочерний процесс не наследует соединения с базой и потоки бота
+                self._process_pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+            return self._process_pool
+
+    # Пул, в котором процесс завершился аварийно (например, убит из-за нехватки
+    # памяти), больше не принимает задачи: он отбрасывается, и следующая
+    # задача создает новый
+    def _discard_process_pool(self, pool):
+        with self._condition:
+            if self._process_pool is pool:
+                self._process_pool = None
+        pool.shutdown(wait=False)
+
+    def _run(self, job):
+        try:
+            kind = self._kinds.get(job['kind'])
+            if kind is None:
+                database.fail_job(job['id'], f"Невідомий вид завдання: {job['kind']}")
+                logging.error(f"Завдання {job['id']}: невідомий вид {job['kind']}")
+                return
+            payload = json.loads(job['payload'])
+            started = time.perf_counter()
+            try:
+                if kind.in_process and self.processes:
+                    pool = self._process_executor()
+                    try:
+                        result = pool.submit(kind.handler, payload).result()
+                    except BrokenProcessPool:
+                        self._discard_process_pool(pool)
+                        raise
+                else:
+                    result = kind.handler(payload)
+            except Exception as e:
+                metrics.observe(metrics.JOB, time.perf_counter() - started, kind=job['kind'], result='error')
+                if job['attempts'] < job['max_attempts']:
+                    retry_delay = RETRY_BASE * 2 ** (job['attempts'] - 1)
+                    database.fail_job(job['id'], str(e), retry_delay)
+                    logging.warning(f"Завдання {job['id']} ({job['kind']}) завершилось помилкою, повтор через {retry_delay} с: {e}")
+                else:
+                    database.fail_job(job['id'], str(e))
+                    logging.error(f"Завдання {job['id']} ({job['kind']}) не виконано після {job['attempts']} спроб: {e}")
+                    if kind.on_failure:
+                        kind.on_failure(job, e)
+                return
+            metrics.observe(metrics.JOB, time.perf_counter() - started, kind=job['kind'], result='done')
+            database.complete_job(job['id'], json.dumps(result, ensure_ascii=False))
+            logging.info(f"Завдання {job['id']} ({job['kind']}) виконано")
+            if kind.on_success:
+                kind.on_success(job, result)
+        except Exception as e:
+            logging.error(f"Помилка обробки завдання {job['id']}: {e}")
+        finally:
+            with self._condition:
+                self._busy -= 1
+                self._condition.notify_all()
+
+
+# Обработчик задачи экспорта. Выполняется в отдельном процессе, поэтому
+# принимает и возвращает только данные, пригодные для JSON.
+def export_requests(payload):
+    os.makedirs(EXPORT_FOLDER, exist_ok=True)
+    date_from = datetime.strptime(payload['date_from'], '%Y-%m-%d').date() if payload.get('date_from') else None
+    date_to = datetime.strptime(payload['date_to'], '%Y-%m-%d').date() if payload.get('date_to') else None
+    file_path = os.path.join(EXPORT_FOLDER, f"requests_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.xlsx")
+    database.export_requests_to_excel(file_path, date_from=date_from, date_to=date_to, status=payload.get('status'))
+    return {'file_path': file_path}
@@ -0,0 +1,382 @@
+"""Нагрузочный тест бота против локальной замены Telegram API.
+
+Запуск:
+    python loadtest.py --users 50 --latency 0.05
+    python loadtest.py --modes async --users 200
+    python loadtest.py --modes sync --users 2000 --concurrency 100 --attachments 0.3 --reject-share 0.2 --bot-metrics --send-rate 0
+    python loadtest.py --scenario burst --modes sync webhook --users 100 --updates-per-user 20 --latency 0 --send-rate 0
+
+Для каждого режима (sync - bot.py с опросом getUpdates, webhook - bot.py с
+приемом обновлений через вебхук, async - async_bot.py) бот запускается в
+отдельном процессе с временной базой данных.
+
+Сценарий flow: симулированные пользователи проходят регистрацию и создают
+заявку (часть - с вложением, --attachments), администратор одобряет или
+отклоняет (--reject-share) каждую заявку. Одновременно активны не больше
+--concurrency пользователей, поэтому можно симулировать тысячи
+пользователей. Результат - пропускная способность и задержки шагов в JSON;
+с --bot-metrics добавляются p50/p95/p99 обработчиков бота и функций
+database.py, замеренные в процессе бота.
+
+Сценарий burst: каждый пользователь сразу отправляет несколько команд /start,
+измеряется число обработанных обновлений в секунду. --send-rate 0 снимает
+лимиты очереди отправки бота (sync и webhook), чтобы измерялся прием
+обновлений, а не ограничения Telegram на отправку.
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import callbacks
+import fake_telegram
+import outbox
+
+ADMIN_ID = 900000001
+FIRST_USER_ID = 500000
+# Размер вложения симулированного пользователя, байт
+ATTACHMENT_SIZE = 20 * 1024
+WEBHOOK_SECRET = 'loadtest-secret'
+MODES = ['sync', 'webhook', 'async']
+
+
+# Создание модуля config для дочернего процесса бота, так как config.py
+# заполняется вручную при развертывании
+def install_config(upload_folder):
+    config = types.ModuleType('config')
+    config.TOKEN = fake_telegram.TOKEN
+    config.ADMIN_CHAT_ID = ADMIN_ID
+    config.UPLOAD_FOLDER = upload_folder
+    config.ADMIN_NAMES = {ADMIN_ID: "Адміністратор"}
+    sys.modules['config'] = config
+    return config
+
+
+# Сохранение метрик бота в файл при остановке процесса (SIGTERM от
+# нагрузочного теста). Процесс завершается сразу: потоки планировщика и
+# очередей бота не рассчитаны на остановку.
+def dump_metrics_on_terminate(path):
+    import metrics
+    metrics.registry.keep_samples = True
+
+    def handler(signum, frame):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(metrics.registry.snapshot(), file, ensure_ascii=False)
+        os._exit(0)
+    signal.signal(signal.SIGTERM, handler)
+
+
+# Очередь отправки с одним лимитом send_rate (0 - без ограничений на отправку)
+def outbox_with_rate(outbox_class, send_rate):
+    rate = send_rate or 1000000
+    return outbox_class(global_rate=rate, global_burst=rate, chat_rate=rate, chat_burst=rate, workers=16)
+
+
+# Запуск бота в текущем процессе с адресами локального API
+def run_bot(mode, api_url, file_url, send_rate=None, metrics_path=None):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    install_config(os.path.join(os.getcwd(), 'uploads'))
+    if metrics_path:
+        dump_metrics_on_terminate(metrics_path)
+    if mode == 'async':
+        import asyncio
+        from telebot import asyncio_helper
+        asyncio_helper.API_URL = api_url
+        asyncio_helper.FILE_URL = file_url
+        import async_bot
+        if send_rate is not None:
+            async_bot.outgoing = outbox_with_rate(outbox.AsyncOutbox, send_rate)
+        asyncio.run(async_bot.bot.polling(non_stop=True, timeout=1))
+    else:
+        from telebot import apihelper
+        apihelper.API_URL = api_url
+        apihelper.FILE_URL = file_url
+        import bot
+        if send_rate is not None:
+            bot.outgoing = outbox_with_rate(outbox.Outbox, send_rate)
+        if mode == 'webhook':
+            import webhook
+            server = webhook.WebhookServer(bot.bot, '127.0.0.1', 0, '/webhook', secret=WEBHOOK_SECRET)
+            host, port = server.server_address[:2]
+            bot.bot.remove_webhook()
+            bot.bot.set_webhook(url=f"http://{host}:{port}/webhook", secret_token=WEBHOOK_SECRET)
+            server.serve_forever()
+        else:
+            bot.bot.polling(none_stop=True, interval=0, timeout=1, long_polling_timeout=1)
+
+
+def start_bot_process(mode, fake, workdir, send_rate=None, metrics_path=None):
+    env = dict(os.environ, FINANCE_BOT_DB=os.path.join(workdir, 'users.db'))
+    command = [sys.executable, os.path.abspath(__file__), '_bot', mode, fake.api_url, fake.file_url]
+    if send_rate is not None:
+        command += ['--send-rate', str(send_rate)]
+    if metrics_path:
+        command += ['--metrics', metrics_path]
+    return subprocess.Popen(command, cwd=workdir, env=env)
+
+
+# Остановка процесса бота. Возвращает метрики бота, если они сохранялись.
+def stop_bot_process(process, metrics_path=None):
+    process.terminate()
+    process.wait(timeout=30)
+    if metrics_path and os.path.exists(metrics_path):
+        with open(metrics_path, encoding='utf-8') as file:
+            return json.load(file)
+    return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# Симулированный пользователь: отправляет шаг и ждет ответа бота в своем чате
+class SimulatedUser:
+    def __init__(self, fake, user_id, latencies, timeout, think_time=0.0):
+        self.fake = fake
+        self.user_id = user_id
+        self.latencies = latencies
+        self.timeout = timeout
+        # Пауза между ответом бота и следующим действием пользователя,
+        # имитирующая время, за которое человек читает вопрос и отвечает
+        self.think_time = think_time
+        self.position = 0
+
+    def _wait(self, predicate, name):
+        try:
+            message, index = self.fake.wait_for_message(self.user_id, predicate, start=self.position, timeout=self.timeout)
+        except TimeoutError as e:
+            raise TimeoutError(f"{e} (крок {name})") from None
+        self.position = index + 1
+        return message
+
+    def step(self, name, update, predicate):
+        if self.think_time:
+            time.sleep(self.think_time)
+        started = time.perf_counter()
+        self.fake.push_update(**update)
+        message = self._wait(predicate, name)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        return message
+
+    def send(self, name, text, predicate):
+        return self.step(name, {'message': fake_telegram.make_message(self.user_id, text)}, predicate)
+
+    def press(self, name, data, message, predicate):
+        return self.step(name, {'callback_query': fake_telegram.make_callback(self.user_id, data, message)}, predicate)
+
+    def run_flow(self, amount, attachment=False):
+        has_text = lambda fragment: lambda message: fragment in message.get('text', '')
+        has_button = lambda action: lambda message: fake_telegram.find_button(message, action=action) is not None
+        decided = lambda message: 'погоджено' in message.get('text', '') or 'відхилено' in message.get('text', '')
+
+        message = self.send('start_registration', '/start', has_button(callbacks.REGISTER))
+        self.press('process_registration', fake_telegram.find_button(message, action=callbacks.REGISTER), message, has_text("ім'я"))
+        self.send('get_name', f"Користувач {self.user_id}", has_text('телефону'))
+        self.send('get_phone', '+380000000000', has_text('місто'))
+        message = self.send('get_city', 'Київ', has_button(callbacks.MAKE_REQUEST))
+        self.press('handle_make_request', fake_telegram.find_button(message, action=callbacks.MAKE_REQUEST), message, has_text('суму'))
+        message = self.send('process_amount', str(amount), has_text('коментар'))
+        message = self.send('process_comment', 'Навантажувальний тест', has_button(callbacks.SKIP_FILE))
+        if attachment:
+            # Содержимое у каждого пользователя свое, чтобы файл действительно
+            # загружался и записывался в хранилище
+            content = f"%PDF-1.4 {self.user_id}\n".encode() + b'0' * ATTACHMENT_SIZE
+            file_id = self.fake.add_file(content, 'receipt.pdf')
+            document = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'receipt.pdf', 'file_size': len(content)}
+            self.step('process_file', {'message': fake_telegram.make_message(self.user_id, document=document)}, has_text('прийнятий'))
+        else:
+            self.press('skip_file', fake_telegram.find_button(message, action=callbacks.SKIP_FILE), message, has_text('прийнятий'))
+        # Ожидание решения администратора
+        started = time.perf_counter()
+        self._wait(decided, 'decision_delivered')
+        self.latencies.setdefault('decision_delivered', []).append(time.perf_counter() - started)
+
+
+# Симулированный администратор: решает каждую заявку, как только у
+# сообщения появляются кнопки; доля reject_share заявок отклоняется
+def run_admin(fake, expected, stop, reject_share=0.0, seed=0):
+    rnd = random.Random(seed)
+    position = 0
+    approved = set()
+    while len(approved) < expected and not stop.is_set():
+        try:
+            message, index = fake.wait_for_message(
+                ADMIN_ID, lambda m: fake_telegram.find_button(m, action=callbacks.APPROVE) is not None,
+                start=position, timeout=1
+            )
+        except TimeoutError:
+            continue
+        position = index + 1
+        if message['message_id'] in approved:
+            continue
+        action = callbacks.REJECT if rnd.random() < reject_share else callbacks.APPROVE
+        fake.push_update(callback_query=fake_telegram.make_callback(
+            ADMIN_ID, fake_telegram.find_button(message, action=action), message))
+        approved.add(message['message_id'])
+
+
+# concurrency - число одновременно активных пользователей (по умолчанию все
+# сразу). Выбор вложения и решения администратора зависит только от seed,
+# поэтому прогоны с одинаковыми параметрами повторяют один сценарий.
+def run_flow(fake, users, timeout, think_time, concurrency=None, attachment_share=0.0, reject_share=0.0, seed=0):
+    latencies = {}
+    errors = []
+    stop = threading.Event()
+    admin = threading.Thread(target=run_admin, args=(fake, users, stop, reject_share, seed), daemon=True)
+    admin.start()
+    indexes = iter(range(users))
+    indexes_lock = threading.Lock()
+
+    def user_thread():
+        while True:
+            with indexes_lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            user = SimulatedUser(fake, FIRST_USER_ID + index, latencies, timeout, think_time)
+            attachment = random.Random(seed * 1000003 + index).random() < attachment_share
+            try:
+                user.run_flow(100 + index, attachment)
+            except TimeoutError as e:
+                errors.append(str(e))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user_thread) for _ in range(min(concurrency or users, users))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+
+    completed = users - len(errors)
+    # Шаги пользователя и нажатие кнопки администратором
+    updates = sum(len(values) for name, values in latencies.items() if name != 'decision_delivered') + completed
+    return {
+        'seconds': round(elapsed, 3),
+        'completed_flows': completed,
+        'flows_per_second': round(completed / elapsed, 2),
+        'updates_per_second': round(updates / elapsed, 1),
+        'steps': {
+            name: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 1),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+            }
+            for name, values in sorted(latencies.items())
+        },
+        'errors': errors[:5],
+    }
+
+
+# Все пользователи сразу отправляют по updates_per_user команд /start;
+# обновление считается обработанным, когда бот ответил на него в чате
+def run_burst(fake, users, updates_per_user, timeout):
+    user_ids = [FIRST_USER_ID + index for index in range(users)]
+    started = time.perf_counter()
+    for _ in range(updates_per_user):
+        for user_id in user_ids:
+            fake.push_update(message=fake_telegram.make_message(user_id, '/start'))
+    deadline = time.monotonic() + timeout
+    errors = []
+    for user_id in user_ids:
+        try:
+            fake.wait_for_message(user_id, start=updates_per_user - 1, timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError as e:
+            errors.append(str(e))
+    elapsed = time.perf_counter() - started
+    answered = sum(min(len(fake.chats.get(user_id, [])), updates_per_user) for user_id in user_ids)
+    return {
+        'updates': users * updates_per_user,
+        'answered': answered,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(answered / elapsed, 1),
+        'errors': errors[:5],
+    }
+
+
+def run_mode(mode, scenario, users, latency, timeout, think_time, updates_per_user=1, send_rate=None,
+             concurrency=None, attachment_share=0.0, reject_share=0.0, seed=0, bot_metrics=False):
+    fake = fake_telegram.FakeTelegram(latency=latency).start()
+    with tempfile.TemporaryDirectory() as workdir:
+        metrics_path = os.path.join(workdir, 'metrics.json') if bot_metrics else None
+        process = start_bot_process(mode, fake, workdir, send_rate, metrics_path)
+        snapshot = None
+        try:
+            fake.wait_for_call('setWebhook' if mode == 'webhook' else 'getUpdates', timeout=30)
+            if scenario == 'burst':
+                result = run_burst(fake, users, updates_per_user, timeout)
+            else:
+                result = run_flow(fake, users, timeout, think_time, concurrency, attachment_share, reject_share, seed)
+        finally:
+            snapshot = stop_bot_process(process, metrics_path)
+            fake.stop()
+    report = {
+        'mode': mode,
+        'scenario': scenario,
+        'users': users,
+        'concurrency': concurrency or users,
+        'attachment_share': attachment_share,
+        'reject_share': reject_share,
+        'seed': seed,
+        'latency_s': latency,
+        'think_time_s': think_time,
+        'send_rate': send_rate,
+        **result,
+    }
+    if snapshot is not None:
+        report['bot_metrics'] = snapshot
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Навантажувальний тест бота з локальним Telegram API")
+    subparsers = parser.add_subparsers(dest='command')
+
+    bot_parser = subparsers.add_parser('_bot')
+    bot_parser.add_argument('mode', choices=MODES)
+    bot_parser.add_argument('api_url')
+    bot_parser.add_argument('file_url')
+    bot_parser.add_argument('--send-rate', type=float)
+    bot_parser.add_argument('--metrics')
+
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=MODES)
+    parser.add_argument('--scenario', default='flow', choices=['flow', 'burst'])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--updates-per-user', type=int, default=10, help="Кількість оновлень від користувача в сценарії burst")
+    parser.add_argument('--send-rate', type=float,
+                        help="Ліміт черги відправки бота, повідомлень/с (0 - без лімітів); за замовчуванням ліміти Telegram")
+    parser.add_argument('--latency', type=float, default=0.05, help="Затримка відповіді API на відправку повідомлень, с")
+    parser.add_argument('--think-time', type=float, default=0.1, help="Пауза користувача між кроками, с")
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--concurrency', type=int, help="Кількість одночасно активних користувачів (за замовчуванням усі)")
+    parser.add_argument('--attachments', type=float, default=0.0, help="Частка запитів з вкладенням, 0..1")
+    parser.add_argument('--reject-share', type=float, default=0.0, help="Частка запитів, які адміністратор відхиляє, 0..1")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bot-metrics', action='store_true',
+                        help="Додати p50/p95/p99 обробників і функцій бази, заміряні в процесі бота")
+    args = parser.parse_args(argv)
+
+    if args.command == '_bot':
+        run_bot(args.mode, args.api_url, args.file_url, args.send_rate, args.metrics)
+        return
+
+    results = [run_mode(mode, args.scenario, args.users, args.latency, args.timeout, args.think_time,
+                        args.updates_per_user, args.send_rate, args.concurrency, args.attachments,
+                        args.reject_share, args.seed, args.bot_metrics) for mode in args.modes]
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import re
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Номера телефонов в сообщениях журнала заменяются маской: международный
+# формат (+380...) и национальный (0XXXXXXXXX)
+_PHONE = re.compile(r'\+\d[\d\s()-]{7,}\d|\b0\d{9}\b')
+
+
+class RedactingFilter(logging.Filter):
+    def filter(self, record):
+        message = record.getMessage()
+        redacted = _PHONE.sub('***', message)
+        if redacted != message:
+            record.msg, record.args = redacted, None
+        return True
+
+
+# Журнал в формате JSON: одна запись на строку
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Настройка журнала. При asynchronous=True запись в файл выполняет отдельный
+# поток: обработчики только кладут запись в очередь и не ждут диска.
+def setup_logging(filename, level=logging.INFO, structured=False, asynchronous=True):
+    file_handler = logging.FileHandler(filename, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter() if structured else logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    if asynchronous:
+        records = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(records)
+        listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+        listener.start()
+        # Записи, оставшиеся в очереди, дописываются при завершении процесса
+        atexit.register(listener.stop)
+    else:
+        handler = file_handler
+    # Фильтр на обработчике, а не на логгере: он применяется и к записям
+    # дочерних логгеров (telebot, urllib3)
+    handler.addFilter(RedactingFilter())
+    root.addHandler(handler)
+    return handler
@@ -0,0 +1,335 @@
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Метрики процесса бота: гистограммы времени обработчиков, запросов к базе и
+# вызовов Telegram API, счетчики команд и кнопок. Доступны администратору
+# командой /metrics и в текстовом формате Prometheus по HTTP.
+PREFIX = 'financebot_'
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Запросы к базе дольше этого времени записываются в журнал
+SLOW_QUERY_SECONDS = 0.1
+
+HANDLER = 'handler_seconds'
+DB = 'db_seconds'
+TELEGRAM_API = 'telegram_api_seconds'
+JOB = 'job_seconds'
+
+
+# Гистограмма по корзинам. При keep_samples=True сохраняются и сами значения
+# (для бенчмарков), тогда перцентили точные.
+class Histogram:
+    def __init__(self, buckets=BUCKETS, keep_samples=False):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples = [] if keep_samples else None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        if self.samples is not None:
+            self.samples.append(value)
+
+    # Оценка перцентиля по корзинам: верхняя граница корзины, в которую он
+    # попал. Если значения сохранены, перцентиль считается по ним.
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        if self.samples:
+            ordered = sorted(self.samples)
+            return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+
+class Registry:
+    def __init__(self, keep_samples=False):
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self.keep_samples = keep_samples
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(keep_samples=self.keep_samples)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # Регистрация функции, возвращающей текущие значения (глубина очередей,
+    # состояние кеша): список (имя, тип 'gauge' или 'counter', метки, значение)
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def histograms(self):
+        with self._lock:
+            return {key: (histogram.count, histogram.sum, histogram.max, list(histogram.counts),
+                          histogram.percentile(0.5), histogram.percentile(0.95), histogram.percentile(0.99))
+                    for key, histogram in self._histograms.items()}
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def collected(self):
+        values = []
+        for collector in self._collectors:
+            try:
+                values.extend(collector())
+            except Exception as e:
+                logging.error(f"Помилка збору метрик: {e}")
+        return values
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    # Снимок гистограмм и счетчиков для сохранения в JSON (бенчмарки):
+    # {метрика: [{labels, count, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}]}
+    def snapshot(self):
+        result = {}
+        for (name, labels), (count, total, maximum, _, p50, p95, p99) in sorted(self.histograms().items()):
+            result.setdefault(name, []).append({
+                'labels': dict(labels),
+                'count': count,
+                'mean_ms': round(total / count * 1000, 3) if count else None,
+                'p50_ms': _round_ms(p50),
+                'p95_ms': _round_ms(p95),
+                'p99_ms': _round_ms(p99),
+                'max_ms': _round_ms(maximum),
+            })
+        for (name, labels), value in sorted(self.counters().items()):
+            result.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return result
+
+
+def _round_ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+registry = Registry()
+observe = registry.observe
+inc = registry.inc
+add_collector = registry.add_collector
+
+
+@contextmanager
+def timer(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - started, **labels)
+
+
+# Декоратор для замера времени функции. Для запросов к базе (name=DB)
+# медленные вызовы записываются в журнал без аргументов: в них бывают
+# персональные данные.
+def timed(name, label=None):
+    def decorator(func):
+        function_name = label or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    _record(name, function_name, time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, function_name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def _record(name, function_name, elapsed):
+    if name == DB:
+        registry.observe(name, elapsed, function=function_name)
+        if elapsed >= SLOW_QUERY_SECONDS:
+            registry.inc('slow_queries_total', function=function_name)
+            logging.warning(f"Повільний запит до бази: {function_name} ({elapsed * 1000:.0f} мс)")
+    else:
+        registry.observe(name, elapsed, handler=function_name)
+
+
+# Замер всех открытых функций модуля, кроме перечисленных в exclude и
+# генераторов (их время - это время перебора, а не вызова)
+def instrument_module(namespace, name, exclude=()):
+    module_name = namespace['__name__']
+    for attribute, value in list(namespace.items()):
+        if (attribute.startswith('_') or attribute in exclude or not inspect.isfunction(value)
+                or value.__module__ != module_name or inspect.isgeneratorfunction(value)):
+            continue
+        namespace[attribute] = timed(name)(value)
+
+
+# Замер обработчиков, уже зарегистрированных в боте telebot (синхронном или
+# асинхронном), и подсчет команд. Вызывается после регистрации всех
+# обработчиков.
+def instrument_bot(bot):
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            if not getattr(handler['function'], '_instrumented', False):
+                handler['function'] = _instrument_handler(handler['function'])
+
+
+def _instrument_handler(func):
+    timed_func = timed(HANDLER)(func)
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(update, *args, **kwargs):
+            _count_update(update)
+            return await timed_func(update, *args, **kwargs)
+        async_wrapper._instrumented = True
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(update, *args, **kwargs):
+        _count_update(update)
+        return timed_func(update, *args, **kwargs)
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _count_update(update):
+    text = getattr(update, 'text', None)
+    if text and text.startswith('/'):
+        registry.inc('commands_total', command=text.split()[0].split('@')[0][1:])
+
+
+def _format_seconds(value):
+    return "—" if value is None else f"{value * 1000:.1f}"
+
+
+# Функция для формирования текста метрик для администратора: самые
+# нагруженные обработчики и запросы, вызовы API, счетчики и collectors
+def format_summary(limit=10):
+    histograms = registry.histograms()
+    lines = ["📈 Метрики (мс: p50 / p95 / max, кількість)"]
+    for name, title in ((HANDLER, "Обробники"), (DB, "Запити до бази"), (TELEGRAM_API, "Telegram API"),
+                        (JOB, "Фонові завдання")):
+        rows = sorted(((dict(labels), values) for (metric, labels), values in histograms.items() if metric == name),
+                      key=lambda row: row[1][1], reverse=True)
+        if not rows:
+            continue
+        lines.append(f"\n{title}:")
+        for labels, (count, total, maximum, _, p50, p95, _) in rows[:limit]:
+            label = ', '.join(str(value) for value in labels.values())
+            lines.append(f"  {label}: {_format_seconds(p50)} / {_format_seconds(p95)} / {_format_seconds(maximum)}, {count}")
+    counters = registry.counters()
+    if counters:
+        lines.append("\nЛічильники:")
+        for (name, labels), value in sorted(counters.items()):
+            label = ', '.join(str(item) for _, item in labels)
+            lines.append(f"  {name}{f' ({label})' if label else ''}: {value}")
+    collected = registry.collected()
+    if collected:
+        lines.append("\nСтан:")
+        for name, _, labels, value in collected:
+            label = ', '.join(str(item) for item in labels.values())
+            lines.append(f"  {name}{f' ({label})' if label else ''}: {value}")
+    return '\n'.join(lines)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in items) + '}'
+
+
+# Функция для формирования метрик в текстовом формате Prometheus
+def render_prometheus():
+    lines = []
+    histograms = registry.histograms()
+    for name in sorted({metric for metric, _ in histograms}):
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for (metric, labels), (count, total, _, counts, _, _, _) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+    counters = registry.counters()
+    for name in sorted({metric for metric, _ in counters}):
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+    declared = set()
+    for name, kind, labels, value in registry.collected():
+        if value is None:
+            continue
+        if name not in declared:
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            declared.add(name)
+        lines.append(f"{PREFIX}{name}{_labels(sorted(labels.items()))} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+# Запуск HTTP-сервера с метриками по адресу /metrics в отдельном потоке
+def start_http_server(port, host='127.0.0.1'):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = _Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info(f"Метрики доступні на http://{host}:{server.server_address[1]}/metrics")
+    return server
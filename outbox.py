@@ -0,0 +1,325 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from requests.exceptions import RequestException
+from telebot import asyncio_helper
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+
+# Очереди отправки: меньшее значение отправляется раньше
+PRIORITY_USER = 0        # ответы и подтверждения пользователям
+PRIORITY_ADMIN = 1       # уведомления администраторам о заявках
+PRIORITY_BACKGROUND = 2  # напоминания и прочие фоновые рассылки
+
+PRIORITY_NAMES = {PRIORITY_USER: 'user', PRIORITY_ADMIN: 'admin', PRIORITY_BACKGROUND: 'background'}
+
+# Ограничения Telegram: около 30 сообщений в секунду всего и около одного
+# сообщения в секунду в один чат (короткие всплески допускаются)
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+LATENCY_WINDOW = 1000
+# Как часто удаляются лимиты чатов, в которые давно ничего не отправлялось, с
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Время ожидания до появления токена (0 - токен доступен сейчас)
+    def delay(self, now):
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    # Лимит восстановился полностью: такой же, как у нового ведра
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'chat_id', 'func', 'args', 'kwargs', 'future', 'created', 'attempts', 'not_before')
+
+    def __init__(self, priority, seq, chat_id, func, args, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.created = time.monotonic()
+        self.attempts = 0
+        self.not_before = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# Центральная очередь исходящих вызовов Telegram API. Вызовы в один чат
+# выполняются строго по порядку и по одному, разные чаты отправляются
+# параллельно в пределах общего и чатового лимитов. Ответ 429 повторяется
+# после retry_after, сетевые ошибки - с экспоненциальной задержкой.
+class Outbox:
+    # Ошибки вызова: ответ Telegram (429 повторяется) и сетевые ошибки
+    api_errors = (ApiTelegramException,)
+    network_errors = (RequestException,)
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST,
+                 workers=4, max_retries=MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets = {}
+        self._chat_not_before = {}
+        # Очередь каждого чата (куча по приоритету и порядку постановки),
+        # куча чатов, готовых к отправке, по первому вызову чата и куча чатов,
+        # ожидающих лимита или повтора, по времени готовности. Записи в кучах
+        # чатов могут устареть и отбрасываются при извлечении.
+        self._chats = {}
+        self._ready = []
+        self._delayed = []
+        self._depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self._in_flight = set()
+        self._prune_at = time.monotonic() + PRUNE_INTERVAL
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox')
+        self._workers = workers
+        self._thread = None
+        self._stopped = False
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._counters = {'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0}
+
+    # Постановка вызова в очередь. func - метод бота, например bot.send_message.
+    # Возвращает Future с результатом вызова.
+    def submit(self, chat_id, func, *args, priority=PRIORITY_USER, **kwargs):
+        job = _Job(priority, next(self._seq), chat_id, func, args, kwargs)
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch_loop, name='outbox-dispatcher', daemon=True)
+                self._thread.start()
+            self._push(job)
+            self._condition.notify()
+        return job.future
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    # Ожидание, пока очередь не опустеет (для тестов и корректной остановки)
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while any(self._depth.values()) or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _push(self, job):
+        heapq.heappush(self._chats.setdefault(job.chat_id, []), job)
+        self._depth[job.priority] = self._depth.get(job.priority, 0) + 1
+        self._schedule(job.chat_id)
+
+    # Постановка свободного чата в кучу готовых по его первому вызову
+    def _schedule(self, chat_id):
+        jobs = self._chats.get(chat_id)
+        if jobs and chat_id not in self._in_flight:
+            heapq.heappush(self._ready, (jobs[0].priority, jobs[0].seq, chat_id))
+
+    # Выбор следующего вызова: первый по приоритету вызов среди свободных
+    # чатов, чьи лимиты позволяют отправку. Пока первый вызов чата ждет,
+    # остальные вызовы того же чата тоже ждут, чтобы не нарушить порядок.
+    # Возвращает (вызов, None) или (None, время ожидания).
+    def _next_job(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            self._schedule(heapq.heappop(self._delayed)[2])
+        while self._ready:
+            priority, seq, chat_id = self._ready[0]
+            jobs = self._chats.get(chat_id)
+            if not jobs or chat_id in self._in_flight or (jobs[0].priority, jobs[0].seq) != (priority, seq):
+                heapq.heappop(self._ready)
+                continue
+            delay = max(jobs[0].not_before - now, self._chat_not_before.get(chat_id, 0) - now,
+                        self._chat_bucket(chat_id).delay(now))
+            if delay > 0:
+                heapq.heappop(self._ready)
+                heapq.heappush(self._delayed, (now + delay, seq, chat_id))
+                continue
+            global_delay = self._global_bucket.delay(now)
+            if global_delay > 0:
+                return None, global_delay
+            heapq.heappop(self._ready)
+            job = heapq.heappop(jobs)
+            if not jobs:
+                del self._chats[chat_id]
+            self._depth[job.priority] -= 1
+            return job, None
+        return None, (self._delayed[0][0] - now if self._delayed else None)
+
+    # Удаление лимитов чатов без вызовов в очереди, у которых лимит
+    # восстановился и пауза после 429 прошла: без них чат ведет себя так же,
+    # а словари не растут с числом когда-либо обслуженных чатов
+    def _prune(self, now):
+        for chat_id in list(self._chat_buckets.keys() | self._chat_not_before.keys()):
+            if chat_id in self._chats or chat_id in self._in_flight:
+                continue
+            if self._chat_not_before.get(chat_id, 0) > now:
+                continue
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is not None and not bucket.full(now):
+                continue
+            self._chat_buckets.pop(chat_id, None)
+            self._chat_not_before.pop(chat_id, None)
+        self._prune_at = now + PRUNE_INTERVAL
+
+    def _dispatch_loop(self):
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return
+                if len(self._in_flight) >= self._workers:
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                if now >= self._prune_at:
+                    self._prune(now)
+                job, wait = self._next_job(now)
+                if job is None:
+                    self._condition.wait(wait)
+                    continue
+                self._chat_bucket(job.chat_id).take(now)
+                self._global_bucket.take(now)
+                self._in_flight.add(job.chat_id)
+                self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        job.attempts += 1
+        retry_delay = None
+        rate_limited = False
+        try:
+            with metrics.timer(metrics.TELEGRAM_API, method=job.func.__name__.lstrip('_')):
+                result = job.func(*job.args, **job.kwargs)
+        except self.api_errors as e:
+            if e.error_code == 429 and job.attempts <= self.max_retries:
+                retry_delay = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                rate_limited = True
+            else:
+                self._finish(job, error=e)
+                return
+        except self.network_errors as e:
+            # Сетевые ошибки повторяются с экспоненциальной задержкой
+            if job.attempts <= self.max_retries:
+                retry_delay = BACKOFF_BASE * 2 ** (job.attempts - 1)
+            else:
+                self._finish(job, error=e)
+                return
+        except Exception as e:
+            self._finish(job, error=e)
+            return
+        else:
+            self._finish(job, result=result)
+            return
+
+        with self._condition:
+            self._counters['retried'] += 1
+            if rate_limited:
+                self._counters['rate_limited'] += 1
+            job.not_before = time.monotonic() + retry_delay
+            self._chat_not_before[job.chat_id] = job.not_before
+            self._in_flight.discard(job.chat_id)
+            self._push(job)
+            self._condition.notify_all()
+        logging.warning(f"Повторна відправка в чат {job.chat_id} через {retry_delay} с (спроба {job.attempts})")
+
+    def _finish(self, job, result=None, error=None):
+        with self._condition:
+            self._in_flight.discard(job.chat_id)
+            self._schedule(job.chat_id)
+            self._latencies.append(time.monotonic() - job.created)
+            self._counters['failed' if error is not None else 'sent'] += 1
+            self._condition.notify_all()
+        if error is not None:
+            logging.warning(f"Не вдалося надіслати повідомлення в чат {job.chat_id}: {error}")
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    # Метрики очереди: глубина по приоритетам, счетчики и задержка от
+    # постановки в очередь до завершения вызова
+    def metrics(self):
+        with self._condition:
+            depth = {PRIORITY_NAMES.get(priority, str(priority)): count for priority, count in self._depth.items()}
+            latencies = sorted(self._latencies)
+            counters = dict(self._counters)
+            in_flight = len(self._in_flight)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000, 1)
+
+        return {
+            'queue_depth': sum(depth.values()),
+            'queue_depth_by_priority': depth,
+            'in_flight': in_flight,
+            **counters,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+            'latency_max_ms': percentile(1.0),
+        }
+
+
+# Очередь отправки асинхронного бота (AsyncTeleBot) с теми же лимитами и
+# повторами. func - корутинная функция, например bot.send_message: она
+# выполняется в цикле событий, из которого вызван submit, а поток очереди
+# ждет ее завершения.
+class AsyncOutbox(Outbox):
+    api_errors = (asyncio_helper.ApiTelegramException,)
+    network_errors = (asyncio_helper.RequestTimeout,)
+
+    def submit(self, chat_id, func, *args, priority=PRIORITY_USER, **kwargs):
+        loop = asyncio.get_running_loop()
+
+        @functools.wraps(func)
+        def call(*call_args, **call_kwargs):
+            return asyncio.run_coroutine_threadsafe(func(*call_args, **call_kwargs), loop).result()
+
+        return super().submit(chat_id, call, *args, priority=priority, **kwargs)
@@ -0,0 +1,191 @@
+"""Воспроизводимый набор замеров производительности для сравнения коммитов.
+
+Запуск:
+    python perf_suite.py run --output perf.json
+    python perf_suite.py run --users 2000 --concurrency 100 --export-rows 1000 10000 100000 --output perf.json
+    python perf_suite.py compare base.json perf.json --threshold 0.2
+
+run выполняет нагрузочный сценарий flow из loadtest.py (регистрация,
+заявки с вложениями и без, одобрение и отклонение администратором) против
+локальной замены Telegram API и экспорт в Excel из benchmark.py для
+нескольких размеров базы. В отчет JSON попадают p50/p95/p99 шагов
+пользователя, каждого обработчика bot.py и каждой функции database.py,
+экспорта по размерам, а также коммит, версии и параметры прогона. Сценарий
+определяется параметрами и --seed, поэтому отчеты с одинаковыми
+параметрами сравнимы между коммитами.
+
+compare сравнивает p95 двух отчетов и завершается с кодом 1, если какой-то
+замер вырос больше чем на --threshold (доля) и на --min-ms миллисекунд.
+Замеры меньше чем из --min-count значений не сравниваются: их p95 - это
+по сути единичный вызов (например, задачи при запуске бота).
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime
+
+import benchmark
+import loadtest
+import metrics
+
+REPORT_VERSION = 1
+# Метрики процесса бота, попадающие в отчет, и имена разделов
+BOT_METRICS = {
+    metrics.HANDLER: 'handlers',
+    metrics.DB: 'database',
+    metrics.TELEGRAM_API: 'telegram_api',
+    metrics.JOB: 'jobs',
+}
+
+
+def _git(*args):
+    try:
+        completed = subprocess.run(['git', *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   capture_output=True, text=True, check=True, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return completed.stdout.strip()
+
+
+def collect_meta(params):
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'report_version': REPORT_VERSION,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'params': params,
+    }
+
+
+# Гистограммы из снимка метрик бота: {раздел: {метка: перцентили}}
+def _bot_sections(snapshot):
+    sections = {}
+    for name, section in BOT_METRICS.items():
+        rows = {}
+        for row in snapshot.get(name, []):
+            label = ':'.join(str(value) for value in row['labels'].values())
+            rows[label] = {key: value for key, value in row.items() if key != 'labels'}
+        sections[section] = rows
+    return sections
+
+
+def run_suite(args):
+    params = {key: value for key, value in vars(args).items() if key not in ('func', 'output')}
+    report = {'meta': collect_meta(params), 'load': [], 'export': []}
+    for mode in args.modes:
+        result = loadtest.run_mode(mode, 'flow', args.users, args.latency, args.timeout, args.think_time,
+                                   send_rate=args.send_rate, concurrency=args.concurrency,
+                                   attachment_share=args.attachments, reject_share=args.reject_share,
+                                   seed=args.seed, bot_metrics=True)
+        snapshot = result.pop('bot_metrics', None) or {}
+        result.update(_bot_sections(snapshot))
+        report['load'].append(result)
+        print(f"{mode}: {result['completed_flows']}/{args.users} сценаріїв за {result['seconds']} с, "
+              f"помилок {len(result['errors'])}", file=sys.stderr)
+    if args.export_rows:
+        report['export'] = benchmark.run_export_sizes(args.export_rows, ['streaming'], args.export_repeats)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"Звіт збережено: {args.output}", file=sys.stderr)
+    return 1 if any(result['errors'] for result in report['load']) else 0
+
+
+# Плоский список замеров отчета: {ключ: (p95 в миллисекундах, число значений)}.
+# У экспорта число значений не учитывается: повторов всегда немного.
+def flatten(report):
+    values = {}
+    for result in report.get('load', []):
+        mode = result['mode']
+        for step, row in result.get('steps', {}).items():
+            values[f"{mode}/step/{step}"] = (row.get('p95_ms'), row.get('count'))
+        for section in BOT_METRICS.values():
+            for label, row in result.get(section, {}).items():
+                values[f"{mode}/{section}/{label}"] = (row.get('p95_ms'), row.get('count'))
+    for row in report.get('export', []):
+        values[f"export/{row['variant']}/{row['rows']}"] = (row['p95_s'] * 1000, None)
+    return values
+
+
+def compare(base, new, threshold, min_ms, min_count=0):
+    base_values, new_values = flatten(base), flatten(new)
+    rows = []
+    for key in sorted(base_values.keys() & new_values.keys()):
+        (before, before_count), (after, after_count) = base_values[key], new_values[key]
+        if before is None or after is None:
+            continue
+        if min(before_count or min_count, after_count or min_count) < min_count:
+            continue
+        change = (after - before) / before if before else None
+        regression = after - before >= min_ms and (change is None or change > threshold)
+        improvement = before - after >= min_ms and change is not None and change < -threshold
+        if regression or improvement:
+            rows.append((key, before, after, change, regression))
+    missing = sorted(base_values.keys() - new_values.keys())
+    return rows, missing
+
+
+def compare_reports(args):
+    with open(args.base, encoding='utf-8') as file:
+        base = json.load(file)
+    with open(args.new, encoding='utf-8') as file:
+        new = json.load(file)
+    base_meta, new_meta = base.get('meta', {}), new.get('meta', {})
+    print(f"База: {base_meta.get('commit')}  Нова: {new_meta.get('commit')}")
+    if base_meta.get('params') != new_meta.get('params'):
+        print("⚠️ Параметри прогонів відрізняються, порівняння може бути некоректним")
+    rows, missing = compare(base, new, args.threshold, args.min_ms, args.min_count)
+    regressions = [row for row in rows if row[4]]
+    for key, before, after, change, regression in rows:
+        mark = "🔴" if regression else "🟢"
+        percent = f"{change * 100:+.0f}%" if change is not None else "нове"
+        print(f"{mark} {key}: p95 {before:.1f} → {after:.1f} мс ({percent})")
+    for key in missing:
+        print(f"⚪ {key}: відсутній у новому звіті")
+    if not rows:
+        print("Суттєвих змін p95 немає")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Нагрузочний сценарій і експорт, звіт у JSON")
+    run_parser.add_argument('--output', default='perf.json')
+    run_parser.add_argument('--modes', nargs='+', default=['sync'], choices=['sync', 'webhook', 'async'])
+    run_parser.add_argument('--users', type=int, default=1000)
+    run_parser.add_argument('--concurrency', type=int, default=50)
+    run_parser.add_argument('--attachments', type=float, default=0.3)
+    run_parser.add_argument('--reject-share', type=float, default=0.2)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--latency', type=float, default=0.005)
+    run_parser.add_argument('--think-time', type=float, default=0.0)
+    # Без лимитов очереди отправки: замеряется бот, а не ограничения Telegram
+    run_parser.add_argument('--send-rate', type=float, default=0)
+    run_parser.add_argument('--timeout', type=float, default=120)
+    run_parser.add_argument('--export-rows', type=int, nargs='*', default=[1000, 10000, 100000])
+    run_parser.add_argument('--export-repeats', type=int, default=3)
+    run_parser.set_defaults(func=run_suite)
+
+    compare_parser = subparsers.add_parser('compare', help="Порівняння p95 двох звітів")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.2)
+    compare_parser.add_argument('--min-ms', type=float, default=1.0)
+    compare_parser.add_argument('--min-count', type=int, default=20)
+    compare_parser.set_defaults(func=compare_reports)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import re
+from datetime import datetime, timedelta
+
+import database
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+# Длина комментария заявки в списках активных заявок
+ACTIVE_COMMENT_LIMIT = 1000
+
+_MARKDOWN_SPECIAL = re.compile(r'([_*`\[])')
+
+# Порядок статусов в отчетах
+STATUS_ORDER = [database.STATUS_PENDING, database.STATUS_APPROVED, database.STATUS_REJECTED]
+
+# Функция для перевода секунд в читаемую длительность
+def format_duration(seconds):
+    if seconds is None:
+        return "—"
+    minutes = int(round(seconds / 60))
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days} дн. {hours} год."
+    if hours:
+        return f"{hours} год. {minutes} хв."
+    return f"{minutes} хв."
+
+def _ordered_statuses(stats):
+    return [status for status in STATUS_ORDER if status in stats] + sorted(status for status in stats if status not in STATUS_ORDER)
+
+# Функция для формирования строк по статусам: число заявок и сумма
+def _format_status_lines(stats, indent=''):
+    lines = []
+    for status in _ordered_statuses(stats):
+        lines.append(f"{indent}{status}: {stats[status]['count']} (сума {stats[status]['amount']})")
+    return lines
+
+# Функция для формирования текста статистики по статусам. title - заголовок
+# отчета (например, с указанием периода).
+def format_stats(stats, title="📊 Статистика запитів:"):
+    total_count = sum(values['count'] for values in stats.values())
+    total_amount = sum(values['amount'] for values in stats.values())
+    approved = stats.get(database.STATUS_APPROVED, {})
+    rejected = stats.get(database.STATUS_REJECTED, {})
+    lines = [
+        title,
+        f"Загалом запитів: {total_count}",
+        f"Погоджено: {approved.get('count', 0)}",
+        f"Відхилено: {rejected.get('count', 0)}",
+        f"Загальна сума: {total_amount}",
+        f"Середній час погодження: {format_duration(approved.get('avg_decision_seconds'))}",
+        f"Середній час відхилення: {format_duration(rejected.get('avg_decision_seconds'))}",
+        "",
+        "За статусами:",
+    ]
+    lines.extend(_format_status_lines(stats, '  '))
+    return '\n'.join(lines)
+
+# Функция для формирования текста статистики по городам
+def format_city_stats(stats_by_city, title="🏙 Статистика за містами:"):
+    if not stats_by_city:
+        return f"{title}\nЗапитів немає."
+    lines = [title]
+    for city, stats in stats_by_city.items():
+        total_count = sum(values['count'] for values in stats.values())
+        total_amount = sum(values['amount'] for values in stats.values())
+        lines.append(f"\n{city or 'Без міста'}: {total_count} (сума {total_amount})")
+        lines.extend(_format_status_lines(stats, '  '))
+    return '\n'.join(lines)
+
+# Функция для формирования результата сверки статистики
+def format_stats_verification(mismatches, fixed=False):
+    if not mismatches:
+        return "✅ Статистика збігається з повним перерахунком."
+    lines = [f"⚠️ Розбіжностей: {len(mismatches)}"]
+    for mismatch in mismatches[:10]:
+        place = ', '.join(str(part) for part in (mismatch['day'], mismatch['city'], mismatch['status']) if part is not None)
+        stats, recount = mismatch['stats'], mismatch['recount']
+        lines.append(f"{place}: кількість {stats[0]} замість {int(recount[0])}, сума {stats[1]} замість {int(recount[1])}")
+    if len(mismatches) > 10:
+        lines.append(f"... та ще {len(mismatches) - 10}")
+    if fixed:
+        lines.append("Статистику перераховано.")
+    return '\n'.join(lines)
+
+# Экранирование текста пользователя для parse_mode='Markdown': символы
+# разметки в имени или комментарии не ломают разбор сообщения
+def escape_markdown(text):
+    return _MARKDOWN_SPECIAL.sub(r'\\\1', str(text))
+
+def format_active_request(req):
+    comment = str(req['comment'])
+    if len(comment) > ACTIVE_COMMENT_LIMIT:
+        comment = comment[:ACTIVE_COMMENT_LIMIT] + '…'
+    return (f"📌 **Запит №{req['request_number']}**\n"
+            f"👤 **Користувач:** {escape_markdown(req['name'])} (Телефон: {escape_markdown(req['phone'])})\n"
+            f"💰 **Сума:** {req['amount']}\n"
+            f"🖋 **Коментар:** {escape_markdown(comment)}\n"
+            f"📎 **Файл:** {'Прикріплено' if req['file_path'] else 'Файл не додано.'}\n"
+            f"📅 **Статус:** {req['status']}")
+
+# Обрезка блока до limit символов по границе строки, чтобы не разорвать
+# разметку; одна строка длиннее limit обрезается без незавершенного
+# экранирования в конце
+def _truncate_block(block, limit):
+    if len(block) <= limit:
+        return block
+    cut = block.rfind('\n', 0, limit + 1)
+    if cut > 0:
+        return block[:cut]
+    return block[:limit].rstrip('\\')
+
+# Разбиение блоков текста на сообщения не длиннее MESSAGE_LIMIT
+def split_messages(header, blocks, limit=MESSAGE_LIMIT):
+    chunk = header
+    for block in blocks:
+        block = _truncate_block(block, limit - len(header) - 2)
+        if len(chunk) + len(block) + 2 > limit:
+            yield chunk
+            chunk = header
+        chunk = chunk + "\n\n" + block if chunk else block
+    if chunk != header:
+        yield chunk
+
+# Сообщения напоминания об активных заявках. В инкрементальном режиме
+# (incremental и известно время прошлого напоминания last_run) - только
+# заявки, созданные после last_run, и заявки, которые с тех пор стали старше
+# aging_hours; иначе - все активные заявки. Заявки читаются страницами.
+def format_active_reminder(now, last_run, incremental=False, aging_hours=24):
+    now_text = now.strftime('%Y-%m-%d %H:%M:%S')
+    if not (incremental and last_run):
+        yield from split_messages("🔔 **Нагадування про активні заявки**:",
+                                  (format_active_request(req) for req in database.iter_active_requests()))
+        return
+    aging_delta = timedelta(hours=aging_hours)
+    aging_from = (datetime.strptime(last_run, '%Y-%m-%d %H:%M:%S') - aging_delta).strftime('%Y-%m-%d %H:%M:%S')
+    aging_to = (now - aging_delta).strftime('%Y-%m-%d %H:%M:%S')
+    yield from split_messages("🆕 **Нові заявки з останнього нагадування**:",
+                              (format_active_request(req) for req in
+                               database.iter_active_requests(created_after=last_run, created_before=now_text)))
+    yield from split_messages(f"⏳ **Заявки, що чекають понад {aging_hours} год**:",
+                              (format_active_request(req) for req in
+                               database.iter_active_requests(created_after=aging_from, created_before=aging_to)))
+
+# Функция для формирования сообщения о ходе импорта
+def format_import_progress(state):
+    return (f"⏳ Імпорт: оброблено рядків {state['rows_done']}, додано запитів {state['rows_imported']}, "
+            f"пропущено {state['rows_skipped']}")
+
+# Функция для формирования итога импорта
+def format_import_result(state):
+    lines = [
+        "✅ Імпорт завершено.",
+        f"Рядків оброблено: {state['rows_done']}",
+        f"Запитів додано: {state['rows_imported']}",
+        f"Нових користувачів: {state['users_created']}",
+        f"Рядків пропущено: {state['rows_skipped']}",
+    ]
+    if state['errors']:
+        lines.append("")
+        lines.append("Помилки:")
+        lines.extend(state['errors'][:10])
+        if state['rows_skipped'] > 10:
+            lines.append(f"... та ще {state['rows_skipped'] - 10}")
+    return '\n'.join(lines)
+
+# Функция для формирования подтверждения массового решения по порогу суммы
+def format_bulk_preview(status, max_amount, summary):
+    action = "погоджено" if status == database.STATUS_APPROVED else "відхилено"
+    return (f"⚠️ Буде {action} усі активні заявки з сумою до {max_amount}: "
+            f"{summary['count']} шт. на суму {summary['amount']}. Підтвердити?")
+
+# Функция для формирования итога массового решения. requested - число
+# выбранных заявок, часть которых могла быть решена раньше.
+def format_bulk_result(action_id, status, updated, requested, admin_name):
+    action = "погоджено" if status == database.STATUS_APPROVED else "відхилено"
+    lines = [f"{'✅' if status == database.STATUS_APPROVED else '❌'} Масове рішення #{action_id}: {action} адміністратором {admin_name} "
+             f"{len(updated)} заявок на суму {sum(request['amount'] or 0 for request in updated)}."]
+    if requested > len(updated):
+        lines.append(f"Пропущено вже розглянутих: {requested - len(updated)}.")
+    return '\n'.join(lines)
+
+# Функция для формирования журнала массовых решений
+def format_bulk_actions(actions, admin_names):
+    if not actions:
+        return "📜 Масових рішень ще не було."
+    lines = ["📜 Останні масові рішення:"]
+    for action in actions:
+        criteria = action['criteria']
+        selection = f"сума до {criteria['max_amount']}" if 'max_amount' in criteria else "вибрані в списку"
+        lines.append(f"#{action['id']} {action['created_at']} {admin_names.get(action['admin_id'], action['admin_id'])}: "
+                     f"{action['status']} {action['request_count']} заявок на суму {action['amount_sum']} ({selection})")
+    return '\n'.join(lines)
+
+# Функция для формирования истории статусов заявки
+def format_request_history(request_id, request_info, history, admin_names):
+    if request_info is None:
+        return f"❗️ Запит з ID {request_id} не знайдено."
+    lines = [f"🕓 Історія запиту №{request_info['request_number']} ({request_info['name']}, сума {request_info['amount']}):"]
+    if request_info['comment']:
+        lines.append(f"Коментар автора: {request_info['comment']}")
+    for entry in history:
+        line = f"{entry['changed_at']}: {entry['status']}"
+        if entry['admin_id'] is not None:
+            line += f" ({admin_names.get(entry['admin_id'], entry['admin_id'])})"
+        if entry['comment']:
+            line += f" - {entry['comment']}"
+        lines.append(line)
+    return '\n'.join(lines)
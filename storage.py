@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+import requests
+
+import database
+
+# Хранилище вложений: файл сохраняется под SHA-256 своего содержимого в
+# подкаталогах по первым символам хеша (uploads/ab/cd/abcd....pdf), поэтому
+# одинаковые файлы хранятся один раз, а файлы с одинаковыми именами от разных
+# пользователей не перезаписывают друг друга.
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+# Файлы без ссылок моложе этого времени не удаляются: заявка с ними может
+# создаваться прямо сейчас
+GC_GRACE_SECONDS = 60 * 60
+TEMP_FOLDER = 'tmp'
+
+TELEGRAM_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
+_SHARD = re.compile(r'^[0-9a-f]{2}$')
+
+
+def blob_path(root, sha256, extension=''):
+    return os.path.join(root, sha256[:2], sha256[2:4], sha256 + extension.lower())
+
+
+# Функция для сохранения потока байтов в хранилище. Содержимое пишется во
+# временный файл с одновременным подсчетом хеша и затем переносится на место.
+# Возвращает путь к файлу хранилища.
+def store_chunks(root, chunks, extension='', file_name=None, telegram_file_id=None, telegram_kind=None):
+    temp_folder = os.path.join(root, TEMP_FOLDER)
+    os.makedirs(temp_folder, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    descriptor, temp_path = tempfile.mkstemp(dir=temp_folder)
+    try:
+        with os.fdopen(descriptor, 'wb') as temp_file:
+            for chunk in chunks:
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        path = blob_path(root, sha256, extension)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    stored_path = database.register_file(sha256, path, size, file_name, telegram_file_id, telegram_kind)
+    if stored_path != path:
+        # Такое же содержимое уже сохранено с другим расширением
+        if os.path.exists(path):
+            os.remove(path)
+        logging.info(f"Файл {file_name or sha256} вже є у сховищі: {stored_path}")
+    return stored_path
+
+
+# Функция для потоковой загрузки файла по адресу в хранилище
+def download(url, root, extension='', file_name=None, telegram_file_id=None, telegram_kind=None, proxies=None):
+    with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, proxies=proxies) as response:
+        response.raise_for_status()
+        return store_chunks(root, response.iter_content(CHUNK_SIZE), extension, file_name, telegram_file_id, telegram_kind)
+
+
+def telegram_file_url(token, file_path, file_url=None):
+    return (file_url or TELEGRAM_FILE_URL).format(token, file_path)
+
+
+# Функция для запоминания file_id из ответа Telegram на отправку файла
+def remember_sent_file(path, sent_message):
+    if sent_message is None or database.get_file(path) is None:
+        return
+    if sent_message.photo:
+        database.set_file_telegram_id(path, sent_message.photo[-1].file_id, 'photo')
+    elif sent_message.document:
+        database.set_file_telegram_id(path, sent_message.document.file_id, 'document')
+
+
+# Функция для удаления файлов без ссылок из заявок, а также файлов в
+# каталогах хранилища, которые не зарегистрированы в базе (например, после
+# сбоя во время сохранения). Возвращает число удаленных файлов и байтов.
+def collect_garbage(root, grace=GC_GRACE_SECONDS):
+    removed = 0
+    freed = 0
+    for stored in database.get_unreferenced_files(grace):
+        if database.delete_file(stored['sha256'], grace) and os.path.exists(stored['path']):
+            freed += os.path.getsize(stored['path'])
+            os.remove(stored['path'])
+            removed += 1
+
+    for folder, subfolders, file_names in os.walk(root):
+        relative = os.path.relpath(folder, root)
+        parts = [] if relative == os.curdir else relative.split(os.sep)
+        # Обходятся только каталоги хранилища и каталог временных файлов
+        if parts and not (parts[0] == TEMP_FOLDER or all(_SHARD.match(part) for part in parts)):
+            subfolders[:] = []
+            continue
+        if not parts:
+            subfolders[:] = [name for name in subfolders if name == TEMP_FOLDER or _SHARD.match(name)]
+            continue
+        for file_name in file_names:
+            path = os.path.join(folder, file_name)
+            if parts[0] != TEMP_FOLDER and (len(parts) != 2 or database.get_file(path) is not None):
+                continue
+            if os.path.getmtime(path) > time.time() - grace:
+                continue
+            freed += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+    if removed:
+        logging.info(f"Видалено {removed} файлів сховища ({freed} байт)")
+    return removed, freed
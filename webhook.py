@@ -0,0 +1,204 @@
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from telebot import types
+
+import metrics
+
+# Число потоков, обрабатывающих обновления
+WEBHOOK_WORKERS = 8
+# Заголовок, в котором Telegram передает secret_token из setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_SIZE = 1024 * 1024
+
+
+# Ключ упорядочивания обновления: чат, из которого оно пришло. Обновления без
+# чата (например, inline-запросы) упорядочиваются по пользователю.
+def update_key(update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        call = update.callback_query
+        return call.message.chat.id if call.message is not None else call.from_user.id
+    for name in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+                 'poll_answer', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        item = getattr(update, name, None)
+        user = getattr(item, 'from_user', None) or getattr(item, 'user', None)
+        if user is not None:
+            return user.id
+    return None
+
+
+# Распределение обновлений между потоками. Обновления одного чата
+# обрабатываются строго по порядку поступления и по одному, разные чаты -
+# параллельно: у каждого чата своя очередь, а в очереди готовых чатов ключ
+# чата находится не больше одного раза.
+class UpdateDispatcher:
+    def __init__(self, handler, workers=WEBHOOK_WORKERS):
+        self.handler = handler
+        self.workers = workers
+        self._pending = {}
+        self._ready = deque()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopped = False
+        self.received = 0
+        self.processed = 0
+
+    def start(self):
+        with self._condition:
+            if self._threads:
+                return
+            self._threads = [threading.Thread(target=self._worker_loop, name=f'updates-{index}', daemon=True)
+                             for index in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def submit(self, update):
+        key = update_key(update)
+        if key is None:
+            key = ('update', update.update_id)
+        with self._condition:
+            self.received += 1
+            queue = self._pending.get(key)
+            if queue is None:
+                self._pending[key] = deque([update])
+                self._ready.append(key)
+                self._condition.notify()
+            else:
+                # Чат уже ждет обработки или обрабатывается другим потоком
+                queue.append(update)
+
+    # Ожидание обработки всех принятых обновлений
+    def join(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending, timeout)
+
+    def queue_size(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._pending.values())
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while not self._ready and not self._stopped:
+                    self._condition.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                update = self._pending[key][0]
+            try:
+                self.handler([update])
+            except Exception as e:
+                logging.error(f"Помилка обробки оновлення {update.update_id}: {e}")
+            with self._condition:
+                self.processed += 1
+                queue = self._pending[key]
+                queue.popleft()
+                if queue:
+                    self._ready.append(key)
+                else:
+                    del self._pending[key]
+                self._condition.notify_all()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Telegram открывает до 40 одновременных соединений
+    request_queue_size = 128
+
+
+# HTTP-сервер для приема обновлений от Telegram. Ответ отправляется сразу
+# после постановки обновления в очередь, поэтому Telegram не ждет обработки.
+# Telegram принимает вебхуки только по HTTPS: сервер рассчитан на работу за
+# обратным прокси (nginx), который принимает TLS.
+class WebhookServer:
+    def __init__(self, bot, host, port, path='/', secret=None, workers=WEBHOOK_WORKERS):
+        # Обработчики выполняются в потоках диспетчера, а не в пуле telebot,
+        # иначе порядок обновлений одного чата снова не гарантирован
+        bot.threaded = False
+        self.path = path
+        self.secret = secret
+        self.dispatcher = UpdateDispatcher(bot.process_new_updates, workers)
+        self._server = _Server((host, port), self._make_handler())
+        metrics.add_collector(lambda: [
+            ('webhook_queue_size', 'gauge', {}, self.dispatcher.queue_size()),
+            ('webhook_updates_received', 'counter', {}, self.dispatcher.received),
+            ('webhook_updates_processed', 'counter', {}, self.dispatcher.processed),
+        ])
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def serve_forever(self):
+        self.dispatcher.start()
+        logging.info(f"Вебхук слухає {self.server_address[0]}:{self.server_address[1]}{self.path}")
+        self._server.serve_forever()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self.dispatcher.stop()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                if urlsplit(self.path).path != server.path:
+                    self._reply(404)
+                    return
+                if server.secret and self.headers.get(SECRET_HEADER) != server.secret:
+                    logging.warning(f"Запит до вебхука з неправильним секретом від {self.client_address[0]}")
+                    self._reply(403)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                if length <= 0 or length > MAX_BODY_SIZE:
+                    self._reply(400)
+                    return
+                try:
+                    update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+                except Exception as e:
+                    logging.error(f"Некоректне оновлення у вебхуку: {e}")
+                    self._reply(400)
+                    return
+                server.dispatcher.submit(update)
+                self._reply(200)
+
+            def do_GET(self):
+                self._reply(405)
+
+        return Handler
+
+
+# Запуск бота в режиме вебхука: регистрация адреса в Telegram и прием
+# обновлений. url - внешний адрес, по которому Telegram отправляет
+# обновления; путь из него используется и локальным сервером.
+def run(bot, url, host='0.0.0.0', port=8443, secret=None, workers=WEBHOOK_WORKERS):
+    server = WebhookServer(bot, host, port, urlsplit(url).path or '/', secret, workers)
+    bot.remove_webhook()
+    bot.set_webhook(url=url, secret_token=secret)
+    try:
+        server.serve_forever()
+    finally:
+        server.shutdown()